@@ -0,0 +1,259 @@
+"""
+Index benchmark for action and occupant lookups. Fills a number of rooms with a realistic mix of
+action types, then times the history, has-more, delta, unread count, joined room and action ID
+backfill queries twice, once with the composite action and occupant indexes in place and once
+without them, so that the two can be compared. The query plan for each is printed alongside.
+
+This creates its own users, rooms and actions and does not clean them up, and it drops and recreates indexes
+while it runs, so point it at a scratch database and not at your production instance! The schema
+should be fully migrated before running it. Works against both MySQL and SQLite.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/action_indexes.py --config .config.yaml --rooms 200 --actions 3000000 --occupants 40000 --runs 50
+"""
+import argparse
+import json
+import random
+import statistics
+import string
+import time
+from typing import Callable
+
+from sqlalchemy.sql import text
+from sqlfragments import statement
+
+from critterchat.common import Time
+from critterchat.config import Config, load_config
+from critterchat.data import ActionID, ActionType, Data, RoomID, UserID
+from critterchat.service import MessageService
+
+
+# The indexes under test, and the columns they cover.
+INDEXES: dict[str, tuple[str, list[str]]] = {
+    "ix_action_room_id_action_id": ("action", ["room_id", "action", "id"]),
+    "ix_occupant_user_id_inactive": ("occupant", ["user_id", "inactive"]),
+}
+
+# Roughly what a busy room looks like, mostly messages with edits and reactions mixed in.
+MIX: list[tuple[ActionType, float]] = [
+    (ActionType.MESSAGE, 0.85),
+    (ActionType.CHANGE_REACTION, 0.08),
+    (ActionType.CHANGE_MESSAGE, 0.04),
+    (ActionType.JOIN, 0.01),
+    (ActionType.LEAVE, 0.01),
+    (ActionType.CHANGE_PROFILE, 0.005),
+    (ActionType.CHANGE_INFO, 0.005),
+]
+
+
+def setup(config: Config, rooms: int, actions: int, occupants: int) -> tuple[list[RoomID], UserID]:
+    tag = "".join(random.choice(string.ascii_lowercase) for _ in range(8))
+
+    with Data.spawn(config) as data:
+        messageservice = MessageService(config, data)
+
+        user = data.user.create_account(f"bench_{tag}", "benchmark_password")
+        if user is None:
+            raise Exception("Could not create benchmark user!")
+
+        roomids = [messageservice.create_public_room(f"bench {tag} {i}", "", None).id for i in range(rooms)]
+        for roomid in roomids:
+            messageservice.join_room(roomid, user.id)
+        data.commit()
+
+    with config.database.engine.connect() as connection:
+        joined: dict[RoomID, int] = {}
+        for result in connection.execute(
+            text("SELECT id, room_id FROM occupant WHERE user_id = :userid"), {"userid": user.id}
+        ).mappings():
+            joined[RoomID(result['room_id'])] = int(result['id'])
+
+        # Everyone else only needs to exist as occupants, with some of them having left.
+        if occupants:
+            base = (user.id % 1000 + 1) * 1000000
+            connection.execute(
+                text("INSERT INTO occupant (user_id, room_id, inactive, moderator, muted) VALUES (:userid, :roomid, :inactive, FALSE, FALSE)"),
+                [
+                    {"userid": base + i, "roomid": random.choice(roomids), "inactive": random.random() < 0.2}
+                    for i in range(occupants)
+                ],
+            )
+            connection.commit()
+
+        # Interleave rooms the same way real traffic does, so that no room's actions are contiguous.
+        types = [t for t, _ in MIX]
+        weights = [w for _, w in MIX]
+        batch: list[dict[str, object]] = []
+        for i in range(actions):
+            roomid = random.choice(roomids)
+            batch.append({
+                "timestamp": Time.now(),
+                "roomid": roomid,
+                "occupantid": joined[roomid],
+                "action": str(random.choices(types, weights)[0]),
+                "details": json.dumps({"message": f"benchmark message {i}"}),
+            })
+            if len(batch) >= 10000 or i == actions - 1:
+                connection.execute(
+                    text(
+                        "INSERT INTO action (timestamp, room_id, occupant_id, action, details) "
+                        "VALUES (:timestamp, :roomid, :occupantid, :action, :details)"
+                    ),
+                    batch,
+                )
+                connection.commit()
+                batch = []
+
+    with Data.spawn(config) as data:
+        data.room.backfill_action_ids()
+        data.commit()
+
+    return roomids, user.id
+
+
+def analyze(config: Config) -> None:
+    with config.database.engine.connect() as connection:
+        if config.database.backend == "mysql":
+            connection.execute(text("ANALYZE TABLE action, occupant"))
+        else:
+            connection.execute(text("ANALYZE"))
+        connection.commit()
+
+
+def set_indexes(config: Config, present: bool) -> None:
+    with config.database.engine.connect() as connection:
+        for name, (table, columns) in INDEXES.items():
+            if present:
+                connection.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+            elif config.database.backend == "mysql":
+                connection.execute(text(f"DROP INDEX {name} ON {table}"))
+            else:
+                connection.execute(text(f"DROP INDEX {name}"))
+        connection.commit()
+    analyze(config)
+
+
+def plan(config: Config, data: Data, sql: str, params: dict[str, object]) -> str:
+    if config.database.backend == "mysql":
+        results = data.room.execute(statement(f"EXPLAIN {sql}", **params)).mappings()
+        return "; ".join(f"{r['table']}: {r['key'] or 'scan'} ({r['Extra'] or ''})" for r in results)
+    else:
+        results = data.room.execute(statement(f"EXPLAIN QUERY PLAN {sql}", **params)).mappings()
+        return "; ".join(str(r['detail']) for r in results)
+
+
+def measure(config: Config, roomids: list[RoomID], userid: UserID, runs: int) -> dict[str, tuple[float, str]]:
+    # Pick a room and anchors within it up front so that both passes time exactly the same work.
+    roomid = roomids[0]
+    with Data.spawn(config) as data:
+        room = data.room.get_room(roomid)
+        if room is None or room.oldest_action is None or room.newest_action is None:
+            raise Exception("Benchmark room has no actions!")
+    middle = ActionID((room.oldest_action + room.newest_action) // 2)
+    recent = ActionID(room.newest_action - 50 * len(roomids))
+
+    unread = [str(t) for t in ActionType.unread_types()]
+    updates = [str(t) for t in ActionType.update_types()]
+    rare = [str(ActionType.CHANGE_INFO)]
+
+    queries: list[tuple[str, Callable[[Data], object], str, dict[str, object]]] = [
+        (
+            "history, unread types, limit 101",
+            lambda data: data.room.get_room_history(roomid, types=ActionType.unread_types(), limit=101),
+            "SELECT id FROM action WHERE room_id = %value:roomid AND action IN (%inlist:types) ORDER BY id DESC LIMIT 101",
+            {"roomid": roomid, "types": unread},
+        ),
+        (
+            "history, rare type, limit 101",
+            lambda data: data.room.get_room_history(roomid, types=[ActionType.CHANGE_INFO], limit=101),
+            "SELECT id FROM action WHERE room_id = %value:roomid AND action IN (%inlist:types) ORDER BY id DESC LIMIT 101",
+            {"roomid": roomid, "types": rare},
+        ),
+        (
+            "has more history, rare type",
+            lambda data: data.room.has_room_history(roomid, after=middle, types=[ActionType.CHANGE_INFO]),
+            "SELECT id FROM action WHERE room_id = %value:roomid AND id > %value:after AND action IN (%inlist:types) LIMIT 1",
+            {"roomid": roomid, "after": middle, "types": rare},
+        ),
+        (
+            "deltas, update types",
+            lambda data: data.room.get_room_history(roomid, after=recent, types=ActionType.update_types()),
+            "SELECT id FROM action WHERE room_id = %value:roomid AND id > %value:after AND action IN (%inlist:types) ORDER BY id DESC",
+            {"roomid": roomid, "after": recent, "types": updates},
+        ),
+        (
+            "unread count, half the room",
+            lambda data: data.user.count_unread_actions_many({roomid: middle}),
+            "SELECT COUNT(id) FROM action WHERE room_id = %value:roomid AND id > %value:after AND action IN (%inlist:types)",
+            {"roomid": roomid, "after": middle, "types": unread},
+        ),
+        (
+            "unread count, every room",
+            lambda data: data.user.count_unread_actions_many({r: None for r in roomids}),
+            "SELECT COUNT(id) FROM action WHERE room_id = %value:roomid AND action IN (%inlist:types)",
+            {"roomid": roomid, "types": unread},
+        ),
+        (
+            "joined rooms",
+            lambda data: data.room.get_joined_rooms(userid),
+            "SELECT id FROM room WHERE id IN (SELECT room_id FROM occupant WHERE user_id = %value:userid AND inactive != TRUE)",
+            {"userid": userid},
+        ),
+        (
+            "backfill oldest/newest ids",
+            lambda data: data.room.backfill_action_ids(),
+            "SELECT (SELECT MIN(id) FROM action WHERE action.room_id = room.id), "
+            "(SELECT MAX(id) FROM action WHERE action.room_id = room.id) FROM room",
+            {},
+        ),
+    ]
+
+    results: dict[str, tuple[float, str]] = {}
+    with Data.spawn(config) as data:
+        for name, query, sql, params in queries:
+            # One warm-up run so that both passes start from a populated cache.
+            query(data)
+            timings: list[float] = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                query(data)
+                timings.append(time.perf_counter() - start)
+            data.commit()
+
+            results[name] = (statistics.mean(timings), plan(config, data, sql, params))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure action and occupant queries with and without the composite indexes.")
+    parser.add_argument("-c", "--config", help="Core configuration for the database to benchmark against.", type=str, required=True)
+    parser.add_argument("-r", "--rooms", help="Number of rooms to spread the actions across.", type=int, default=200)
+    parser.add_argument("-a", "--actions", help="Number of actions to insert.", type=int, default=500000)
+    parser.add_argument("-o", "--occupants", help="Number of other occupants to spread across the rooms.", type=int, default=40000)
+    parser.add_argument("-n", "--runs", help="Number of times to run each query per pass.", type=int, default=50)
+    args = parser.parse_args()
+
+    config = Config()
+    load_config(args.config, config)
+
+    roomids, userid = setup(config, args.rooms, args.actions, args.occupants)
+    analyze(config)
+
+    indexed = measure(config, roomids, userid, args.runs)
+    set_indexes(config, False)
+    try:
+        unindexed = measure(config, roomids, userid, args.runs)
+    finally:
+        set_indexes(config, True)
+
+    print(f"{args.actions} actions and {args.occupants} occupants across {args.rooms} rooms on {config.database.backend}, mean of {args.runs} runs")
+    for name, (after, afterplan) in indexed.items():
+        before, beforeplan = unindexed[name]
+        print(f"  {name}: {before * 1000:.2f}ms without, {after * 1000:.2f}ms with")
+        print(f"    without: {beforeplan}")
+        print(f"    with: {afterplan}")
+
+
+if __name__ == "__main__":
+    main()
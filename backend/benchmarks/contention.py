@@ -0,0 +1,118 @@
+"""
+Contention benchmark for action inserts. Spins up a number of concurrent writers spread across a
+number of rooms, each posting messages with an attachment and reacting to earlier messages, which
+are the two paths that lock a room. Reports throughput and latency so that locking changes can be
+compared on a real database.
+
+This creates its own users, rooms and attachments and does not clean them up, so point it at a
+scratch database and not at your production instance! Note that SQLite only ever allows a single
+writer, so concurrent writers will mostly fail with locking errors there. This is only meaningful
+when run against MySQL.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/contention.py --config .config.yaml --writers 16 --rooms 4 --operations 200
+"""
+import argparse
+import random
+import statistics
+import string
+import threading
+import time
+
+from critterchat.config import Config, load_config
+from critterchat.data import ActionID, Data, RoomID, UserID
+from critterchat.service import MessageService
+
+
+def setup(config: Config, writers: int, rooms: int) -> tuple[list[RoomID], list[UserID]]:
+    tag = "".join(random.choice(string.ascii_lowercase) for _ in range(8))
+
+    with Data.spawn(config) as data:
+        messageservice = MessageService(config, data)
+
+        roomids = [messageservice.create_public_room(f"bench {tag} {i}", "", None).id for i in range(rooms)]
+        userids: list[UserID] = []
+        for i in range(writers):
+            user = data.user.create_account(f"bench_{tag}_{i}", "benchmark_password")
+            if user is None:
+                raise Exception("Could not create benchmark user!")
+            userids.append(user.id)
+
+            # Each writer sticks to one room, so writers only contend with others in the same room.
+            messageservice.join_room(roomids[i % rooms], user.id)
+
+        data.commit()
+
+    return roomids, userids
+
+
+def writer(config: Config, roomid: RoomID, userid: UserID, operations: int, latencies: list[float], errors: list[str]) -> None:
+    with Data.spawn(config) as data:
+        messageservice = MessageService(config, data)
+        posted: list[ActionID] = []
+        reacted: set[ActionID] = set()
+
+        for _ in range(operations):
+            start = time.perf_counter()
+            try:
+                if posted and random.random() < 0.5:
+                    # Toggle our reaction so that every one of these actually writes something.
+                    actionid = random.choice(posted)
+                    if actionid in reacted:
+                        messageservice.remove_reaction(userid, actionid, ":thumbsup:")
+                        reacted.discard(actionid)
+                    else:
+                        messageservice.add_reaction(userid, actionid, ":thumbsup:")
+                        reacted.add(actionid)
+                else:
+                    aid = data.attachment.insert_attachment('local', 'image/png', 'bench.png', {})
+                    if aid is None:
+                        raise Exception("Could not create benchmark attachment!")
+                    action = messageservice.add_message(roomid, userid, "benchmark message", False, [aid])
+                    if action is not None:
+                        posted.append(action.id)
+
+                data.commit()
+            except Exception as e:
+                errors.append(str(e))
+
+            latencies.append(time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure action insert throughput with concurrent writers across rooms.")
+    parser.add_argument("-c", "--config", help="Core configuration for the database to benchmark against.", type=str, required=True)
+    parser.add_argument("-w", "--writers", help="Number of concurrent writers.", type=int, default=16)
+    parser.add_argument("-r", "--rooms", help="Number of rooms to spread the writers across.", type=int, default=4)
+    parser.add_argument("-o", "--operations", help="Number of messages and reactions each writer performs.", type=int, default=200)
+    args = parser.parse_args()
+
+    config = Config()
+    load_config(args.config, config)
+
+    roomids, userids = setup(config, args.writers, args.rooms)
+
+    latencies: list[float] = []
+    errors: list[str] = []
+    threads = [
+        threading.Thread(target=writer, args=(config, roomids[i % args.rooms], userids[i], args.operations, latencies, errors))
+        for i in range(args.writers)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{args.writers} writers across {args.rooms} rooms on {config.database.backend}")
+    print(f"  {len(latencies)} operations in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} ops/s")
+    print(f"  p50 {statistics.median(latencies) * 1000:.1f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+    if errors:
+        print(f"  {len(errors)} operations failed, first error: {errors[0]}")
+
+
+if __name__ == "__main__":
+    main()
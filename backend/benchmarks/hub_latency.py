@@ -0,0 +1,93 @@
+"""
+Event loop latency benchmark for database access. Runs a number of greenlets that each stand in
+for an unrelated websocket, waking up on a short interval, alongside a number of greenlets that
+run deliberately slow queries. Reports how late the websocket greenlets woke up, once with every
+query run directly on the gevent hub and once with queries handed off to the query thread pool,
+so that the two can be compared.
+
+This only ever reads from the database, so it is safe to point at any instance. On MySQL the slow
+query sleeps on the server, and on SQLite it counts through a large recursive query instead.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/hub_latency.py --config .config.yaml --threads 4 --slow 4 --duration 5
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa
+import statistics  # noqa
+import time  # noqa
+
+import gevent  # noqa
+
+from critterchat.config import Config, load_config  # noqa
+from critterchat.data import Data  # noqa
+
+
+def slow_query(config: Config, seconds: float, deadline: float, completed: list[float]) -> None:
+    with Data.spawn(config) as data:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if config.database.backend == "mysql":
+                data.user.execute("SELECT SLEEP(:seconds) AS slept", {"seconds": seconds})
+            else:
+                sql = """
+                    WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter WHERE x < :rows)
+                    SELECT COUNT(*) AS counted FROM counter
+                """
+                data.user.execute(sql, {"rows": int(seconds * 3_000_000)})
+            completed.append(time.perf_counter() - start)
+
+            # Real handlers give the hub a chance to run between queries when they talk to clients.
+            gevent.sleep(0)
+
+
+def socket(interval: float, deadline: float, lateness: list[float]) -> None:
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        gevent.sleep(interval)
+        lateness.append(time.perf_counter() - start - interval)
+
+
+def measure(config: Config, threads: int, slow: int, sockets: int, seconds: float, duration: float) -> None:
+    config["database"]["query_threads"] = threads
+    Data.configure_process(config)
+
+    completed: list[float] = []
+    lateness: list[float] = []
+    deadline = time.perf_counter() + duration
+
+    # Let every socket start waiting before any slow query gets going.
+    waiting = [gevent.spawn(socket, 0.01, deadline, lateness) for _ in range(sockets)]
+    gevent.sleep(0)
+    querying = [gevent.spawn(slow_query, config, seconds, deadline, completed) for _ in range(slow)]
+    gevent.joinall(querying, raise_error=True)
+    gevent.joinall(waiting, raise_error=True)
+
+    lateness.sort()
+    mode = f"{threads} query threads" if threads else "queries on the hub"
+    print(f"{mode}, {slow} slow query greenlets and {sockets} socket greenlets on {config.database.backend}")
+    if completed:
+        print(f"  {len(completed)} slow queries, p50 {statistics.median(completed) * 1000:.1f}ms each")
+    print(f"  {len(lateness)} socket wakeups, p50 {statistics.median(lateness) * 1000:.1f}ms late, p99 {lateness[int(len(lateness) * 0.99)] * 1000:.1f}ms late, max {lateness[-1] * 1000:.1f}ms late")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure how much slow queries delay unrelated greenlets.")
+    parser.add_argument("-c", "--config", help="Core configuration for the database to benchmark against.", type=str, required=True)
+    parser.add_argument("-t", "--threads", help="Number of query threads to compare against running on the hub.", type=int, default=4)
+    parser.add_argument("-s", "--slow", help="Number of greenlets running slow queries.", type=int, default=4)
+    parser.add_argument("-k", "--sockets", help="Number of greenlets standing in for unrelated websockets.", type=int, default=50)
+    parser.add_argument("-q", "--query-seconds", help="Roughly how long each slow query should take.", type=float, default=0.25)
+    parser.add_argument("-d", "--duration", help="Number of seconds to run each measurement for.", type=float, default=5)
+    args = parser.parse_args()
+
+    config = Config()
+    load_config(args.config, config)
+
+    measure(config, 0, args.slow, args.sockets, args.query_seconds, args.duration)
+    measure(config, args.threads, args.slow, args.sockets, args.query_seconds, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Image upload benchmark. Runs every image in a corpus through the same checks and thumbnailing that
+uploaded attachments go through, each in its own freshly forked process, and reports the wall time
+and peak memory that each upload took. Peak memory is reported both as the process total and as
+how much it grew over what the process was already using before the upload started.
+
+Without a corpus directory, this generates a handful of large JPEG, PNG and WebP images to use
+instead, along with a HEIC image the size that phones take them. No database is needed, since
+nothing is stored anywhere.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/media_decode.py --corpus ~/photos --megapixels 100
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from multiprocessing.connection import Connection
+from typing import Any
+
+from PIL import ExifTags, Image
+
+from critterchat.service.attachment import AttachmentServiceException, _prepare_attachment_image
+
+
+def generate(directory: str, width: int, height: int) -> list[str]:
+    image = photo(width, height)
+
+    # Phones tag photos with their orientation instead of rotating them.
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6
+
+    formats: list[tuple[str, dict[str, Any]]] = [
+        ("jpg", {"quality": 90, "exif": exif}),
+        ("png", {}),
+        ("webp", {"quality": 90}),
+    ]
+
+    paths: list[str] = []
+    for ext, kwargs in formats:
+        path = os.path.join(directory, f"generated_{width}x{height}.{ext}")
+        image.save(path, **kwargs)
+        paths.append(path)
+
+    # Not every HEIF decoder handles images larger than this unless they're split into tiles,
+    # which is what phones do for anything larger.
+    path = os.path.join(directory, "generated_4032x3024.heic")
+    photo(4032, 3024).save(path, quality=90)
+    paths.append(path)
+
+    return paths
+
+
+def photo(width: int, height: int) -> Image.Image:
+    # Something with smooth gradients and fine detail, so files are sized like real photos.
+    mandelbrot = Image.effect_mandelbrot((width, height), (-2.0, -1.25, 1.0, 1.25), 64)
+    noise = Image.effect_noise((width, height), 24)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (mandelbrot, noise, gradient))
+
+
+def measure(data: bytes, max_pixels: int, conn: Connection) -> None:
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    try:
+        _, thumbs, width, height, _, content_type = _prepare_attachment_image(data, None, None, max_pixels)
+        sizes = ", ".join(f"{t.height}px {t.content_type} {len(t.data) / 1024:.1f}kb" for t in thumbs)
+        result = f"{width}x{height} {content_type}, thumbnails {sizes}"
+    except AttachmentServiceException as e:
+        result = f"rejected: {e}"
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    conn.send((elapsed, before, after, result))
+    conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure wall time and peak memory for processing uploaded images.")
+    parser.add_argument("-c", "--corpus", help="Directory of images to run through, instead of generating some.", type=str, default=None)
+    parser.add_argument("-W", "--width", help="Width of generated images.", type=int, default=6000)
+    parser.add_argument("-H", "--height", help="Height of generated images.", type=int, default=4000)
+    parser.add_argument("-m", "--megapixels", help="Largest image in megapixels that will be accepted.", type=int, default=64)
+    parser.add_argument("-r", "--repeat", help="Number of times to process each image.", type=int, default=3)
+    args = parser.parse_args()
+
+    # Forking keeps the baseline identical for every upload, since nothing is imported per run.
+    context = multiprocessing.get_context("fork")
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.corpus:
+            paths = sorted(os.path.join(args.corpus, f) for f in os.listdir(args.corpus))
+        else:
+            paths = generate(directory, args.width, args.height)
+
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as bfp:
+                data = bfp.read()
+
+            timings: list[float] = []
+            peaks: list[int] = []
+            growths: list[int] = []
+            result = ""
+            for _ in range(args.repeat):
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=measure, args=(data, args.megapixels * 1000 * 1000, sender))
+                process.start()
+                sender.close()
+                try:
+                    elapsed, before, after, result = receiver.recv()
+                except EOFError:
+                    elapsed, before, after, result = 0.0, 0, 0, "crashed"
+                process.join()
+
+                timings.append(elapsed)
+                peaks.append(after)
+                growths.append(after - before)
+
+            print(f"{os.path.basename(path)} ({len(data) // 1024}kb): {result}")
+            print(f"  best {min(timings) * 1000:.0f}ms, worst {max(timings) * 1000:.0f}ms, peak RSS {max(peaks) // 1024}MB (+{max(growths) // 1024}MB for this upload)")
+
+
+if __name__ == "__main__":
+    main()
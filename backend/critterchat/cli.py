@@ -3,11 +3,13 @@ monkey.patch_all()
 
 import argparse  # noqa
 import logging  # noqa
+import os  # noqa
 from flask.logging import default_handler  # noqa
 from gevent.ssl import Purpose, create_default_context  # noqa
 from werkzeug.middleware.proxy_fix import ProxyFix  # noqa
 
 from critterchat.http import app, config, socketio  # noqa
+from critterchat.http.cluster import create_client_manager  # noqa
 
 from critterchat.config import Config, load_config  # noqa
 from critterchat.data import Data  # noqa
@@ -40,11 +42,17 @@ def perform_initialization_work(config: Config) -> None:
         userservice = UserService(config, data)
         logger.info("Migrating any legacy names to current rules.")
         userservice.migrate_legacy_names()
+        logger.info("Migrating any legacy unread counts to current system.")
+        userservice.migrate_unread_counts()
 
         # Ensure any per-room nicknames loopholes are fixed.
         messageservice = MessageService(config, data)
         logger.info("Migrating any per-room legacy names to current rules.")
         messageservice.migrate_legacy_names()
+        logger.info("Migrating any legacy room action IDs to current system.")
+        messageservice.migrate_room_action_ids()
+        logger.info("Migrating any legacy message reactions to current system.")
+        messageservice.migrate_reactions()
 
         logger.info("Done with initialization.")
 
@@ -58,6 +66,7 @@ def main(prog: str = "critterchat") -> None:
     parser.add_argument("-c", "--config", help="Config file to parse for instance settings. Defaults to config.yaml", type=str, default="config.yaml")
     parser.add_argument("-e", "--cert", help="Certificate fullchain to use when directly hosting SSL traffic", type=str, default=None)
     parser.add_argument("-k", "--cert-key", help="Certificate key to use with the fullchain when directly hosting SSL traffic", type=str, default=None)
+    parser.add_argument("-w", "--workers", help="Number of worker processes to run, each listening on its own port starting at --port. Overrides the cluster config section", type=int, default=None)
     args = parser.parse_args()
 
     load_config(args.config, config)
@@ -96,5 +105,44 @@ def main(prog: str = "critterchat") -> None:
     if args.nginx_proxy > 0:
         logger.info(f"Fixing proxy headers with a depth of {args.nginx_proxy}")
         app.wsgi_app = ProxyFix(app.wsgi_app, x_host=args.nginx_proxy, x_proto=args.nginx_proxy, x_for=args.nginx_proxy, x_prefix=args.nginx_proxy)  # type: ignore
-    logger.info(f"Running server listening on port {args.port}")
-    socketio.run(app, host='0.0.0.0', port=args.port, debug=args.debug, **extra_args)
+
+    workers = args.workers if args.workers is not None else config.cluster.workers
+    if workers > 1 and not config.cluster.message_queue:
+        logger.warning("Running multiple workers without a message queue, updates made on one worker will be delayed on others!")
+
+    port = args.port
+    children: list[int] = []
+    for worker in range(1, workers):
+        pid = os.fork()
+        if pid == 0:
+            # Each worker listens on its own port, so put them behind a load balancer with sticky sessions.
+            port = args.port + worker
+            children = []
+            break
+        children.append(pid)
+
+    # Don't share pooled DB connections with any other worker process, and don't let the debug
+    # reloader spawn even more processes.
+    if workers > 1:
+        config.database.engine.dispose(close=False)  # type: ignore
+        extra_args['use_reloader'] = False
+
+    # Now that we know which process we are, set up the caches and thread pools it will use.
+    Data.configure_process(config)
+
+    # Attach to the message queue, if we are running as part of a cluster.
+    client_manager = create_client_manager(config)
+    if client_manager is not None:
+        logger.info(f"Attaching to message queue on channel {config.cluster.channel}")
+        socketio.init_app(app, client_manager=client_manager)
+
+    try:
+        logger.info(f"Running server listening on port {port}")
+        socketio.run(app, host='0.0.0.0', port=port, debug=args.debug, **extra_args)
+    finally:
+        # Read state is buffered in memory between flushes, so write out whatever is left on the way out.
+        with Data.spawn(config) as data:
+            UserService(config, data).flush_last_seen(force=True)
+
+        for pid in children:
+            os.waitpid(pid, 0)
@@ -0,0 +1,340 @@
+import argparse
+import importlib
+import os
+import pickle
+import resource
+import select
+import struct
+import subprocess
+import sys
+import time
+from threading import BoundedSemaphore, Lock
+from typing import IO, Any, Callable, Final, TypeVar, cast
+
+
+__all__ = [
+    "ProcessPool",
+    "ProcessPoolBusyException",
+    "ProcessPoolCrashedException",
+    "ProcessPoolException",
+    "ProcessPoolStats",
+    "ProcessPoolTimeoutException",
+]
+
+
+T = TypeVar("T")
+
+# Every message in either direction is a pickle prefixed with its length.
+_HEADER: Final[struct.Struct] = struct.Struct("<Q")
+
+# How long a freshly started worker gets to import everything before it is given up on.
+_STARTUP_SECONDS: Final[float] = 60.0
+
+# Where this package lives, so that workers can import it no matter how we were started.
+_PACKAGE_ROOT: Final[str] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ProcessPoolException(Exception):
+    pass
+
+
+class ProcessPoolBusyException(ProcessPoolException):
+    pass
+
+
+class ProcessPoolTimeoutException(ProcessPoolException):
+    pass
+
+
+class ProcessPoolCrashedException(ProcessPoolException):
+    pass
+
+
+class ProcessPoolStats:
+    def __init__(
+        self,
+        workers: int,
+        queued: int,
+        running: int,
+        completed: int,
+        failed: int,
+        timeouts: int,
+        crashes: int,
+        rejected: int,
+        busy_seconds: float,
+    ) -> None:
+        self.workers: Final[int] = workers
+        self.queued: Final[int] = queued
+        self.running: Final[int] = running
+        self.completed: Final[int] = completed
+        self.failed: Final[int] = failed
+        self.timeouts: Final[int] = timeouts
+        self.crashes: Final[int] = crashes
+        self.rejected: Final[int] = rejected
+        self.busy_seconds: Final[float] = busy_seconds
+
+    def __repr__(self) -> str:
+        return (
+            f"ProcessPoolStats(workers={self.workers}, queued={self.queued}, running={self.running}, "
+            f"completed={self.completed}, failed={self.failed}, timeouts={self.timeouts}, "
+            f"crashes={self.crashes}, rejected={self.rejected}, busy_seconds={self.busy_seconds:.1f})"
+        )
+
+
+class _Worker:
+    def __init__(self, memory: int, preload: list[str]) -> None:
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(p for p in [_PACKAGE_ROOT, env.get("PYTHONPATH")] if p)
+
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "critterchat.common.process", "--memory", str(memory), *preload],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+
+        # Workers say when they're done importing, so that startup never counts against a job.
+        try:
+            self.__read(_HEADER.size, time.monotonic() + _STARTUP_SECONDS)
+        except ProcessPoolException:
+            self.kill()
+            raise ProcessPoolCrashedException("Worker did not start up!")
+
+    def call(self, job: bytes, timeout: float) -> bytes:
+        stdin = cast(IO[bytes], self.process.stdin)
+        stdin.write(_HEADER.pack(len(job)) + job)
+        stdin.flush()
+
+        deadline = time.monotonic() + timeout
+        header = self.__read(_HEADER.size, deadline)
+        return self.__read(_HEADER.unpack(header)[0], deadline)
+
+    def __read(self, length: int, deadline: float) -> bytes:
+        fd = cast(IO[bytes], self.process.stdout).fileno()
+        chunks: list[bytes] = []
+        while length > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProcessPoolTimeoutException("Job took too long to finish!")
+
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+
+            try:
+                chunk = os.read(fd, min(length, 1024 * 1024))
+            except BlockingIOError:
+                continue
+            if not chunk:
+                raise ProcessPoolCrashedException("Worker exited in the middle of a job!")
+
+            chunks.append(chunk)
+            length -= len(chunk)
+
+        return b"".join(chunks)
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.wait()
+
+    def abandon(self) -> None:
+        # Only closes our copy of the pipes, so the process that started this worker can keep using it.
+        cast(IO[bytes], self.process.stdin).close()
+        cast(IO[bytes], self.process.stdout).close()
+
+
+class ProcessPool:
+    """
+    A bounded pool of long-lived worker processes that CPU heavy jobs are handed off to. Unlike
+    a thread pool, this keeps the work off the GIL entirely, and a job that runs away with the
+    CPU or memory can be killed without taking the server down with it. Each worker runs jobs
+    one at a time and is replaced whenever a job times out or kills it.
+
+    Jobs are plain functions and arguments, so both have to be picklable, which means the
+    function must be defined at module level. Anything a job raises is re-raised to the caller.
+    Modules that jobs live in can be listed in preload so that workers import them up front.
+    """
+
+    def __init__(self, preload: list[str] = []) -> None:
+        self.__preload = list(preload)
+        self.__lock = Lock()
+        self.__size = 0
+        self.__timeout = 0.0
+        self.__memory = 0
+        self.__queue = 0
+        self.__pid = 0
+        self.__slots = BoundedSemaphore(1)
+        self.__idle: list[_Worker] = []
+
+        self.__queued = 0
+        self.__running = 0
+        self.__completed = 0
+        self.__failed = 0
+        self.__timeouts = 0
+        self.__crashes = 0
+        self.__rejected = 0
+        self.__busy_seconds = 0.0
+
+    def configure(self, workers: int, timeout: float, memory: int, queue: int) -> None:
+        """
+        Set how many worker processes can run jobs at once, how many seconds each job can take,
+        how many megabytes each worker can use and how many callers can wait for a free worker.
+        A size of 0 runs every job directly in the calling process, and a memory of 0 leaves
+        workers unlimited.
+        """
+        workers = max(0, workers)
+        timeout = max(0.0, timeout)
+        memory = max(0, memory)
+        queue = max(0, queue)
+
+        with self.__lock:
+            if (
+                (workers, timeout, memory, queue) == (self.__size, self.__timeout, self.__memory, self.__queue) and
+                self.__pid == os.getpid()
+            ):
+                return
+
+            for worker in self.__idle:
+                if self.__pid == os.getpid():
+                    worker.kill()
+                else:
+                    # Workers started before a fork belong to the parent, so leave them alone.
+                    worker.abandon()
+
+            self.__idle = []
+            self.__pid = os.getpid()
+            self.__size = workers
+            self.__timeout = timeout
+            self.__memory = memory
+            self.__queue = queue
+            self.__slots = BoundedSemaphore(max(1, workers))
+
+    def stats(self) -> ProcessPoolStats:
+        with self.__lock:
+            return ProcessPoolStats(
+                self.__size,
+                self.__queued,
+                self.__running,
+                self.__completed,
+                self.__failed,
+                self.__timeouts,
+                self.__crashes,
+                self.__rejected,
+                self.__busy_seconds,
+            )
+
+    def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run a job on a worker process and return its result, re-raising anything it raised.
+        Raises ProcessPoolBusyException if too many callers are already waiting, as well as
+        ProcessPoolTimeoutException or ProcessPoolCrashedException if the job didn't finish.
+        """
+        if not self.__size or self.__pid != os.getpid():
+            # Pools inherited across a fork are reconfigured before their next use, but until
+            # then, just do the work here.
+            return func(*args)
+
+        job = pickle.dumps((func, args))
+        with self.__lock:
+            if self.__queued + self.__running >= self.__size + self.__queue:
+                self.__rejected += 1
+                raise ProcessPoolBusyException("Too many jobs are already waiting on this pool!")
+            self.__queued += 1
+            slots = self.__slots
+
+        with slots:
+            with self.__lock:
+                self.__queued -= 1
+                self.__running += 1
+                worker = self.__idle.pop() if self.__idle else None
+                memory = self.__memory
+                timeout = self.__timeout
+
+            start = time.monotonic()
+            try:
+                if worker is None:
+                    worker = _Worker(memory, self.__preload)
+                success, result = pickle.loads(worker.call(job, timeout or float("inf")))
+            except BaseException as e:
+                if worker is not None:
+                    worker.kill()
+
+                with self.__lock:
+                    self.__running -= 1
+                    self.__busy_seconds += time.monotonic() - start
+                    if isinstance(e, ProcessPoolTimeoutException):
+                        self.__timeouts += 1
+                    else:
+                        self.__crashes += 1
+
+                if isinstance(e, ProcessPoolException):
+                    raise
+                raise ProcessPoolCrashedException(f"Could not talk to worker: {e}") from e
+
+            with self.__lock:
+                self.__running -= 1
+                self.__busy_seconds += time.monotonic() - start
+                if success:
+                    self.__completed += 1
+                else:
+                    self.__failed += 1
+
+                if self.__pid == os.getpid() and len(self.__idle) < self.__size:
+                    self.__idle.append(worker)
+                    worker = None
+
+            if worker is not None:
+                # We were reconfigured while this job ran, so this worker isn't wanted any more.
+                worker.kill()
+
+        if not success:
+            raise cast(BaseException, result)
+        return cast(T, result)
+
+
+def _serve(stdin: IO[bytes], stdout: IO[bytes]) -> None:
+    stdout.write(_HEADER.pack(0))
+    stdout.flush()
+
+    while True:
+        header = stdin.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            # Our parent went away, so there will be no more jobs.
+            return
+
+        func, args = pickle.loads(stdin.read(_HEADER.unpack(header)[0]))
+        try:
+            response = pickle.dumps((True, func(*args)))
+        except Exception as e:
+            try:
+                response = pickle.dumps((False, e))
+            except Exception:
+                # Not everything a library raises can be pickled, so fall back to the message.
+                response = pickle.dumps((False, Exception(str(e))))
+
+        stdout.write(_HEADER.pack(len(response)) + response)
+        stdout.flush()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Worker process for a ProcessPool, not meant to be run by hand.")
+    parser.add_argument("-m", "--memory", help="Megabytes of memory this worker can use, or 0 for unlimited.", type=int, default=0)
+    parser.add_argument("preload", help="Modules to import before taking any jobs.", nargs="*")
+    args = parser.parse_args()
+
+    if args.memory:
+        limit = args.memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    for module in args.preload:
+        importlib.import_module(module)
+
+    # Jobs are free to print whatever they like, but it must not end up in the middle of a response.
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    _serve(sys.stdin.buffer, stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,22 @@ class Database:
     def password(self) -> str:
         return str(self._config.get("database", {}).get("password") or "critterchat")
 
+    @property
+    def lastseen_flush_ms(self) -> int:
+        # Specifically allow 0 so operators can write read state out on every message pump tick.
+        lastseen_flush_ms = self._config.get("database", {}).get("lastseen_flush_ms")
+        if lastseen_flush_ms is None:
+            lastseen_flush_ms = 1000
+        return max(0, int(lastseen_flush_ms))
+
+    @property
+    def query_threads(self) -> int:
+        # Off by default until running queries on pool threads has been proven out against MySQL.
+        query_threads = self._config.get("database", {}).get("query_threads")
+        if query_threads is None:
+            query_threads = 0
+        return max(0, int(query_threads))
+
     @property
     def engine(self) -> Engine:
         engine = self._config.get("database", {}).get("engine")
@@ -88,6 +104,19 @@ class Attachments:
         # We specifically allow an empty list here, so admins can turn off binary attachments.
         return listvals
 
+    @property
+    def thumbnail_format(self) -> str:
+        thumbnail_format = str(self._config.get("attachments", {}).get("thumbnail_format") or "webp").lower()
+        return thumbnail_format if thumbnail_format in {"png", "webp"} else "webp"
+
+    @property
+    def thumbnail_heights(self) -> list[int]:
+        vals = self._config.get("attachments", {}).get("thumbnail_heights")
+        if not isinstance(vals, list) or not vals:
+            return [100, 300]
+
+        return sorted({max(1, int(v)) for v in vals})
+
 
 class Limits:
     def __init__(self, parent_config: "Config") -> None:
@@ -117,6 +146,10 @@ class Limits:
     def attachment_size(self) -> int:
         return int(self._config.get("limits", {}).get("attachment_size") or 2048)
 
+    @property
+    def history_length(self) -> int:
+        return int(self._config.get("limits", {}).get("history_length") or 100)
+
     @property
     def attachment_max(self) -> int:
         # Specifically allow 0 as an attachment_max so operators can disable attachments.
@@ -157,6 +190,36 @@ class Authentication:
     def local(self) -> bool:
         return _bool(self._config.get("authentication", {}).get("local"), True)
 
+    @property
+    def password_rounds(self) -> int | None:
+        # Leave this unset to use whatever the hashing library recommends.
+        rounds = self._config.get("authentication", {}).get("password_rounds")
+        return max(1, int(rounds)) if rounds else None
+
+    @property
+    def password_threads(self) -> int:
+        # Specifically allow 0 so operators can hash passwords directly on the calling greenlet.
+        password_threads = self._config.get("authentication", {}).get("password_threads")
+        if password_threads is None:
+            password_threads = 2
+        return max(0, int(password_threads))
+
+    @property
+    def password_queue(self) -> int:
+        # Specifically allow 0 so operators can refuse logins whenever every thread is busy.
+        password_queue = self._config.get("authentication", {}).get("password_queue")
+        if password_queue is None:
+            password_queue = 16
+        return max(0, int(password_queue))
+
+    @property
+    def session_revalidate(self) -> int:
+        # Specifically allow 0 so operators can check sessions on every request.
+        session_revalidate = self._config.get("authentication", {}).get("session_revalidate")
+        if session_revalidate is None:
+            session_revalidate = 60
+        return max(0, int(session_revalidate))
+
     @property
     def mastodon(self) -> list[MastodonConfig]:
         instances = self._config.get("authentication", {}).get("mastodon", [])
@@ -212,6 +275,90 @@ class Reactions:
         return listvals
 
 
+class Cluster:
+    def __init__(self, parent_config: "Config") -> None:
+        self._config = parent_config
+
+    @property
+    def workers(self) -> int:
+        return max(1, int(self._config.get("cluster", {}).get("workers") or 1))
+
+    @property
+    def message_queue(self) -> str | None:
+        message_queue = self._config.get("cluster", {}).get("message_queue")
+        return str(message_queue) if message_queue else None
+
+    @property
+    def channel(self) -> str:
+        return str(self._config.get("cluster", {}).get("channel") or "critterchat")
+
+
+class Cache:
+    def __init__(self, parent_config: "Config") -> None:
+        self._config = parent_config
+
+    @property
+    def occupants(self) -> int:
+        # Specifically allow 0 so operators can turn the cache off.
+        occupants = self._config.get("cache", {}).get("occupants")
+        if occupants is None:
+            occupants = 10000
+        return max(0, int(occupants))
+
+    @property
+    def users(self) -> int:
+        # Specifically allow 0 so operators can turn the cache off.
+        users = self._config.get("cache", {}).get("users")
+        if users is None:
+            users = 10000
+        return max(0, int(users))
+
+    @property
+    def ttl(self) -> int:
+        # Specifically allow 0 so operators can turn the cache off.
+        ttl = self._config.get("cache", {}).get("ttl")
+        if ttl is None:
+            ttl = 60
+        return max(0, int(ttl))
+
+
+class Media:
+    def __init__(self, parent_config: "Config") -> None:
+        self._config = parent_config
+
+    @property
+    def workers(self) -> int:
+        # Specifically allow 0 so operators can process uploads directly on the calling greenlet.
+        workers = self._config.get("media", {}).get("workers")
+        if workers is None:
+            workers = 2
+        return max(0, int(workers))
+
+    @property
+    def timeout(self) -> int:
+        return max(1, int(self._config.get("media", {}).get("timeout") or 30))
+
+    @property
+    def memory(self) -> int:
+        # Specifically allow 0 so operators can let workers use as much memory as they need.
+        memory = self._config.get("media", {}).get("memory")
+        if memory is None:
+            memory = 1024
+        return max(0, int(memory))
+
+    @property
+    def max_megapixels(self) -> int:
+        return max(1, int(self._config.get("media", {}).get("max_megapixels") or 64))
+
+    @property
+    def queue(self) -> int:
+        # Specifically allow 0 so operators can refuse uploads whenever every worker is busy.
+        queue = self._config.get("media", {}).get("queue")
+        if queue is None:
+            queue = 8
+        return max(0, int(queue))
+
+
 class Config(dict[str, Any]):
     def __init__(self, existing_contents: dict[str, Any] = {}, filename: str | None = None) -> None:
         super().__init__(existing_contents or {})
@@ -226,6 +373,9 @@ class Config(dict[str, Any]):
         self.account_registration = AccountRegistration(self)
         self.authentication = Authentication(self)
         self.reactions = Reactions(self)
+        self.cluster = Cluster(self)
+        self.cache = Cache(self)
+        self.media = Media(self)
 
     def clone(self) -> "Config":
         # Somehow its not possible to clone this object if an instantiated Engine is present,
@@ -1,5 +1,9 @@
 from .base import ConnectionLike
+from .cache import CacheStats, invalidate_changes, occupantcache, usercache
 from .data import Data, RequestCache, DBCreateException
+from .lastseen import LastSeenBuffer, lastseenbuffer
+from .notify import Change, ChangeType, changebus
+from .pool import PoolBusyException, hashpool, querypool
 from .types import (
     Action,
     ActionType,
@@ -49,6 +53,18 @@ __all__ = [
     "Data",
     "DBCreateException",
     "RequestCache",
+    "Change",
+    "ChangeType",
+    "changebus",
+    "CacheStats",
+    "invalidate_changes",
+    "occupantcache",
+    "usercache",
+    "LastSeenBuffer",
+    "lastseenbuffer",
+    "PoolBusyException",
+    "hashpool",
+    "querypool",
     "NewActionID",
     "NewAttachmentID",
     "NewMastodonInstanceID",
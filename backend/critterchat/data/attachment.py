@@ -1,9 +1,8 @@
-import contextlib
 import json
 from sqlalchemy import MetaData, Table, Column
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.types import String, Integer, JSON
-from typing import Iterable, Iterator
+from typing import Iterable
 
 from .base import BaseData, statement
 from .types import MetadataType, ActionID, AttachmentID, NewActionID, NewAttachmentID, UserID, NewUserID
@@ -422,24 +421,6 @@ class AttachmentData(BaseData):
         """
         self.execute(sql, {"userid": userid, "type": notificationtype})
 
-    @contextlib.contextmanager
-    def lock_action_attachments(self) -> Iterator[None]:
-        """
-        Locks the action attachments table for exclusive write, when needing to attach data to a new
-        attachment without other clients polling incomplete actions. Use in a with block.
-        """
-        if self.config.database.backend == "mysql":
-            self.execute("LOCK TABLES attachment WRITE, action_attachment WRITE")
-            try:
-                yield
-            finally:
-                self.execute("UNLOCK TABLES")
-        elif self.config.database.backend == "sqlite":
-            with self.transaction():
-                yield
-        else:
-            raise NotImplementedError(f"Unsupported database backend {self.config.database.backend}")
-
     def get_action_attachments(self, actionid: ActionID | Iterable[ActionID]) -> dict[ActionID, list[ActionAttachment]]:
         """
         Look up all action attachments for a given action or actions in the system.
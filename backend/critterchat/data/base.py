@@ -1,7 +1,9 @@
 import json
 import random
 from contextlib import contextmanager
+from threading import Lock
 from typing import Any, Iterator, Protocol, cast
+from weakref import WeakKeyDictionary
 
 from sqlfragments import Statement, Fragment, statement, fragment
 
@@ -10,7 +12,11 @@ from sqlalchemy.engine.cursor import CursorResult
 from sqlalchemy.sql import text
 from sqlalchemy.sql.expression import TextClause
 
+from ..common import Time
 from ..config import Config
+from .cache import invalidate_changes
+from .notify import Change, changebus
+from .pool import querypool
 
 
 __all__ = [
@@ -50,6 +56,22 @@ class _BytesEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class _TransactionState:
+    """
+    Transaction bookkeeping for a single connection. Every BaseData object built on the same
+    connection shares one of these, so that writing through one of them while another has a
+    transaction open nests inside that transaction instead of committing it out from under it.
+    """
+
+    def __init__(self) -> None:
+        self.depth: list[int] = []
+        self.pending: list[Change] = []
+
+
+_transactions: "WeakKeyDictionary[ConnectionLike, _TransactionState]" = WeakKeyDictionary()
+_transactions_lock = Lock()
+
+
 class BaseData:
     def __init__(self, config: Config, connection: ConnectionLike) -> None:
         """
@@ -63,7 +85,12 @@ class BaseData:
         """
         self.__config = config
         self.__connection = connection
-        self.__depth: list[int] = []
+        with _transactions_lock:
+            state = _transactions.get(connection)
+            if state is None:
+                state = _TransactionState()
+                _transactions[connection] = state
+        self.__state = state
 
     @property
     def config(self) -> Config:
@@ -114,27 +141,81 @@ class BaseData:
 
         raise NotImplementedError(f"Unsupported database backend {self.__config.database.backend}")
 
+    def upsert_value(self, column: str) -> Fragment:
+        """
+        Returns a fragment referring to the value that an upsert tried to insert for the given
+        column, for use on the update side of a multi-row upsert.
+        """
+        if self.__config.database.backend == "mysql":
+            return fragment("VALUES(%column)", column)
+        if self.__config.database.backend == "sqlite":
+            return fragment("excluded.%column", column)
+
+        raise NotImplementedError(f"Unsupported database backend {self.__config.database.backend}")
+
     @contextmanager
     def transaction(self) -> Iterator[None]:
         with self.__connection.begin_nested() as txn:
             nonce = random.randint(0, 2 ** 31)
-            self.__depth.append(nonce)
+            self.__state.depth.append(nonce)
+            pending = len(self.__state.pending)
 
             try:
                 yield
 
             except Exception:
                 txn.rollback()
+                # Nothing recorded at this level will ever be committed, so nobody should hear about it.
+                # Anything recorded by outer levels before we started is still on its way.
+                del self.__state.pending[pending:]
                 raise
 
             finally:
-                newnonce = self.__depth.pop()
+                newnonce = self.__state.depth.pop()
                 if nonce != newnonce:
                     raise Exception("Logic error, nonce order issue!")
 
         # Only commit if we didn't throw an exception, otherwise let SQLAlchemy rollback.
-        if not self.__depth:
-            self.__connection.commit()
+        if not self.__state.depth:
+            querypool.run(self.__connection.commit)
+            self.__flush_changes()
+
+    @property
+    def uncommitted(self) -> bool:
+        """
+        Whether the current transaction has recorded changes that aren't committed yet. The
+        process-wide caches only drop what changed once the transaction commits, so anything
+        read through them should come straight from the DB while this is set.
+        """
+        return bool(self.__state.pending)
+
+    def notify(self, change: Change) -> None:
+        """
+        Record a change in the change log and announce it to any in-process listeners such
+        as the message pump. The log entry is written as part of any current transaction, and
+        listeners are only told about the change once that transaction commits so that they
+        never wake up before the data is visible to them. The same goes for dropping anything
+        the change touched from the process-wide caches, since a reader that refilled them before
+        the commit would otherwise put the old data right back.
+
+        Parameters:
+            change - The change that was just written.
+        """
+        self.execute(
+            "INSERT INTO changelog (`type`, `room_id`, `user_id`, `timestamp`) VALUES (:type, :roomid, :userid, :ts)",
+            {"type": change.type, "roomid": change.roomid, "userid": change.userid, "ts": Time.now()},
+        )
+
+        self.__state.pending.append(change)
+        if not self.__state.depth:
+            self.__flush_changes()
+
+    def __flush_changes(self) -> None:
+        if self.__state.pending:
+            changes = self.__state.pending
+            self.__state.pending = []
+            invalidate_changes(changes)
+            changebus.publish(changes)
 
     def execute(self, sql: Statement | str, params: dict[str, object] | None = None) -> CursorResult[Any]:
         """
@@ -151,17 +232,19 @@ class BaseData:
                 raise ValueError("Logic error, cannot provide Statement and params!")
 
             actual, params = sql.to_sqlalchemy()
-            result = self.__connection.execute(
-                text(actual),
-                params or {},
-            )
         else:
+            actual = sql
+
+        def run() -> CursorResult[Any]:
             result = self.__connection.execute(
-                text(sql),
+                text(actual),
                 params or {},
             )
 
-        if not self.__depth:
-            self.__connection.commit()
+            if not self.__state.depth:
+                self.__connection.commit()
+
+            return result
 
-        return result
+        # Drivers block whichever thread they run on, so keep that thread off the gevent hub.
+        return querypool.run(run)
@@ -0,0 +1,214 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Final, Generic, Hashable, Iterable, TypeVar
+
+from .notify import Change, ChangeType
+from .types import InviteID, Occupant, OccupantID, RoomID, User, UserID
+
+
+__all__ = [
+    "CacheStats",
+    "LRUCache",
+    "OccupantCache",
+    "invalidate_changes",
+    "occupantcache",
+    "usercache",
+]
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CacheStats:
+    def __init__(self, size: int, hits: int, misses: int) -> None:
+        self.size: Final[int] = size
+        self.hits: Final[int] = hits
+        self.misses: Final[int] = misses
+
+    def __repr__(self) -> str:
+        return f"CacheStats(size={self.size}, hits={self.hits}, misses={self.misses})"
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A bounded, thread-safe cache that is shared by every request in the process. Entries are
+    evicted least recently used first once the cache is full, and expire after a time to live
+    so that changes made by other processes are eventually picked up.
+
+    Every invalidation bumps a generation counter. Callers that read from the DB on a miss grab
+    the generation before reading and hand it back when storing the result, so that a result
+    read before an invalidation can never be stored after it.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.__size = 0
+        self.__ttl = 0.0
+        self.__generation = 0
+        self.__hits = 0
+        self.__misses = 0
+
+    def configure(self, size: int, ttl: float) -> None:
+        """
+        Set the maximum number of entries and how many seconds each one lives for. A size
+        of 0 disables the cache entirely.
+        """
+        with self.__lock:
+            self.__size = max(0, size)
+            self.__ttl = max(0.0, ttl)
+            self.__trim()
+
+    @property
+    def generation(self) -> int:
+        return self.__generation
+
+    def get(self, key: K) -> V | None:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None
+
+            if entry[0] < time.monotonic():
+                del self.__entries[key]
+                self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+
+    def put(self, key: K, value: V, generation: int) -> None:
+        with self.__lock:
+            if not self.__size or not self.__ttl or generation != self.__generation:
+                return
+
+            self.__entries[key] = (time.monotonic() + self.__ttl, value)
+            self.__entries.move_to_end(key)
+            self.__trim()
+
+    def discard(self, keys: Iterable[K]) -> None:
+        with self.__lock:
+            self.__generation += 1
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def discard_if(self, predicate: Callable[[K, V], bool]) -> None:
+        with self.__lock:
+            self.__generation += 1
+            for key in [k for k, (_, v) in self.__entries.items() if predicate(k, v)]:
+                del self.__entries[key]
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self.__lock:
+            return CacheStats(len(self.__entries), self.__hits, self.__misses)
+
+    def __trim(self) -> None:
+        while len(self.__entries) > self.__size:
+            self.__entries.popitem(last=False)
+
+
+class OccupantCache:
+    """
+    Occupants as looked up by RoomData, keyed both by occupant ID and by room. Each cached
+    occupant remembers whether it has an invite row at all, since the room occupant filters
+    care about that even when the invite was revoked. Room lists only hold occupant IDs, so
+    dropping a single occupant also makes every room list it appears in a miss.
+
+    Everything handed out is a copy, so callers are free to modify what they get back.
+    """
+
+    def __init__(self) -> None:
+        self.__occupants: LRUCache[OccupantID, tuple[RoomID, Occupant, bool]] = LRUCache()
+        self.__rooms: LRUCache[RoomID, list[OccupantID]] = LRUCache()
+
+    def configure(self, size: int, ttl: float) -> None:
+        self.__occupants.configure(size, ttl)
+        self.__rooms.configure(size, ttl)
+
+    @property
+    def generation(self) -> tuple[int, int]:
+        return (self.__occupants.generation, self.__rooms.generation)
+
+    def get_occupants(self, occupantids: Iterable[OccupantID]) -> dict[OccupantID, tuple[Occupant, bool]]:
+        found: dict[OccupantID, tuple[Occupant, bool]] = {}
+        for occupantid in occupantids:
+            entry = self.__occupants.get(occupantid)
+            if entry is not None:
+                found[occupantid] = (entry[1].clone(), entry[2])
+        return found
+
+    def put_occupants(self, occupants: Iterable[tuple[RoomID, Occupant, bool]], generation: tuple[int, int]) -> None:
+        for roomid, occupant, invited in occupants:
+            self.__occupants.put(occupant.id, (roomid, occupant.clone(), invited), generation[0])
+
+    def get_room(self, roomid: RoomID) -> list[tuple[Occupant, bool]] | None:
+        occupantids = self.__rooms.get(roomid)
+        if occupantids is None:
+            return None
+
+        found = self.get_occupants(occupantids)
+        if len(found) != len(occupantids):
+            # Somebody in this room was dropped, so the list as a whole can't be trusted.
+            return None
+        return [found[o] for o in occupantids]
+
+    def put_room(self, roomid: RoomID, occupants: list[tuple[Occupant, bool]], generation: tuple[int, int]) -> None:
+        self.put_occupants([(roomid, o, i) for o, i in occupants], generation)
+        self.__rooms.put(roomid, [o.id for o, _ in occupants], generation[1])
+
+    def invalidate_room(self, roomid: RoomID) -> None:
+        self.__rooms.discard([roomid])
+        self.__occupants.discard_if(lambda _, entry: entry[0] == roomid)
+
+    def invalidate_user(self, userid: UserID) -> None:
+        self.__occupants.discard_if(lambda _, entry: entry[1].userid == userid)
+
+    def invalidate_invite(self, inviteid: InviteID) -> None:
+        self.__occupants.discard_if(lambda _, entry: entry[1].invite is not None and entry[1].invite.id == inviteid)
+
+    def invalidate_changes(self, changes: Iterable[Change]) -> None:
+        """
+        Drop anything touched by the given changes, whether we just committed them ourselves or
+        read them from the change log after another process did.
+        """
+        for change in changes:
+            if change.type == ChangeType.OCCUPANT or (change.type == ChangeType.INVITE and change.roomid is not None):
+                if change.roomid is not None:
+                    self.invalidate_room(change.roomid)
+                elif change.userid is not None:
+                    self.invalidate_user(change.userid)
+            elif change.type == ChangeType.USER and change.userid is not None:
+                self.invalidate_user(change.userid)
+
+    def clear(self) -> None:
+        self.__occupants.clear()
+        self.__rooms.clear()
+
+    def stats(self) -> CacheStats:
+        return self.__occupants.stats()
+
+
+occupantcache: Final[OccupantCache] = OccupantCache()
+usercache: Final[LRUCache[UserID, User]] = LRUCache()
+
+
+def invalidate_changes(changes: list[Change]) -> None:
+    """
+    Drop anything in the process-wide caches touched by the given changes. This is called once
+    a change is committed in this process, and again for changes read from the change log, which
+    is how we find out about changes made by other processes.
+    """
+    occupantcache.invalidate_changes(changes)
+
+    users = {c.userid for c in changes if c.type == ChangeType.USER and c.userid is not None}
+    if users:
+        usercache.discard(users)
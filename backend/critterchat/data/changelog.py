@@ -0,0 +1,82 @@
+from sqlalchemy import MetaData, Table, Column
+from sqlalchemy.types import String, Integer
+
+from .base import BaseData
+from .notify import Change, ChangeType
+from .types import RoomID, UserID
+
+
+def tables(dialect: str, metadata: MetaData) -> None:
+    """
+    Table representing an append-only log of changes that connected clients might care about.
+    Every write that should be relayed to clients appends a row here in the same transaction,
+    so the row's ID acts as a monotonic sequence that the message pump can follow with a cursor.
+    """
+    Table(
+        "changelog",
+        metadata,
+        Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
+        Column("type", String(16), nullable=False),
+        Column("room_id", Integer),
+        Column("user_id", Integer),
+        Column("timestamp", Integer, nullable=False, index=True),
+        mysql_charset="utf8mb4",
+        # Without this, SQLite hands out the IDs of deleted rows again once the log is pruned.
+        sqlite_autoincrement=True,
+    )
+
+
+class ChangeLogData(BaseData):
+    def get_last_change(self) -> int | None:
+        """
+        Returns the sequence ID of the most recent change, or None if nothing has changed yet.
+        """
+
+        cursor = self.execute("SELECT id FROM changelog ORDER BY id DESC LIMIT 1")
+        result = cursor.mappings().fetchone()
+        if not result:
+            return None
+        return int(result['id'])
+
+    def get_changes(self, after: int | None, limit: int = 1000) -> list[tuple[int, Change]]:
+        """
+        Returns up to limit changes after the given sequence ID in sequence order, paired with their
+        sequence ID. If after is None, returns changes from the beginning of the log.
+        """
+
+        sql = """
+            SELECT id, type, room_id, user_id
+            FROM changelog
+            WHERE id > :after
+            ORDER BY id ASC
+            LIMIT :limit
+        """
+        cursor = self.execute(sql, {"after": after if after is not None else 0, "limit": limit})
+        return [
+            (
+                int(result['id']),
+                Change(
+                    ChangeType(result['type']),
+                    roomid=RoomID(result['room_id']) if result['room_id'] is not None else None,
+                    userid=UserID(result['user_id']) if result['user_id'] is not None else None,
+                ),
+            )
+            for result in cursor.mappings()
+        ]
+
+    def prune_changes(self, before: int) -> None:
+        """
+        Removes any changes older than the given timestamp. Nothing reads the log further back
+        than a few seconds, so this keeps the table from growing forever. The newest change is
+        always kept, since some databases restart their ID sequence from whatever is left in the
+        table, and cursors would never see anything again if the sequence went backwards.
+        """
+
+        last = self.get_last_change()
+        if last is None:
+            return
+
+        sql = """
+            DELETE FROM changelog WHERE timestamp < :ts AND id < :last
+        """
+        self.execute(sql, {"ts": before, "last": last})
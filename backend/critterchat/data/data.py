@@ -13,11 +13,15 @@ from sqlfragments import statement
 
 from ..config import Config
 from .base import ConnectionLike
+from .cache import occupantcache, usercache
+from .lastseen import lastseenbuffer
+from .pool import hashpool, querypool
 from .user import UserData, tables as user_tables
 from .room import RoomData, tables as room_tables
 from .attachment import AttachmentData, tables as attachment_tables
 from .migration import MigrationData, tables as migration_tables
 from .mastodon import MastodonData, tables as mastodon_tables
+from .changelog import ChangeLogData, tables as changelog_tables
 from .types import ActionID, RoomID, UserID, Action, Occupant, User
 
 
@@ -46,7 +50,7 @@ def metadata(dialect: str) -> MetaData:
         return __metadata[dialect]
 
     metadata = MetaData()
-    for tables in [user_tables, room_tables, attachment_tables, migration_tables, mastodon_tables]:
+    for tables in [user_tables, room_tables, attachment_tables, migration_tables, mastodon_tables, changelog_tables]:
         tables(dialect, metadata)
 
     __metadata[dialect] = metadata
@@ -78,6 +82,7 @@ class Data:
         self.attachment = AttachmentData(config, self.__connection)
         self.migration = MigrationData(config, self.__connection)
         self.mastodon = MastodonData(config, self.__connection)
+        self.changelog = ChangeLogData(config, self.__connection)
         self.requestcache = RequestCache()
 
     def clone(self) -> "Data":
@@ -94,6 +99,20 @@ class Data:
             connection.execute(text("PRAGMA synchronous = NORMAL;"))
             connection.commit()
 
+    @staticmethod
+    def configure_process(config: Config) -> None:
+        """
+        Size the process-wide caches, pools and buffers from the given config. This should be called
+        once by each process that serves requests, after it has been forked from its parent, since pool
+        threads don't survive a fork. Until then, caching is off, work runs on the calling greenlet and
+        read state is written out on every flush.
+        """
+        occupantcache.configure(config.cache.occupants, config.cache.ttl)
+        lastseenbuffer.configure(config.database.lastseen_flush_ms)
+        usercache.configure(config.cache.users, config.cache.ttl)
+        querypool.configure(config.database.query_threads)
+        hashpool.configure(config.authentication.password_threads, config.authentication.password_queue)
+
     @staticmethod
     def connection(config: Config) -> "Data":
         connection = config.database.engine.connect()
@@ -246,7 +265,7 @@ class Data:
         Commit any pending transactions to the DB.
         """
         if self._valid:
-            self.__connection.commit()
+            querypool.run(self.__connection.commit)
 
     def close(self) -> None:
         """
@@ -0,0 +1,76 @@
+import time
+from threading import Lock
+from typing import Final
+
+from .types import ActionID, NewActionID, RoomID, UserID
+
+
+__all__ = [
+    "LastSeenBuffer",
+    "lastseenbuffer",
+]
+
+
+class LastSeenBuffer:
+    """
+    Read state that clients have reported but which hasn't been written to the DB yet. Clients
+    report this constantly while scrolling and reading, so only the newest action per room is
+    kept and everything is handed out together on the next flush.
+
+    This only lives in the memory of the process that the client is connected to, so anything
+    not yet flushed is lost if the process dies and can't be seen by other processes. Both are
+    bounded by the flush interval.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__pending: dict[UserID, dict[RoomID, ActionID]] = {}
+        self.__interval = 0.0
+        self.__last_flush = 0.0
+
+    def configure(self, flush_ms: int) -> None:
+        """
+        Set how many milliseconds to wait between flushes. An interval of 0 hands everything
+        out on every flush.
+        """
+        with self.__lock:
+            self.__interval = max(0, flush_ms) / 1000
+
+    def mark(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
+        with self.__lock:
+            pending = self.__pending.setdefault(userid, {})
+            if actionid > pending.get(roomid, NewActionID):
+                pending[roomid] = actionid
+
+    def get(self, userid: UserID) -> dict[RoomID, ActionID]:
+        with self.__lock:
+            return dict(self.__pending.get(userid, {}))
+
+    def take(self, *, force: bool = False) -> dict[UserID, dict[RoomID, ActionID]]:
+        """
+        Hand out everything pending and start buffering afresh. Unless forced, this hands out
+        nothing until the flush interval has passed since the last time it handed anything out.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            if not self.__pending:
+                return {}
+            if not force and (now - self.__last_flush) < self.__interval:
+                return {}
+
+            pending = self.__pending
+            self.__pending = {}
+            self.__last_flush = now
+            return pending
+
+    def restore(self, pending: dict[UserID, dict[RoomID, ActionID]]) -> None:
+        """
+        Put back something handed out by take() that couldn't be written, keeping anything newer
+        that came in since.
+        """
+        for userid, rooms in pending.items():
+            for roomid, actionid in rooms.items():
+                self.mark(userid, roomid, actionid)
+
+
+lastseenbuffer: Final[LastSeenBuffer] = LastSeenBuffer()
@@ -0,0 +1,149 @@
+from enum import StrEnum
+from threading import Event, Lock
+from typing import Callable, Final
+
+from .types import RoomID, UserID
+
+
+__all__ = [
+    "Change",
+    "ChangeBus",
+    "ChangeSubscription",
+    "ChangeType",
+    "changebus",
+]
+
+
+class ChangeType(StrEnum):
+    ACTION = "action"
+    USER = "user"
+    PREFERENCES = "preferences"
+    INVITE = "invite"
+    OCCUPANT = "occupant"
+
+
+class Change:
+    """
+    A single notification that something was written to the DB which connected
+    clients might care about. The room and user are filled in when known, so that
+    subscribers can narrow down who needs to be told about the change.
+    """
+
+    def __init__(self, changetype: ChangeType, *, roomid: RoomID | None = None, userid: UserID | None = None) -> None:
+        self.type = changetype
+        self.roomid = roomid
+        self.userid = userid
+
+    def __repr__(self) -> str:
+        return f"Change({self.type}, roomid={self.roomid}, userid={self.userid})"
+
+    def to_dict(self) -> dict[str, object]:
+        return {
+            "type": str(self.type),
+            "roomid": self.roomid,
+            "userid": self.userid,
+        }
+
+    @staticmethod
+    def from_dict(data: dict[str, object]) -> "Change":
+        roomid = data.get("roomid")
+        userid = data.get("userid")
+        return Change(
+            ChangeType(str(data["type"])),
+            roomid=RoomID(int(str(roomid))) if roomid is not None else None,
+            userid=UserID(int(str(userid))) if userid is not None else None,
+        )
+
+
+class ChangeSubscription:
+    """
+    A single subscriber's view of the change bus. Changes published while nobody is
+    waiting are queued up and handed out on the next call to wait().
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__event = Event()
+        self.__changes: list[Change] = []
+
+    def deliver(self, changes: list[Change]) -> None:
+        with self.__lock:
+            self.__changes.extend(changes)
+            self.__event.set()
+
+    def wait(self, timeout: float) -> list[Change]:
+        """
+        Block until at least one change is published or the timeout elapses, whichever
+        comes first. Returns the list of changes seen since the last call, which will be
+        empty if we timed out.
+        """
+        self.__event.wait(timeout)
+
+        with self.__lock:
+            changes = self.__changes
+            self.__changes = []
+            self.__event.clear()
+
+        return changes
+
+
+class ChangeBus:
+    """
+    An in-process publish/subscribe bus for DB changes. Writers publish after their changes
+    are committed and the message pump subscribes so that it can wake up immediately instead
+    of polling the DB. Changes made by other processes only show up here when a forwarder
+    such as the cluster message queue relays them, so subscribers still need to occasionally
+    poll to pick those up.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__subscribers: list[ChangeSubscription] = []
+        self.__forwarders: list[Callable[[list[Change]], None]] = []
+
+    def subscribe(self) -> ChangeSubscription:
+        subscription = ChangeSubscription()
+        with self.__lock:
+            self.__subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: ChangeSubscription) -> None:
+        with self.__lock:
+            if subscription in self.__subscribers:
+                self.__subscribers.remove(subscription)
+
+    def forward(self, forwarder: Callable[[list[Change]], None]) -> None:
+        """
+        Register a callback that is handed every change published locally, so that it can be
+        relayed to other processes.
+        """
+        with self.__lock:
+            self.__forwarders.append(forwarder)
+
+    def unforward(self, forwarder: Callable[[list[Change]], None]) -> None:
+        with self.__lock:
+            if forwarder in self.__forwarders:
+                self.__forwarders.remove(forwarder)
+
+    def publish(self, changes: list[Change], *, relayed: bool = False) -> None:
+        """
+        Publish changes to every subscriber. Changes that were relayed from another process are
+        not forwarded again, so that they don't bounce between processes forever.
+        """
+        if not changes:
+            return
+
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+            forwarders = [] if relayed else list(self.__forwarders)
+
+        for forwarder in forwarders:
+            forwarder(changes)
+
+        # With nobody subscribed, changes are intentionally dropped on the floor so that
+        # processes without a message pump (such as the CLI) don't accumulate them.
+        for subscription in subscribers:
+            subscription.deliver(changes)
+
+
+changebus: Final[ChangeBus] = ChangeBus()
@@ -0,0 +1,95 @@
+import os
+from threading import Lock
+from typing import Callable, Final, TypeVar
+
+from gevent.threadpool import ThreadPool
+
+
+__all__ = [
+    "PoolBusyException",
+    "WorkerPool",
+    "hashpool",
+    "querypool",
+]
+
+
+T = TypeVar("T")
+
+
+class PoolBusyException(Exception):
+    pass
+
+
+class WorkerPool:
+    """
+    A bounded pool of native threads that blocking work is handed off to. Running something
+    that blocks directly on a greenlet holds up every other greenlet in the process until it
+    returns. Running it here instead only holds up the greenlet that asked, and the rest of the
+    process carries on serving sockets.
+
+    Optionally, the number of callers waiting for a free thread can be capped. Callers past that
+    point get a PoolBusyException straight away instead of piling up behind everybody else.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__size = 0
+        self.__queue: int | None = None
+        self.__pid = 0
+        self.__pending = 0
+        self.__pool: ThreadPool | None = None
+
+    def configure(self, threads: int, queue: int | None = None) -> None:
+        """
+        Set how many native threads work can run on at once, and optionally how many callers
+        can wait for one of them. A size of 0 runs everything directly on the calling greenlet.
+        """
+        threads = max(0, threads)
+        with self.__lock:
+            self.__queue = None if queue is None else max(0, queue)
+            if threads == self.__size and self.__pid == os.getpid():
+                return
+
+            if self.__pool is not None:
+                self.__pool.kill()
+            self.__size = threads
+            self.__pid = os.getpid()
+            self.__pool = ThreadPool(threads) if threads else None
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def run(self, func: Callable[[], T]) -> T:
+        """
+        Run a blocking function on the pool and return its result, re-raising anything it
+        raised. Only the calling greenlet waits for it to finish.
+        """
+        pool = self.__pool
+        if pool is None or self.__pid != os.getpid():
+            # Threads don't survive a fork, so a worker that was forked after the pool was made
+            # runs its work directly until it configures its own pool.
+            return func()
+
+        with self.__lock:
+            if self.__queue is not None and self.__pending >= self.__size + self.__queue:
+                raise PoolBusyException("Too much work is already waiting on this pool!")
+            self.__pending += 1
+
+        try:
+            return pool.apply(func)
+        finally:
+            with self.__lock:
+                self.__pending -= 1
+
+
+# Neither the MySQL driver nor SQLite know anything about gevent. Each DB connection is still
+# only ever used by one greenlet at a time, so handing its calls to whichever thread is free is
+# safe. Note that SQLite hands back rows as they are read, so only the work it does before the
+# first row (sorting, grouping and the like) happens off the hub. MySQL reads the whole result
+# before returning, so all of it happens on the pool.
+querypool: Final[WorkerPool] = WorkerPool()
+
+# Password hashing is deliberately slow, and hashlib lets go of the GIL while it works, so this
+# gets real parallelism as well as keeping the hub free.
+hashpool: Final[WorkerPool] = WorkerPool()
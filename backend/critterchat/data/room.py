@@ -1,12 +1,15 @@
 import contextlib
-from typing import Any, Iterable, Iterator
+from typing import Any, Iterable, Iterator, cast
 
 from sqlalchemy import MetaData, Table, Column
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy.types import String, Integer, Boolean, JSON
 
 from ..common import Time
 from .base import BaseData, Fragment, fragment, statement
+from .cache import occupantcache
+from .notify import Change, ChangeType
 from .types import (
     Action,
     ActionType,
@@ -44,6 +47,8 @@ def tables(dialect: str, metadata: MetaData) -> None:
         Column("icon", Integer),
         Column("purpose", String(10), nullable=False),
         Column("last_action", Integer, nullable=False),
+        Column("oldest_action_id", Integer),
+        Column("newest_action_id", Integer),
         mysql_charset="utf8mb4",
     )
 
@@ -62,11 +67,15 @@ def tables(dialect: str, metadata: MetaData) -> None:
         Column("nickname", String(255)),
         Column("icon", Integer),
         UniqueConstraint("user_id", "room_id", name='uidrid'),
+        Index("ix_occupant_user_id_inactive", "user_id", "inactive"),
         mysql_charset="utf8mb4",
     )
 
     """
-    Table representing a chat room's actions taken by occupants.
+    Table representing a chat room's actions taken by occupants. The room ID index already
+    carries the primary key on both SQLite and InnoDB so it serves (room_id, id) range scans,
+    and the composite index lets history and unread queries filter on action type without
+    visiting every row in the room. benchmarks/action_indexes.py measures both.
     """
     Table(
         "action",
@@ -77,6 +86,22 @@ def tables(dialect: str, metadata: MetaData) -> None:
         Column("occupant_id", Integer),
         Column("action", String(32)),
         Column("details", JSON),
+        Index("ix_action_room_id_action_id", "room_id", "action", "id"),
+        mysql_charset="utf8mb4",
+    )
+
+    """
+    Table representing reactions to a message, one row per occupant per reaction. Keeping these
+    out of the action's details means adding or removing a reaction never rewrites the message.
+    """
+    Table(
+        "reaction",
+        metadata,
+        Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
+        Column("action_id", Integer, nullable=False),
+        Column("reaction", String(128), nullable=False),
+        Column("occupant_id", Integer, nullable=False),
+        UniqueConstraint("action_id", "reaction", "occupant_id", name='aidroid'),
         mysql_charset="utf8mb4",
     )
 
@@ -101,49 +126,52 @@ def tables(dialect: str, metadata: MetaData) -> None:
 
 
 class RoomData(BaseData):
-    def _get_oldest_action(self, room_ids: list[RoomID]) -> dict[RoomID, ActionID | None]:
-        if not room_ids:
-            return {}
+    def backfill_action_ids(self) -> None:
+        """
+        Compute the oldest and newest action IDs for every room from scratch. These are kept up
+        to date as actions are inserted, so this only needs to run once for rooms that existed
+        before we started tracking them.
+        """
 
-        cursor = self.execute(statement(
-            """
-                SELECT room_id, MIN(id) AS action_id
-                FROM action
-                WHERE room_id IN (%inlist:ids)
-                GROUP BY room_id
-            """,
-            ids=room_ids,
-        ))
-        retval: dict[RoomID, ActionID | None] = {rid: None for rid in room_ids}
-        for result in cursor.mappings():
-            retval[RoomID(result['room_id'])] = ActionID(result['action_id'])
-        return retval
+        sql = """
+            UPDATE room SET
+                `oldest_action_id` = (SELECT MIN(id) FROM action WHERE action.room_id = room.id),
+                `newest_action_id` = (SELECT MAX(id) FROM action WHERE action.room_id = room.id)
+        """
+        self.execute(sql)
 
-    def _get_newest_action(self, room_ids: list[RoomID]) -> dict[RoomID, ActionID | None]:
-        if not room_ids:
-            return {}
+    def backfill_reactions(self) -> None:
+        """
+        Move reactions that were stored in each message's details into the reaction table, so that
+        messages from before the reaction table existed keep their reactions.
+        """
 
-        cursor = self.execute(statement(
+        last = 0
+        while True:
+            sql = """
+                SELECT id, details FROM action WHERE action = :type AND id > :last ORDER BY id ASC LIMIT 1000
             """
-                SELECT room_id, MAX(id) AS action_id
-                FROM action
-                WHERE room_id IN (%inlist:ids)
-                GROUP BY room_id
-            """,
-            ids=room_ids,
-        ))
-        retval: dict[RoomID, ActionID | None] = {rid: None for rid in room_ids}
-        for result in cursor.mappings():
-            retval[RoomID(result['room_id'])] = ActionID(result['action_id'])
-        return retval
+            cursor = self.execute(sql, {"type": ActionType.MESSAGE, "last": last})
+            results = [r for r in cursor.mappings()]
+            if not results:
+                return
 
-    def _hydrate_actions(self, rooms: list[Room]) -> list[Room]:
-        oldest_actions = self._get_oldest_action([r.id for r in rooms])
-        newest_actions = self._get_newest_action([r.id for r in rooms])
-        for room in rooms:
-            room.oldest_action = oldest_actions.get(room.id)
-            room.newest_action = newest_actions.get(room.id)
-        return rooms
+            with self.transaction():
+                for result in results:
+                    last = result['id']
+                    details = self.deserialize(str(result['details'] or "{}"))
+                    if not details.get("reactions"):
+                        # Nothing to move, and an empty leftover is ignored in favor of the table anyway.
+                        continue
+
+                    reactions = cast(dict[str, list[OccupantID]], details.pop("reactions", {}) or {})
+                    ordering = cast(list[str], details.pop("reactions_order", []) or [])
+                    for reaction in [*ordering, *[r for r in reactions if r not in ordering]]:
+                        for occupantid in reactions.get(reaction, []):
+                            self.add_reaction(ActionID(result['id']), reaction, OccupantID(occupantid))
+
+                    sql = "UPDATE action SET details = :details WHERE id = :id"
+                    self.execute(sql, {"id": result['id'], "details": self.serialize(details)})
 
     def _get_purpose(self, purpose: str) -> RoomPurpose:
         if purpose == RoomPurpose.ROOM:
@@ -174,13 +202,13 @@ class RoomData(BaseData):
 
         cursor = self.execute(statement(
             """
-                SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action
+                SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action, oldest_action_id, newest_action_id
                 FROM room
                 WHERE id in (SELECT room_id FROM occupant WHERE %andlist)
             """,
             filters,
         ))
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -189,11 +217,13 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_left_rooms(self, userid: UserID) -> list[Room]:
         """
@@ -209,12 +239,12 @@ class RoomData(BaseData):
             return []
 
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action FROM room WHERE id in (
+            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action, oldest_action_id, newest_action_id FROM room WHERE id in (
                 SELECT room_id FROM occupant WHERE user_id = :userid AND inactive = TRUE
             )
         """
         cursor = self.execute(sql, {"userid": userid})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -223,11 +253,13 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_joined_room_occupants(self, userid: UserID) -> dict[RoomID, Occupant]:
         """
@@ -285,7 +317,7 @@ class RoomData(BaseData):
             return []
 
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action FROM room WHERE id in (
+            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action, oldest_action_id, newest_action_id FROM room WHERE id in (
                 SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
             )
         """
@@ -293,7 +325,7 @@ class RoomData(BaseData):
             sql += " AND (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
 
         cursor = self.execute(sql, {"userid": userid, "name": f"%{name}%"})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -302,11 +334,13 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_public_rooms(self, name: str | None = None) -> list[Room]:
         """
@@ -321,13 +355,13 @@ class RoomData(BaseData):
             list of Room objects representing the public rooms on the network
         """
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action FROM room WHERE purpose = :purpose
+            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action, oldest_action_id, newest_action_id FROM room WHERE purpose = :purpose
         """
         if name is not None:
             sql += " AND (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
 
         cursor = self.execute(sql, {"name": f"%{name}%", "purpose": RoomPurpose.ROOM})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -336,11 +370,13 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_visible_rooms(self, userid: UserID, name: str | None = None) -> list[Room]:
         """
@@ -361,13 +397,13 @@ class RoomData(BaseData):
             return []
 
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action FROM room WHERE purpose = :purpose
+            SELECT id, name, topic, icon, purpose, moderated, autojoin, last_action, oldest_action_id, newest_action_id FROM room WHERE purpose = :purpose
         """
         if name is not None:
             sql += " AND (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
 
         cursor = self.execute(sql, {"userid": userid, "name": f"%{name}%", "purpose": RoomPurpose.ROOM})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -376,11 +412,13 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_autojoin_rooms(self) -> list[Room]:
         """
@@ -391,14 +429,14 @@ class RoomData(BaseData):
         """
         sql = """
             SELECT
-                id, name, topic, icon, purpose, moderated, autojoin, last_action
+                id, name, topic, icon, purpose, moderated, autojoin, last_action, oldest_action_id, newest_action_id
             FROM room
             WHERE
                 autojoin = TRUE AND purpose = :purpose
         """
 
         cursor = self.execute(sql, {'purpose': RoomPurpose.ROOM})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -407,11 +445,13 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def set_room_autojoin(self, roomid: RoomID, autojoin: bool) -> None:
         """
@@ -447,20 +487,16 @@ class RoomData(BaseData):
         result = cursor.mappings().fetchone()
         if not result:
             return None
-        room_id = RoomID(result['id'])
-        oldest_actions = self._get_oldest_action([room_id])
-        newest_actions = self._get_newest_action([room_id])
-
         return Room(
-            roomid=room_id,
+            roomid=RoomID(result['id']),
             name=result['name'],
             topic=result['topic'],
             purpose=self._get_purpose(str(result['purpose'])),
             moderated=bool(result['moderated']),
             autojoin=bool(result['autojoin']),
             last_action_timestamp=result['last_action'],
-            oldest_action=oldest_actions.get(room_id),
-            newest_action=newest_actions.get(room_id),
+            oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+            newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
             iconid=AttachmentID(result['icon']) if result['icon'] else None,
             deficonid=None,
         )
@@ -548,9 +584,16 @@ class RoomData(BaseData):
             sql = """
                 DELETE FROM invite WHERE room_id = :roomid AND invited_user_id = :userid
             """
-            self.execute(sql, {"userid": userid, "roomid": roomid})
+            cursor = self.execute(sql, {"userid": userid, "roomid": roomid})
+            if cursor.rowcount:
+                self.notify(Change(ChangeType.INVITE, roomid=roomid, userid=userid))
+            self.__occupants_changed(roomid, userid)
 
             if not already_joined:
+                # Start counting unread actions for this user, including anything that happened
+                # since they last saw the room if they're rejoining.
+                self.__reset_unread_count(roomid, userid)
+
                 details: dict[str, object] = {}
                 if inviter:
                     sql = """
@@ -574,6 +617,46 @@ class RoomData(BaseData):
                 )
                 self.insert_action(roomid, action)
 
+    def __reset_unread_count(self, roomid: RoomID, userid: UserID) -> None:
+        sql = "SELECT purpose FROM room WHERE id = :roomid"
+        cursor = self.execute(sql, {"roomid": roomid})
+        result = cursor.mappings().fetchone()
+        if not result:
+            return
+
+        if self._get_purpose(result['purpose']) == RoomPurpose.DIRECT_MESSAGE:
+            types = list(ActionType.unread_dm_types())
+        else:
+            types = list(ActionType.unread_types())
+
+        sql = "SELECT action_id FROM lastseen WHERE user_id = :userid AND room_id = :roomid"
+        cursor = self.execute(sql, {"userid": userid, "roomid": roomid})
+        result = cursor.mappings().fetchone()
+        actionid = int(result['action_id']) if result else 0
+
+        cursor = self.execute(statement(
+            """
+                SELECT COUNT(id) AS count FROM action WHERE `room_id` = %value:roomid AND `id` > %value:actionid AND `action` IN (%inlist:types)
+            """,
+            roomid=roomid,
+            actionid=actionid,
+            types=types,
+        ))
+        result = cursor.mappings().fetchone()
+        count = int(result["count"]) if result else 0
+
+        self.execute(statement(
+            """
+                INSERT INTO unread (`user_id`, `room_id`, `count`)
+                VALUES (%value:userid, %value:roomid, %value:count)
+                %fragment:upsert `count` = %value:count
+            """,
+            upsert=self.upsert_fragment,
+            userid=userid,
+            roomid=roomid,
+            count=count,
+        ))
+
     def shadow_join_room(self, roomid: RoomID, userid: UserID) -> None:
         """
         Given a room to join and a user who wants to join, try shadow joining that room. That just
@@ -602,6 +685,7 @@ class RoomData(BaseData):
                     INSERT INTO occupant (`user_id`, `room_id`, `inactive`) VALUES (:userid, :roomid, TRUE)
                 """
                 self.execute(sql, {"userid": userid, "roomid": roomid})
+                self.__occupants_changed(roomid, userid)
 
     def leave_room(self, roomid: RoomID, userid: UserID, *, remover: UserID | None = None) -> None:
         """
@@ -643,6 +727,15 @@ class RoomData(BaseData):
             UPDATE occupant SET inactive = TRUE WHERE `user_id` = :userid AND `room_id` = :roomid
         """
         self.execute(sql, {"userid": userid, "roomid": roomid})
+        self.__occupants_changed(roomid, userid)
+
+        # Rooms that were never seen only count as unread while we're in them.
+        sql = """
+            DELETE FROM unread WHERE `user_id` = :userid AND `room_id` = :roomid AND `room_id` NOT IN (
+                SELECT room_id FROM lastseen WHERE `user_id` = :userid
+            )
+        """
+        self.execute(sql, {"userid": userid, "roomid": roomid})
 
     def grant_room_moderator(self, roomid: RoomID, userid: UserID) -> None:
         """
@@ -673,6 +766,7 @@ class RoomData(BaseData):
                 UPDATE occupant SET moderator = TRUE WHERE `user_id` = :userid AND `room_id` = :roomid
             """
             self.execute(sql, {"userid": userid, "roomid": roomid})
+            self.__occupants_changed(roomid, userid)
 
             occupant = Occupant(
                 occupantid=NewOccupantID,
@@ -716,6 +810,7 @@ class RoomData(BaseData):
                 UPDATE occupant SET moderator = FALSE WHERE `user_id` = :userid AND `room_id` = :roomid
             """
             self.execute(sql, {"userid": userid, "roomid": roomid})
+            self.__occupants_changed(roomid, userid)
 
             occupant = Occupant(
                 occupantid=NewOccupantID,
@@ -759,6 +854,7 @@ class RoomData(BaseData):
                 UPDATE occupant SET muted = TRUE WHERE `user_id` = :userid AND `room_id` = :roomid
             """
             self.execute(sql, {"userid": userid, "roomid": roomid})
+            self.__occupants_changed(roomid, userid)
 
             occupant = Occupant(
                 occupantid=NewOccupantID,
@@ -802,6 +898,7 @@ class RoomData(BaseData):
                 UPDATE occupant SET muted = FALSE WHERE `user_id` = :userid AND `room_id` = :roomid
             """
             self.execute(sql, {"userid": userid, "roomid": roomid})
+            self.__occupants_changed(roomid, userid)
 
             occupant = Occupant(
                 occupantid=NewOccupantID,
@@ -853,6 +950,7 @@ class RoomData(BaseData):
                 UPDATE occupant SET nickname = :nickname, icon = :icon WHERE `user_id` = :userid AND `room_id` = :roomid
             """
             self.execute(sql, {"userid": userid, "roomid": roomid, "nickname": nickname, "icon": actual})
+            self.__occupants_changed(roomid, userid)
 
             # Look occupant back up so we can grab the correct nickname and icon ID after change.
             cursor = self.execute(
@@ -921,12 +1019,19 @@ class RoomData(BaseData):
                 userid=userid,
             )
 
-        # Also update any invite timestamps so those users can get the update sent to them.
+        # Also update any invite timestamps and let those users know so they can get the update sent to them.
         sql = """
             UPDATE invite SET timestamp = :ts WHERE room_id = :roomid AND revoked != TRUE
         """
         self.execute(sql, {"roomid": room.id, "ts": Time.now()})
 
+        sql = """
+            SELECT invited_user_id FROM invite WHERE room_id = :roomid AND revoked != TRUE
+        """
+        cursor = self.execute(sql, {"roomid": room.id})
+        for result in cursor.mappings().all():
+            self.notify(Change(ChangeType.INVITE, roomid=room.id, userid=UserID(result['invited_user_id'])))
+
         action = Action(
             actionid=NewActionID,
             timestamp=Time.now(),
@@ -936,6 +1041,11 @@ class RoomData(BaseData):
         )
         self.insert_action(room.id, action)
 
+    def __occupants_changed(self, roomid: RoomID, userid: UserID | None = None) -> None:
+        # Cached copies are dropped once this commits, in this process and every other one that reads
+        # the change log. Until then, our own reads skip the cache so the rest of this transaction sees it.
+        self.notify(Change(ChangeType.OCCUPANT, roomid=roomid, userid=userid))
+
     def __to_occupant(self, result: Any) -> Occupant:
         """
         Given a result set, spawn an occupant for that result.
@@ -1009,22 +1119,120 @@ class RoomData(BaseData):
         if roomid == NewRoomID:
             return []
 
-        if include_left and include_invited:
-            # Including left will end up grabbing invited users as well, so we don't need both of
-            # these filters at once. Turn off invited so just left operates.
-            include_invited = False
+        return self.get_room_occupants_for_rooms([roomid], include_left=include_left, include_invited=include_invited)[roomid]
+
+    def get_room_occupants_for_rooms(
+        self,
+        room_ids: list[RoomID],
+        *,
+        include_left: bool = False,
+        include_invited: bool = False,
+    ) -> dict[RoomID, list[Occupant]]:
+        """
+        Given a list of room IDs, look up all occupants of each of those rooms and their names and
+        avatars at once.
+
+        Parameters:
+            room_ids - The IDs of the rooms that we want occupants for.
 
-        filters: list[Fragment] = [fragment("occupant.room_id = %value", roomid)]
-        if include_invited:
-            filters.append(fragment("(occupant.inactive != TRUE) OR (invite.id IS NOT NULL)"))
-        elif not include_left:
-            filters.append(fragment("occupant.inactive != TRUE"))
+        Returns:
+            A dictionary keyed by room ID, with an entry for every room requested.
+        """
+        room_ids = [r for r in set(room_ids) if r != NewRoomID]
+        if not room_ids:
+            return {}
 
+        # Every occupant of a room is cached, including ones that have left, so that the filters
+        # below can be applied no matter which of them the caller asks for.
+        everyone: dict[RoomID, list[tuple[Occupant, bool]]] = {}
+        missing: list[RoomID] = []
+        for roomid in room_ids:
+            cached = None if self.uncommitted else occupantcache.get_room(roomid)
+            if cached is None:
+                missing.append(roomid)
+            else:
+                everyone[roomid] = cached
+
+        if missing:
+            generation = occupantcache.generation
+            cursor = self.execute(statement(
+                """
+                    SELECT
+                        occupant.id AS id,
+                        occupant.user_id AS user_id,
+                        occupant.room_id AS room_id,
+                        occupant.nickname AS onick,
+                        occupant.inactive AS inactive,
+                        occupant.moderator AS moderator,
+                        occupant.muted AS muted,
+                        occupant.icon AS oicon,
+                        profile.nickname AS pnick,
+                        profile.icon AS picon,
+                        user.username AS unick,
+                        user.permissions AS permissions,
+                        invite.id AS invite_id,
+                        invite.timestamp AS invite_timestamp,
+                        invite.inviter_user_id AS invite_user,
+                        invite.ignored AS invite_ignored,
+                        invite.seen AS invite_seen,
+                        invite.revoked AS invite_revoked
+                    FROM occupant
+                    LEFT JOIN profile ON occupant.user_id = profile.user_id
+                    LEFT JOIN user ON occupant.user_id = user.id
+                    LEFT JOIN invite ON occupant.room_id = invite.room_id AND occupant.user_id = invite.invited_user_id
+                    WHERE occupant.room_id IN (%inlist:room_ids)
+                    ORDER BY occupant.id
+                """,
+                room_ids=missing,
+            ))
+
+            fetched: dict[RoomID, list[tuple[Occupant, bool]]] = {rid: [] for rid in missing}
+            for result in cursor.mappings():
+                fetched[RoomID(result['room_id'])].append((self.__to_occupant(result), result['invite_id'] is not None))
+
+            for roomid, occupants in fetched.items():
+                if not self.uncommitted:
+                    occupantcache.put_room(roomid, occupants, generation)
+                everyone[roomid] = occupants
+
+        # Including left will end up grabbing invited users as well, so we only need to check
+        # invites when we aren't including everybody who left.
+        return {
+            roomid: [
+                occupant for occupant, invited in occupants
+                if include_left or occupant.present or (include_invited and invited)
+            ]
+            for roomid, occupants in everyone.items()
+        }
+
+    def get_room_occupant(self, occupantid: OccupantID) -> Occupant | None:
+        """
+        Given an occupant ID, look up that occupant. Note that this will return occupants
+        that have left, which is necessary for linking names/nicknames in chat history.
+
+        Parameters:
+            occupantid - The ID of the occupant we're curious about.
+        """
+        if occupantid == NewOccupantID:
+            return None
+
+        return self.__get_occupants({occupantid}).get(occupantid)
+
+    def __get_occupants(self, occupantids: set[OccupantID]) -> dict[OccupantID, Occupant]:
+        occupants: dict[OccupantID, Occupant] = {}
+        if not self.uncommitted:
+            occupants = {oid: occupant for oid, (occupant, _) in occupantcache.get_occupants(occupantids).items()}
+        missing = [oid for oid in occupantids if oid not in occupants]
+        if not missing:
+            return occupants
+
+        generation = occupantcache.generation
         cursor = self.execute(statement(
             """
                 SELECT
                     occupant.id AS id,
                     occupant.user_id AS user_id,
+                    occupant.room_id AS room_id,
                     occupant.nickname AS onick,
                     occupant.inactive AS inactive,
                     occupant.moderator AS moderator,
@@ -1044,23 +1252,34 @@ class RoomData(BaseData):
                 LEFT JOIN profile ON occupant.user_id = profile.user_id
                 LEFT JOIN user ON occupant.user_id = user.id
                 LEFT JOIN invite ON occupant.room_id = invite.room_id AND occupant.user_id = invite.invited_user_id
-                WHERE %andlist:filters
+                WHERE occupant.id IN (%inlist:occupantids)
             """,
-            filters=filters,
+            occupantids=missing,
         ))
-        return [self.__to_occupant(o) for o in cursor.mappings()]
 
-    def get_room_occupant(self, occupantid: OccupantID) -> Occupant | None:
-        """
-        Given an occupant ID, look up that occupant. Note that this will return occupants
-        that have left, which is necessary for linking names/nicknames in chat history.
+        fetched = [(RoomID(result['room_id']), self.__to_occupant(result), result['invite_id'] is not None) for result in cursor.mappings()]
+        if not self.uncommitted:
+            occupantcache.put_occupants(fetched, generation)
+        for _, occupant, _ in fetched:
+            occupants[occupant.id] = occupant
+        return occupants
 
-        Parameters:
-            occupantid - The ID of the occupant we're curious about.
+    def get_room_occupant_for_user(self, roomid: RoomID, userid: UserID) -> Occupant | None:
         """
-        if occupantid == NewOccupantID:
+        Given a room and a user, look up that user's occupant in the room without needing to load
+        everyone else in the room. Like get_room_occupant(), this will return occupants that have left.
+        """
+        if roomid == NewRoomID or userid == NewUserID:
             return None
 
+        cached = None if self.uncommitted else occupantcache.get_room(roomid)
+        if cached is not None:
+            for occupant, _ in cached:
+                if occupant.userid == userid:
+                    return occupant
+            return None
+
+        generation = occupantcache.generation
         sql = """
             SELECT
                 occupant.id AS id,
@@ -1084,23 +1303,17 @@ class RoomData(BaseData):
             LEFT JOIN profile ON occupant.user_id = profile.user_id
             LEFT JOIN user ON occupant.user_id = user.id
             LEFT JOIN invite ON occupant.room_id = invite.room_id AND occupant.user_id = invite.invited_user_id
-            WHERE occupant.id = :occupantid
+            WHERE occupant.room_id = :roomid AND occupant.user_id = :userid
         """
-        cursor = self.execute(sql, {"occupantid": occupantid})
+        cursor = self.execute(sql, {"roomid": roomid, "userid": userid})
         result = cursor.mappings().fetchone()
-        return self.__to_occupant(result) if result else None
+        if not result:
+            return None
 
-    def get_last_action(self) -> ActionID | None:
-        """
-        Gets the last action that was performed for this entire application.
-        """
-
-        sql = """
-            SELECT id FROM action ORDER BY id DESC LIMIT 1
-        """
-        cursor = self.execute(sql)
-        result = cursor.mappings().fetchone()
-        return ActionID(result['id']) if result else None
+        occupant = self.__to_occupant(result)
+        if not self.uncommitted:
+            occupantcache.put_occupants([(roomid, occupant, result['invite_id'] is not None)], generation)
+        return occupant
 
     def get_room_history(
         self,
@@ -1111,86 +1324,52 @@ class RoomData(BaseData):
         limit: int | None = None,
     ) -> list[Action]:
         """
-        Given a room ID, and possibly a pagination offset, fetch recent room history.
+        Given a room ID, and possibly a pagination offset, fetch recent room history. When only
+        after is given along with a limit, the actions immediately following after are returned
+        rather than the most recent ones.
 
         Parameters:
             before - Optional ActionID that we should fetch actions before.
             after - Optional ActionID that we should fetch actions after.
 
         Returns:
-            list of Action objects representing actions taken in the room.
+            list of Action objects representing actions taken in the room, newest first.
         """
         if roomid == NewRoomID:
             return []
 
         # First, grab all the actions we can.
-        filters: list[Fragment] = [fragment("room_id = %value", roomid)]
-        if before is not None:
-            filters.append(fragment("id < %value", before))
-        if after is not None:
-            filters.append(fragment("id > %value", after))
-        if types is not None:
-            filters.append(fragment("action IN (%inlist)", [str(t) for t in types]))
-
+        filters = self.__history_filters(roomid, before, after, types)
         querylimit: Fragment | None = None
         if limit is not None:
             querylimit = fragment("LIMIT %value", limit)
 
+        # Paging forwards from an anchor walks the index the other way, so the rows closest to
+        # the anchor are the ones that fit under the limit.
+        forwards = after is not None and before is None
         cursor = self.execute(statement(
             """
                 SELECT id, timestamp, occupant_id, action, details
                 FROM action
                 WHERE %andlist:filters
-                ORDER BY id DESC %fragment:limit
+                ORDER BY id %fragment:order %fragment:limit
             """,
             filters=filters,
+            order=fragment("ASC" if forwards else "DESC"),
             limit=querylimit,
         ))
         data = [x for x in cursor.mappings()]
+        if forwards:
+            data.reverse()
 
         if not data:
             return []
 
         # Now, scoop up all of our occupants that we should look up.
-        occupantids = {x['occupant_id'] for x in data if x['occupant_id'] is not None}
-
-        if occupantids:
-            sql = statement(
-                """
-                    SELECT
-                        occupant.id AS id,
-                        occupant.user_id AS user_id,
-                        occupant.nickname AS onick,
-                        occupant.inactive AS inactive,
-                        occupant.moderator AS moderator,
-                        occupant.muted AS muted,
-                        occupant.icon AS oicon,
-                        profile.nickname AS pnick,
-                        profile.icon AS picon,
-                        user.username AS unick,
-                        user.permissions AS permissions,
-                        invite.id AS invite_id,
-                        invite.timestamp AS invite_timestamp,
-                        invite.inviter_user_id AS invite_user,
-                        invite.ignored AS invite_ignored,
-                        invite.seen AS invite_seen,
-                        invite.revoked AS invite_revoked
-                    FROM occupant
-                    LEFT JOIN profile ON occupant.user_id = profile.user_id
-                    LEFT JOIN user ON occupant.user_id = user.id
-                    LEFT JOIN invite ON occupant.room_id = invite.room_id AND occupant.user_id = invite.invited_user_id
-                    WHERE occupant.id IN (%inlist:occupantids)
-                """,
-                occupantids=occupantids,
-            )
-            cursor = self.execute(sql)
-            occupants = [self.__to_occupant(o) for o in cursor.mappings()]
-        else:
-            occupants = []
-        mapping = {oc.id: oc for oc in occupants}
+        mapping = self.__get_occupants({OccupantID(x['occupant_id']) for x in data if x['occupant_id'] is not None})
 
         # Now, combine them all.
-        return [
+        actions = [
             Action(
                 actionid=ActionID(x['id']),
                 timestamp=x['timestamp'],
@@ -1200,26 +1379,64 @@ class RoomData(BaseData):
             )
             for x in data
         ]
+        self.__hydrate_reactions(actions)
+        return actions
+
+    def has_room_history(
+        self,
+        roomid: RoomID,
+        before: ActionID | None = None,
+        after: ActionID | None = None,
+        types: Iterable[ActionType] | None = None,
+    ) -> bool:
+        """
+        Given a room ID and the same filters as get_room_history(), return whether there is at
+        least one action that get_room_history() would return, without fetching any of them.
+        """
+        if roomid == NewRoomID:
+            return False
+
+        cursor = self.execute(statement(
+            "SELECT id FROM action WHERE %andlist:filters LIMIT 1",
+            filters=self.__history_filters(roomid, before, after, types),
+        ))
+        return cursor.mappings().fetchone() is not None
+
+    def __history_filters(
+        self,
+        roomid: RoomID,
+        before: ActionID | None,
+        after: ActionID | None,
+        types: Iterable[ActionType] | None,
+    ) -> list[Fragment]:
+        filters: list[Fragment] = [fragment("room_id = %value", roomid)]
+        if before is not None:
+            filters.append(fragment("id < %value", before))
+        if after is not None:
+            filters.append(fragment("id > %value", after))
+        if types is not None:
+            filters.append(fragment("action IN (%inlist)", [str(t) for t in types]))
+        return filters
 
     @contextlib.contextmanager
-    def lock_actions(self) -> Iterator[None]:
-        """
-        Locks the actions table for exclusive write, when needing to attach data to a new
-        attachment without other clients polling incomplete actions. Use in a with block.
-        """
-        if self.config.database.backend == "mysql":
-            sql = "LOCK TABLES room WRITE, action WRITE, occupant READ, invite READ, profile READ, user READ"
-            self.execute(sql)
-            try:
-                yield
-            finally:
-                sql = "UNLOCK TABLES"
-                self.execute(sql)
-        elif self.config.database.backend == "sqlite":
-            with self.transaction():
-                yield
-        else:
-            raise NotImplementedError(f"Unsupported database backend {self.config.database.backend}")
+    def lock_room(self, roomid: RoomID) -> Iterator[None]:
+        """
+        Locks a single room for exclusive write for the duration of a transaction, when needing to
+        read-modify-write actions or attach data to a new action without other clients polling
+        incomplete actions. Writers in other rooms are not blocked. Use in a with block.
+        """
+        with self.transaction():
+            if self.config.database.backend == "mysql":
+                # Row lock on the room itself, released when the transaction commits. Pollers never
+                # see anything written inside the transaction until then, so they can't observe it
+                # half-done either.
+                sql = "SELECT id FROM room WHERE id = :roomid FOR UPDATE"
+                self.execute(sql, {"roomid": roomid})
+            elif self.config.database.backend != "sqlite":
+                # SQLite only ever allows one writer at a time, so the transaction is enough there.
+                raise NotImplementedError(f"Unsupported database backend {self.config.database.backend}")
+
+            yield
 
     def get_action(self, actionid: ActionID) -> Action | None:
         """
@@ -1243,55 +1460,115 @@ class RoomData(BaseData):
             return None
 
         # Now, scoop up the occupant that goes with this action.
-        occupantid = result['occupant_id']
-        if occupantid:
-            sql = """
-                SELECT
-                    occupant.id AS id,
-                    occupant.user_id AS user_id,
-                    occupant.nickname AS onick,
-                    occupant.inactive AS inactive,
-                    occupant.moderator AS moderator,
-                    occupant.muted AS muted,
-                    occupant.icon AS oicon,
-                    profile.nickname AS pnick,
-                    profile.icon AS picon,
-                    user.username AS unick,
-                    user.permissions AS permissions,
-                    invite.id AS invite_id,
-                    invite.timestamp AS invite_timestamp,
-                    invite.inviter_user_id AS invite_user,
-                    invite.ignored AS invite_ignored,
-                    invite.seen AS invite_seen,
-                    invite.revoked AS invite_revoked
-                FROM occupant
-                LEFT JOIN profile ON occupant.user_id = profile.user_id
-                LEFT JOIN user ON occupant.user_id = user.id
-                LEFT JOIN invite ON occupant.room_id = invite.room_id AND occupant.user_id = invite.invited_user_id
-                WHERE occupant.id = :occupantid
-            """
-            cursor = self.execute(sql, {"occupantid": occupantid})
-            occupants = [self.__to_occupant(o) for o in cursor.mappings()]
-        else:
-            occupants = []
-        mapping = {oc.id: oc for oc in occupants}
+        mapping = self.__get_occupants({OccupantID(result['occupant_id'])} if result['occupant_id'] else set())
 
         # Now, combine them all.
-        return Action(
+        action = Action(
             actionid=ActionID(result['id']),
             timestamp=result['timestamp'],
             occupant=mapping[OccupantID(result['occupant_id'])] if result['occupant_id'] is not None else None,
             action=result['action'],
             details=self.deserialize(str(result['details'] or "{}")),
         )
+        self.__hydrate_reactions([action])
+        return action
+
+    def get_action_room(self, actionid: ActionID) -> tuple[ActionType, RoomID] | None:
+        """
+        Given an action ID, look up just the type of that action and the room it lives in. This is
+        much cheaper than get_action() when we only need to validate something about the action.
+        """
+        if actionid == NewActionID:
+            return None
+
+        sql = "SELECT action, room_id FROM action WHERE id = :actionid"
+        cursor = self.execute(sql, {"actionid": actionid})
+        result = cursor.mappings().fetchone()
+        if not result:
+            return None
+        return ActionType(result['action']), RoomID(result['room_id'])
+
+    def __hydrate_reactions(self, actions: list[Action]) -> None:
+        messages = {a.id: a for a in actions if a.action == ActionType.MESSAGE}
+        if not messages:
+            return
+
+        for actionid, reactions in self.get_reactions(list(messages)).items():
+            if not reactions:
+                continue
+
+            # Reactions are returned in the order they were first used, which is the order clients display them in.
+            messages[actionid].details["reactions"] = reactions
+            messages[actionid].details["reactions_order"] = list(reactions)
+
+    def get_reactions(self, actionids: list[ActionID]) -> dict[ActionID, dict[str, list[OccupantID]]]:
+        """
+        Given a list of action IDs, look up the reactions to each of them. Each action maps to its
+        reactions in the order they were first used, and each reaction maps to the occupants who chose
+        it in the order they chose it.
+        """
+        reactions: dict[ActionID, dict[str, list[OccupantID]]] = {a: {} for a in actionids}
+        if not actionids:
+            return reactions
+
+        cursor = self.execute(statement(
+            """
+                SELECT action_id, reaction, occupant_id FROM reaction WHERE action_id IN (%inlist:actionids) ORDER BY id ASC
+            """,
+            actionids=actionids,
+        ))
+        for result in cursor.mappings():
+            actionid = ActionID(result['action_id'])
+            reactions[actionid].setdefault(result['reaction'], []).append(OccupantID(result['occupant_id']))
+
+        return reactions
+
+    def add_reaction(self, actionid: ActionID, reaction: str, occupantid: OccupantID) -> bool:
+        """
+        Given an action, a reaction and the occupant reacting, record the reaction. Returns True if the
+        reaction was added or False if this occupant already had this reaction on this action.
+        """
+        if actionid == NewActionID or occupantid == NewOccupantID:
+            return False
+
+        try:
+            with self.transaction():
+                sql = """
+                    INSERT INTO reaction (`action_id`, `reaction`, `occupant_id`) VALUES (:actionid, :reaction, :occupantid)
+                """
+                self.execute(sql, {"actionid": actionid, "reaction": reaction, "occupantid": occupantid})
+        except IntegrityError:
+            # Already reacted with this, the unique constraint keeps racing adds from doubling up.
+            return False
+
+        return True
+
+    def remove_reaction(self, actionid: ActionID, reaction: str, occupantid: OccupantID) -> bool:
+        """
+        Given an action, a reaction and the occupant reacting, remove the reaction. Returns True if the
+        reaction was removed or False if this occupant didn't have this reaction on this action.
+        """
+        if actionid == NewActionID or occupantid == NewOccupantID:
+            return False
+
+        sql = """
+            DELETE FROM reaction WHERE `action_id` = :actionid AND `reaction` = :reaction AND `occupant_id` = :occupantid
+        """
+        cursor = self.execute(sql, {"actionid": actionid, "reaction": reaction, "occupantid": occupantid})
+        return bool(cursor.rowcount)
 
-    def insert_action(self, roomid: RoomID, action: Action) -> None:
+    def insert_action(self, roomid: RoomID, action: Action, *, room: Room | None = None) -> None:
         """
         Given a room ID and an action, insert that action into the room's history.
 
         Parameters:
             roomid - ID of the room that the action should go into.
             action - The action itself that should be added.
+            room - The room the action goes into, if the caller has already looked it up.
+
+        If the action's occupant already has an ID, it is assumed to be a fully hydrated occupant
+        that the caller looked up, so it is only checked against the room as part of the insert and
+        isn't looked up again afterwards. Otherwise, the occupant is found from its user ID.
         """
         if roomid == NewRoomID:
             raise ValueError("Logic error, should not try to insert an action to a new room ID!")
@@ -1299,61 +1576,102 @@ class RoomData(BaseData):
         if action.id != NewActionID:
             raise ValueError("Logic error, cannot insert already-persisted action as a new action!")
 
+        if room is not None and room.id != roomid:
+            raise ValueError("Logic error, cannot insert an action with a mismatched room!")
+
+        params: dict[str, object] = {
+            "roomid": roomid, "ts": action.timestamp, "action": action.action, "details": self.serialize(action.details)
+        }
+        hydrate = False
+
         if action.occupant:
             if action.occupant.userid == NewUserID:
                 # Cannot insert an action as a fake user. This should be performed as an action without
                 # an occupant.
                 raise ValueError("Logic error, cannot insert an action with an empty occupant userid!")
 
-            # First, find the occupant ID.
-            sql = "SELECT id FROM occupant WHERE room_id = :roomid AND user_id = :userid AND inactive != TRUE LIMIT 1"
-            cursor = self.execute(sql, {"roomid": roomid, "userid": action.occupant.userid})
-            result = cursor.mappings().fetchone()
-            if not result:
-                # Trying to insert an action and we're not in the room?
-                return
+            occupantid = action.occupant.id
+            if occupantid == NewOccupantID:
+                # First, find the occupant ID.
+                sql = "SELECT id FROM occupant WHERE room_id = :roomid AND user_id = :userid AND inactive != TRUE LIMIT 1"
+                cursor = self.execute(sql, {"roomid": roomid, "userid": action.occupant.userid})
+                result = cursor.mappings().fetchone()
+                if not result:
+                    # Trying to insert an action and we're not in the room?
+                    return
 
-            occupant = result['id']
+                occupantid = OccupantID(result['id'])
+                hydrate = True
 
-            if action.occupant.id != NewOccupantID:
-                if action.occupant.id != OccupantID(occupant):
-                    # Trying to send as an occupant that we're not?
-                    return
+            # Only insert if the occupant is still in the room. For occupants we looked up above this
+            # is always true, but for occupants handed to us it saves a lookup before the insert.
+            sql = """
+                INSERT INTO action
+                    (`room_id`, `timestamp`, `occupant_id`, `action`, `details`)
+                SELECT
+                    :roomid, :ts, id, :action, :details
+                FROM occupant
+                WHERE id = :oid AND room_id = :roomid AND user_id = :userid AND inactive != TRUE
+            """
+            params["oid"] = occupantid
+            params["userid"] = action.occupant.userid
 
         else:
             if action.action not in {ActionType.CHANGE_INFO}:
                 # Cannot insert this action type without an occupant to link to.
                 return
 
-            occupant = None
+            sql = """
+                INSERT INTO action
+                    (`room_id`, `timestamp`, `occupant_id`, `action`, `details`)
+                VALUES
+                    (:roomid, :ts, NULL, :action, :details)
+            """
 
         # Now, figure out the room type for last action calculations.
-        sql = "SELECT purpose FROM room WHERE id = :roomid"
-        cursor = self.execute(sql, {"roomid": roomid})
-        result = cursor.mappings().fetchone()
-        if not result:
-            # Trying to insert an action and the room doesn't exist?
-            return
+        if room is not None:
+            purpose = room.purpose
+        else:
+            cursor = self.execute("SELECT purpose FROM room WHERE id = :roomid", {"roomid": roomid})
+            result = cursor.mappings().fetchone()
+            if not result:
+                # Trying to insert an action and the room doesn't exist?
+                return
 
-        purpose = self._get_purpose(result['purpose'])
+            purpose = self._get_purpose(result['purpose'])
 
         # Now, attempt to insert the action itself.
-        sql = """
-            INSERT INTO action
-                (`room_id`, `timestamp`, `occupant_id`, `action`, `details`)
-            VALUES
-                (:roomid, :ts, :oid, :action, :details)
-        """
-        cursor = self.execute(sql, {
-            "roomid": roomid, "ts": action.timestamp, "oid": occupant, "action": action.action, "details": self.serialize(action.details)
-        })
+        cursor = self.execute(sql, params)
         if cursor.rowcount != 1:
+            # Either the insert failed, or the occupant we were given isn't in this room.
             return
 
         # Hydrate what we've just persisted.
         action.id = ActionID(cursor.lastrowid)
-        if action.occupant and occupant is not None:
-            action.occupant.id = OccupantID(occupant)
+
+        if purpose == RoomPurpose.DIRECT_MESSAGE:
+            types = ActionType.unread_dm_types()
+        else:
+            types = ActionType.unread_types()
+        badging = action.action in types
+
+        # Keep the room's action bounds up to date so that room lookups never need to compute them, and
+        # record the action timestamp into the room if it is an action that causes badging.
+        sql = """
+            UPDATE room SET
+                `oldest_action_id` = COALESCE(`oldest_action_id`, :id),
+                `newest_action_id` = CASE WHEN `newest_action_id` IS NULL OR `newest_action_id` < :id THEN :id ELSE `newest_action_id` END
+        """
+        if badging:
+            sql += """,
+                `last_action` = CASE WHEN `last_action` < :ts THEN :ts ELSE `last_action` END
+            """
+        sql += " WHERE `id` = :roomid"
+        self.execute(sql, {"roomid": roomid, "id": action.id, "ts": action.timestamp})
+        self.notify(Change(ChangeType.ACTION, roomid=roomid, userid=action.occupant.userid if action.occupant else None))
+
+        if action.occupant and hydrate:
+            action.occupant.id = occupantid
 
             # Now, hydrate the occupant itself so the nickname is present on the response.
             newoccupant = self.get_room_occupant(action.occupant.id)
@@ -1366,17 +1684,12 @@ class RoomData(BaseData):
                 action.occupant.invite = newoccupant.invite
                 action.occupant.iconid = newoccupant.iconid
 
-        if purpose == RoomPurpose.DIRECT_MESSAGE:
-            types = ActionType.unread_dm_types()
-        else:
-            types = ActionType.unread_types()
-
-        # Finally, record the action timestamp into the room if it is an action that causes badging.
-        if action.action in types:
+        # Finally, bump the unread count for everyone who is tracking this room.
+        if badging:
             sql = """
-                UPDATE room SET `last_action` = :ts WHERE `id` = :roomid AND `last_action` < :ts
+                UPDATE unread SET `count` = `count` + 1 WHERE `room_id` = :roomid
             """
-            self.execute(sql, {"roomid": roomid, "ts": action.timestamp})
+            self.execute(sql, {"roomid": roomid})
 
     def update_action(self, action: Action) -> None:
         """
@@ -1386,11 +1699,13 @@ class RoomData(BaseData):
             return
 
         # Right now, only the details can be updated. In the future, this should allow updating
-        # the attachment list as well once we support editing messages.
+        # the attachment list as well once we support editing messages. Reactions live in their own
+        # table and are only filled in on fetch, so never write them back into the details.
+        details = {k: v for k, v in action.details.items() if k not in {"reactions", "reactions_order"}}
         sql = """
             UPDATE action SET details = :details WHERE id = :id LIMIT 1
         """
-        self.execute(sql, {"id": action.id, "details": self.serialize(action.details)})
+        self.execute(sql, {"id": action.id, "details": self.serialize(details)})
 
     def grant_room_invite(self, roomid: RoomID, invitedid: UserID, inviterid: UserID) -> None:
         """
@@ -1481,6 +1796,7 @@ class RoomData(BaseData):
                 details={'invited': user_to_occupant[invitedid]},
             )
             self.insert_action(roomid, action)
+            self.notify(Change(ChangeType.INVITE, roomid=roomid, userid=invitedid))
 
     def revoke_room_invite(self, roomid: RoomID, invitedid: UserID, inviterid: UserID) -> None:
         """
@@ -1559,6 +1875,7 @@ class RoomData(BaseData):
                 details={'uninvited': user_to_occupant[invitedid]},
             )
             self.insert_action(roomid, action)
+            self.notify(Change(ChangeType.INVITE, roomid=roomid, userid=invitedid))
 
     def is_invited_to_room(self, roomid: RoomID, invitedid: UserID) -> bool:
         """
@@ -1591,6 +1908,8 @@ class RoomData(BaseData):
                 room.moderated AS moderated,
                 room.autojoin AS autojoin,
                 room.last_action AS last_action,
+                room.oldest_action_id AS oldest_action_id,
+                room.newest_action_id AS newest_action_id,
                 invite.id AS invite_id,
                 invite.ignored AS ignored,
                 invite.seen AS seen,
@@ -1602,7 +1921,6 @@ class RoomData(BaseData):
         """
         cursor = self.execute(sql, {"userid": userid})
 
-        rooms: list[Room] = []
         results: list[Invite] = []
 
         for result in cursor.mappings():
@@ -1614,10 +1932,11 @@ class RoomData(BaseData):
                 moderated=bool(result['moderated']),
                 autojoin=bool(result['autojoin']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['oldest_action_id']) if result['oldest_action_id'] is not None else None,
+                newest_action=ActionID(result['newest_action_id']) if result['newest_action_id'] is not None else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
-            rooms.append(room)
 
             results.append(Invite(
                 inviteid=InviteID(result['invite_id']),
@@ -1628,8 +1947,6 @@ class RoomData(BaseData):
                 userid=UserID(result['inviter']),
             ))
 
-        # This will modify each room in the list so it's safe to do on the collected temporary list.
-        self._hydrate_actions(rooms)
         return results
 
     def acknowledge_room_invite(self, inviteid: InviteID) -> None:
@@ -1642,6 +1959,7 @@ class RoomData(BaseData):
             UPDATE invite SET seen = TRUE, timestamp = :ts WHERE id = :inviteid
         """
         self.execute(sql, {"ts": Time.now(), "inviteid": inviteid})
+        self.__invite_changed(inviteid)
 
     def dismiss_room_invite(self, inviteid: InviteID) -> None:
         """
@@ -1653,55 +1971,14 @@ class RoomData(BaseData):
             UPDATE invite SET ignored = TRUE, seen = TRUE, timestamp = :ts WHERE id = :inviteid
         """
         self.execute(sql, {"ts": Time.now(), "inviteid": inviteid})
+        self.__invite_changed(inviteid)
 
-    def get_last_invite_update(self) -> tuple[int, int] | None:
-        """
-        Returns the timestamp of the last invite update on the instance, or None if there
-        are actually no invites.
-        """
-
-        with self.transaction():
-            last_update: int | None = None
-            cursor = self.execute("SELECT timestamp FROM invite ORDER BY timestamp DESC LIMIT 1")
-            result = cursor.mappings().fetchone()
-            if result:
-                last_update = int(result['timestamp']) if result['timestamp'] else None
-
-            if last_update is None:
-                # Can't possibly have a count, so return nothing.
-                return None
-
-            cursor = self.execute("SELECT COUNT(id) AS count FROM invite")
-            result = cursor.mappings().fetchone()
-            if not result:
-                # Shouldn't be possible, but return nothing since the above query should have returned nothing.
-                return None
-
-            count = int(result['count'])
-
-            return (last_update, count)
-
-    def has_updated_invites(self, userid: UserID, last_checked: int, last_count: int) -> bool:
-        """
-        Given a user ID and a last checked timestamp, return whether there's an updated set of
-        invites for that user ID or not.
-        """
-
+    def __invite_changed(self, inviteid: InviteID) -> None:
+        # Only the invited user's sessions care about this, so say who it was for.
         sql = """
-            SELECT invited_user_id FROM invite WHERE invited_user_id = :userid AND timestamp >= :ts
+            SELECT room_id, invited_user_id FROM invite WHERE id = :inviteid
         """
-        cursor = self.execute(sql, {"userid": userid, "ts": last_checked})
+        cursor = self.execute(sql, {"inviteid": inviteid})
         result = cursor.mappings().fetchone()
         if result:
-            return True
-
-        sql = """
-            SELECT COUNT(id) AS count FROM invite WHERE invited_user_id = :userid
-        """
-        cursor = self.execute(sql, {"userid": userid})
-        result = cursor.mappings().fetchone()
-        if not result:
-            return False
-
-        actual = int(result['count'])
-        return actual != last_count
+            self.notify(Change(ChangeType.INVITE, roomid=RoomID(result['room_id']), userid=UserID(result['invited_user_id'])))
@@ -31,6 +31,9 @@ class Migration(StrEnum):
     IMAGE_DIMENSIONS = "image_dimensions"
     ATTACHMENT_FILENAMES = "attachment_filenames"
     ATTACHMENT_THUMBNAILS = "attachment_thumbnails"
+    UNREAD_COUNTS = "unread_counts"
+    ROOM_ACTION_IDS = "room_action_ids"
+    REACTION_TABLE = "reaction_table"
 
 
 class UserPermission(IntEnum):
@@ -288,6 +291,7 @@ class MetadataType(StrEnum):
     ALT_TEXT = 'alt_text'
     SENSITIVE = 'sensitive'
     ANIMATED = 'animated'
+    THUMBNAILS = 'thumbnails'
 
 
 class Attachment:
@@ -324,7 +328,9 @@ class Attachment:
             # expose private attachments to URI guessing.
             "uri": self.uri,
             "mimetype": self.mimetype,
-            "metadata": self.metadata,
+            # Clients are only ever handed the one preview that suits them, so they don't need to
+            # know about every thumbnail we have.
+            "metadata": {k: v for k, v in self.metadata.items() if k != MetadataType.THUMBNAILS},
         }
 
         if self.preview:
@@ -609,6 +615,7 @@ class Occupant:
             username=self.username,
             nickname=self.nickname,
             iconid=self.iconid,
+            present=self.present,
             inactive=self.inactive,
             moderator=self.moderator,
             muted=self.muted,
@@ -656,6 +663,7 @@ class ActionType(StrEnum):
     CHANGE_PROFILE = 'change_profile'
     CHANGE_USERS = 'change_users'
     CHANGE_MESSAGE = 'change_message'
+    CHANGE_REACTION = 'change_reaction'
     INVITE_USER = 'invite_user'
     UNINVITE_USER = 'uninvite_user'
 
@@ -690,6 +698,7 @@ class ActionType(StrEnum):
             ActionType.CHANGE_PROFILE,
             ActionType.CHANGE_USERS,
             ActionType.CHANGE_MESSAGE,
+            ActionType.CHANGE_REACTION,
             ActionType.INVITE_USER,
             ActionType.UNINVITE_USER,
         }
@@ -756,6 +765,11 @@ class Action:
             details["actionid"] = Action.from_id(cast(ActionID, details["actionid"]))
             return details
 
+        if self.action == ActionType.CHANGE_REACTION:
+            details = {**self.details}
+            details["actionid"] = Action.from_id(cast(ActionID, details["actionid"]))
+            return details
+
         if self.action == ActionType.MESSAGE:
             details = {**self.details}
             reactions = cast(dict[str, list[OccupantID]], details.get("reactions", {}))
@@ -11,6 +11,9 @@ from passlib.hash import pbkdf2_sha512  # type: ignore
 
 from ..common import Time, coerce_enum
 from .base import BaseData
+from .cache import usercache
+from .pool import PoolBusyException, hashpool
+from .notify import Change, ChangeType
 from .types import (
     ActionType,
     RoomPurpose,
@@ -143,6 +146,21 @@ def tables(dialect: str, metadata: MetaData) -> None:
         mysql_charset="utf8mb4",
     )
 
+    """
+    Table representing a user's unread action count for a given room, kept up to date as actions
+    are inserted and as the user marks actions as seen so that badges never need to be counted.
+    """
+    Table(
+        "unread",
+        metadata,
+        Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
+        Column("user_id", Integer, nullable=False),
+        Column("room_id", Integer, nullable=False, index=True),
+        Column("count", Integer, nullable=False),
+        UniqueConstraint("user_id", "room_id", name='uidrid'),
+        mysql_charset="utf8mb4",
+    )
+
 
 class UserData(BaseData):
     SESSION_LENGTH: Final[int] = 32
@@ -154,11 +172,15 @@ class UserData(BaseData):
     SESSION_TYPE_RECOVERY: Final[str] = "recovery"
     SESSION_TYPE_INVITE: Final[str] = "invite"
 
+    def __get_hasher(self) -> Any:
+        rounds = self.config.authentication.password_rounds
+        return pbkdf2_sha512 if rounds is None else pbkdf2_sha512.using(rounds=rounds)
+
     def __verify_password(self, *, passhash: str, salt: str, password: str) -> bool:
         actual_password = f"{self.config.password_key}.{salt}.{password}"
 
         try:
-            return bool(pbkdf2_sha512.verify(actual_password, passhash))
+            return bool(hashpool.run(lambda: pbkdf2_sha512.verify(actual_password, passhash)))
         except (ValueError, TypeError):
             return False
 
@@ -168,10 +190,17 @@ class UserData(BaseData):
             for _ in range(self.PASSWORD_SALT_LENGTH)
         )
         actual_password = f"{self.config.password_key}.{salt}.{password}"
-        passhash = pbkdf2_sha512.hash(actual_password)
+        hasher = self.__get_hasher()
+        passhash = str(hashpool.run(lambda: hasher.hash(actual_password)))
 
         return passhash, salt
 
+    def __needs_rehash(self, *, passhash: str) -> bool:
+        try:
+            return bool(pbkdf2_sha512.from_string(passhash).rounds != self.__get_hasher().default_rounds)
+        except (ValueError, TypeError):
+            return False
+
     def _get_purpose(self, purpose: str) -> RoomPurpose:
         if purpose == RoomPurpose.ROOM:
             return RoomPurpose.ROOM
@@ -203,7 +232,22 @@ class UserData(BaseData):
             # User doesn't exist, but we have a reference?
             return False
 
-        return self.__verify_password(passhash=result["password"], salt=result["salt"], password=password)
+        if not self.__verify_password(passhash=result["password"], salt=result["salt"], password=password):
+            return False
+
+        if self.__needs_rehash(passhash=result["password"]):
+            # The configured cost changed since this password was last hashed. This is the only
+            # time we ever see the password, so take the chance to bring the hash up to date. If
+            # we're too busy to do that right now, it can wait for the next login.
+            try:
+                passhash, salt = self.__compute_password(password=password)
+            except PoolBusyException:
+                return True
+
+            sql = "UPDATE user SET password = :hash, salt = :salt WHERE id = :userid AND password = :oldhash"
+            self.execute(sql, {"hash": passhash, "salt": salt, "userid": userid, "oldhash": result["password"]})
+
+        return True
 
     def update_password(self, userid: UserID, password: str) -> None:
         """
@@ -225,6 +269,7 @@ class UserData(BaseData):
         # Also nuke any active recovery strings for the user.
         sql = "DELETE FROM session WHERE id = :userid AND type = :optype"
         self.execute(sql, {"userid": userid, "optype": self.SESSION_TYPE_RECOVERY})
+        self.notify(Change(ChangeType.USER, userid=userid))
 
     def validate_invite(self, invite: str) -> bool:
         """
@@ -470,6 +515,11 @@ class UserData(BaseData):
         Parameters:
             session - A session string as returned from create_session.
         """
+        # Look up who owns this session so anybody caching it can be told.
+        sql = "SELECT id FROM session WHERE session = :session AND type = :sesstype"
+        cursor = self.execute(sql, {"session": session, "sesstype": self.SESSION_TYPE_LOGIN})
+        result = cursor.mappings().fetchone()
+
         # Remove the session token
         sql = "DELETE FROM session WHERE session = :session AND type = :sesstype"
         self.execute(sql, {"session": session, "sesstype": self.SESSION_TYPE_LOGIN})
@@ -477,6 +527,9 @@ class UserData(BaseData):
         sql = "DELETE FROM settings WHERE session = :session"
         self.execute(sql, {"session": session})
 
+        if result:
+            self.notify(Change(ChangeType.USER, userid=UserID(result['id'])))
+
         # Also weed out any other defunct sessions
         self.__cleanup_sessions()
 
@@ -615,18 +668,6 @@ class UserData(BaseData):
             audio_notifs=notifications,
         )
 
-    def has_updated_preferences(self, userid: UserID, last_checked: int) -> bool:
-        """
-        Given a user ID and a last checked timestamp, return whether there's an updated user object
-        for that user ID or not.
-        """
-
-        sql = """
-            SELECT user_id FROM preferences WHERE user_id = :userid AND timestamp >= :ts
-        """
-        cursor = self.execute(sql, {"userid": userid, "ts": last_checked})
-        return cursor.mappings().fetchone() is not None
-
     def put_preferences(self, preferences: UserPreferences) -> None:
         """
         Write a new preferences blob to the specified user.
@@ -706,6 +747,7 @@ class UserData(BaseData):
             tabbable_chat_elements=preferences.tabbable_chat_elements,
             ts=Time.now()
         ))
+        self.notify(Change(ChangeType.PREFERENCES, userid=preferences.userid))
 
     def __to_user(self, result: Any) -> User:
         """
@@ -737,65 +779,45 @@ class UserData(BaseData):
         if userid == NewUserID:
             return None
 
-        sql = """
-            SELECT user.id AS id, user.username AS uname, user.permissions AS permissions, profile.nickname AS pname, profile.about AS about, profile.icon AS icon
-            FROM user
-            LEFT JOIN profile ON profile.user_id = user.id
-            WHERE user.id = :userid
-        """
-        cursor = self.execute(sql, {"userid": userid})
-        result = cursor.mappings().fetchone()
-        return self.__to_user(result) if result else None
-
-    def has_updated_user(self, userid: UserID, last_checked: int) -> bool:
-        """
-        Given a user ID and a last checked timestamp, return whether there's an updated user object
-        for that user ID or not.
-        """
+        return self.get_users_by_id([userid]).get(userid)
 
-        sql = """
-            SELECT user_id FROM profile WHERE user_id = :userid AND timestamp >= :ts
+    def get_users_by_id(self, userids: list[UserID]) -> dict[UserID, User]:
         """
-        cursor = self.execute(sql, {"userid": userid, "ts": last_checked})
-        if cursor.mappings().fetchone():
-            return True
-
-        sql = """
-            SELECT id FROM user WHERE id = :userid AND timestamp >= :ts
+        Given a list of user IDs, look up all of those users at once. Any user ID that does
+        not exist is left out of the returned dictionary.
         """
-        cursor = self.execute(sql, {"userid": userid, "ts": last_checked})
-        if cursor.mappings().fetchone():
-            return True
-
-        return False
-
-    def get_last_user_update(self) -> int | None:
-        last_update: int | None = None
+        userids = [u for u in set(userids) if u != NewUserID]
+        if not userids:
+            return {}
 
-        cursor = self.execute("SELECT timestamp FROM profile ORDER BY timestamp DESC LIMIT 1")
-        result = cursor.mappings().fetchone()
-        if result:
-            last_update = int(result['timestamp']) if result['timestamp'] else None
-
-        cursor = self.execute("SELECT timestamp FROM user ORDER BY timestamp DESC LIMIT 1")
-        result = cursor.mappings().fetchone()
-        if result:
-            newer_update = int(result['timestamp']) if result['timestamp'] else None
-
-            last_update = newer_update if last_update is None else last_update
-            if last_update is not None and newer_update is not None:
-                last_update = max(last_update, newer_update)
-
-        cursor = self.execute("SELECT timestamp FROM preferences ORDER BY timestamp DESC LIMIT 1")
-        result = cursor.mappings().fetchone()
-        if result:
-            newer_update = int(result['timestamp']) if result['timestamp'] else None
+        # Users are cached for the whole process, so only look up the ones we haven't seen lately.
+        # Everything handed out is a copy, since callers are free to modify what they get back.
+        users: dict[UserID, User] = {}
+        for userid in userids:
+            cached = None if self.uncommitted else usercache.get(userid)
+            if cached is not None:
+                users[userid] = cached.clone()
 
-            last_update = newer_update if last_update is None else last_update
-            if last_update is not None and newer_update is not None:
-                last_update = max(last_update, newer_update)
+        missing = [u for u in userids if u not in users]
+        if not missing:
+            return users
 
-        return last_update
+        generation = usercache.generation
+        cursor = self.execute(statement(
+            """
+                SELECT user.id AS id, user.username AS uname, user.permissions AS permissions, profile.nickname AS pname, profile.about AS about, profile.icon AS icon
+                FROM user
+                LEFT JOIN profile ON profile.user_id = user.id
+                WHERE user.id IN (%inlist:userids)
+            """,
+            userids=missing,
+        ))
+        for result in cursor.mappings():
+            user = self.__to_user(result)
+            if not self.uncommitted:
+                usercache.put(user.id, user.clone(), generation)
+            users[user.id] = user
+        return users
 
     def update_user(self, user: User) -> None:
         """
@@ -849,6 +871,9 @@ class UserData(BaseData):
             ts=now,
         ))
 
+        # Occupants carry the user's profile and permissions, so this drops any we've cached as well.
+        self.notify(Change(ChangeType.USER, userid=user.id))
+
     def get_users(self, *, name: str | None = None) -> list[User]:
         """
         Return a list of all users on the network.
@@ -935,36 +960,169 @@ class UserData(BaseData):
         having been seen by this user for this room.
         """
 
-        if userid == NewUserID or roomid == NewRoomID or actionid == NewActionID:
-            return
+        self.mark_last_seen_many({(userid, roomid): actionid})
 
-        with self.transaction():
-            sql = """
-                SELECT action_id FROM lastseen WHERE user_id = :userid AND room_id = :roomid LIMIT 1
-            """
-            cursor = self.execute(sql, {"userid": userid, "roomid": roomid})
-            result = cursor.mappings().fetchone()
-            if not result:
-                last = ActionID(0)
-            else:
-                last = ActionID(result['action_id'])
+    def mark_last_seen_many(self, seen: dict[tuple[UserID, RoomID], ActionID]) -> None:
+        """
+        Given a mapping of user and room pairs to the action each user has seen in that room,
+        mark all of them as seen at once. Actions older than what was already seen are ignored.
+        """
 
-            if actionid <= last:
-                # Nothing to do, this is older than our newest message.
-                return
+        seen = {
+            (userid, roomid): actionid
+            for (userid, roomid), actionid in seen.items()
+            if userid != NewUserID and roomid != NewRoomID and actionid != NewActionID
+        }
+        if not seen:
+            return
 
+        with self.transaction():
+            rows = [
+                fragment(
+                    ", (%value:userid, %value:roomid, %value:actionid)" if i else "(%value:userid, %value:roomid, %value:actionid)",
+                    userid=userid,
+                    roomid=roomid,
+                    actionid=actionid,
+                )
+                for i, ((userid, roomid), actionid) in enumerate(seen.items())
+            ]
             self.execute(statement(
                 """
                     INSERT INTO lastseen (`user_id`, `room_id`, `action_id`)
-                    VALUES (%value:userid, %value:roomid, %value:actionid)
-                    %fragment:upsert `action_id` = %value:actionid
+                    VALUES %fragmentlist:rows
+                    %fragment:upsert `action_id` = CASE WHEN %fragment:new > `action_id` THEN %fragment:new ELSE `action_id` END
                 """,
                 upsert=self.upsert_fragment,
-                userid=userid,
-                roomid=roomid,
-                actionid=actionid,
+                new=self.upsert_value("action_id"),
+                rows=rows,
             ))
 
+            # Clients almost always mark the newest action as seen, so these counts are nearly always
+            # zero, but count anything newer anyway in case they've fallen behind. This counts against
+            # whatever ended up stored, in case somebody else already marked something newer as seen.
+            # The count and the write are one statement so that an action inserted concurrently can't
+            # commit its own increment in between and then have it overwritten by a stale count.
+            pairs = [
+                fragment(
+                    " OR (lastseen.user_id = %value:userid AND lastseen.room_id = %value:roomid)" if i else
+                    "(lastseen.user_id = %value:userid AND lastseen.room_id = %value:roomid)",
+                    userid=userid,
+                    roomid=roomid,
+                )
+                for i, (userid, roomid) in enumerate(seen)
+            ]
+            self.execute(statement(
+                """
+                    INSERT INTO unread (`user_id`, `room_id`, `count`)
+                    SELECT lastseen.user_id, lastseen.room_id, COUNT(action.id)
+                    FROM lastseen
+                    JOIN room ON room.id = lastseen.room_id
+                    LEFT JOIN action ON action.room_id = lastseen.room_id AND action.id > lastseen.action_id AND (
+                        (room.purpose = %value:dm AND action.action IN (%inlist:dmtypes)) OR
+                        (room.purpose != %value:dm AND action.action IN (%inlist:types))
+                    )
+                    WHERE %fragmentlist:pairs
+                    GROUP BY lastseen.user_id, lastseen.room_id
+                    %fragment:upsert `count` = %fragment:new
+                """,
+                dm=str(RoomPurpose.DIRECT_MESSAGE),
+                dmtypes=[str(t) for t in ActionType.unread_dm_types()],
+                types=[str(t) for t in ActionType.unread_types()],
+                pairs=pairs,
+                upsert=self.upsert_fragment,
+                new=self.upsert_value("count"),
+            ))
+
+    def count_unread_actions_many(self, seen: dict[RoomID, ActionID | None]) -> dict[RoomID, int]:
+        """
+        Given a mapping of rooms to the last action seen in each, count how many newer actions
+        would cause a badge in each room at once. Where the last action seen is None, every action
+        in the room is counted. Rooms that don't exist are counted as having nothing unread.
+        """
+
+        seen = {roomid: actionid for roomid, actionid in seen.items() if roomid != NewRoomID}
+        if not seen:
+            return {}
+
+        after = [
+            fragment(
+                " OR (action.room_id = %value:roomid AND action.id > %value:actionid)" if i else
+                "(action.room_id = %value:roomid AND action.id > %value:actionid)",
+                roomid=roomid,
+                actionid=actionid if actionid is not None else 0,
+            )
+            for i, (roomid, actionid) in enumerate(seen.items())
+        ]
+        cursor = self.execute(statement(
+            """
+                SELECT room.id AS room_id, COUNT(action.id) AS count
+                FROM room
+                LEFT JOIN action ON action.room_id = room.id AND (%fragmentlist:after) AND (
+                    (room.purpose = %value:dm AND action.action IN (%inlist:dmtypes)) OR
+                    (room.purpose != %value:dm AND action.action IN (%inlist:types))
+                )
+                WHERE room.id IN (%inlist:roomids)
+                GROUP BY room.id
+            """,
+            after=after,
+            dm=str(RoomPurpose.DIRECT_MESSAGE),
+            dmtypes=[str(t) for t in ActionType.unread_dm_types()],
+            types=[str(t) for t in ActionType.unread_types()],
+            roomids=list(seen),
+        ))
+
+        counts = {roomid: 0 for roomid in seen}
+        for result in cursor.mappings():
+            counts[RoomID(result['room_id'])] = int(result['count'])
+        return counts
+
+    def __put_unread_count(self, userid: UserID, roomid: RoomID, count: int) -> None:
+        self.execute(statement(
+            """
+                INSERT INTO unread (`user_id`, `room_id`, `count`)
+                VALUES (%value:userid, %value:roomid, %value:count)
+                %fragment:upsert `count` = %value:count
+            """,
+            upsert=self.upsert_fragment,
+            userid=userid,
+            roomid=roomid,
+            count=count,
+        ))
+
+    def rebuild_unread_counts(self, userid: UserID) -> None:
+        """
+        Given a user, recompute their unread counts from scratch for every room they've seen
+        and every room they're currently in. The counts are maintained as actions are inserted
+        and seen, so this is only needed to fill in counts for data that predates that.
+        """
+
+        if userid == NewUserID:
+            return
+
+        with self.transaction():
+            sql = """
+                SELECT room_id, action_id FROM lastseen WHERE user_id = :userid
+            """
+            cursor = self.execute(sql, {"userid": userid})
+            lastseen: dict[RoomID, ActionID | None] = {
+                RoomID(result['room_id']): ActionID(result['action_id']) for result in cursor.mappings()
+            }
+
+            # Make sure if we were joined to a room or a chat while we were completely gone
+            # that we still count the actions for that room or chat as well.
+            sql = """
+                SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
+            """
+            cursor = self.execute(sql, {"userid": userid})
+            for result in cursor.mappings():
+                roomid = RoomID(result['room_id'])
+                if roomid not in lastseen:
+                    lastseen[roomid] = None
+
+            self.execute("DELETE FROM unread WHERE user_id = :userid", {"userid": userid})
+            for roomid, count in self.count_unread_actions_many(lastseen).items():
+                self.__put_unread_count(userid, roomid, count)
+
     def get_last_seen_counts(self, userid: UserID) -> list[tuple[RoomID, int]]:
         """
         Given a user, grab all of the last seen room/action counts.
@@ -974,83 +1132,10 @@ class UserData(BaseData):
             return []
 
         sql = """
-            SELECT lastseen.room_id AS room_id, lastseen.action_id AS action_id, room.purpose AS purpose
-            FROM lastseen
-            JOIN room ON room.id = lastseen.room_id
-            WHERE user_id = :userid
+            SELECT room_id, `count` FROM unread WHERE user_id = :userid
         """
         cursor = self.execute(sql, {"userid": userid})
-        counts = [
-            (RoomID(result['room_id']), ActionID(result['action_id']), self._get_purpose(result['purpose']))
-            for result in cursor.mappings()
-        ]
-
-        def hydrate_existing_count(roomid: RoomID, actionid: ActionID, purpose: RoomPurpose) -> int:
-            if purpose == RoomPurpose.DIRECT_MESSAGE:
-                types = list(ActionType.unread_dm_types())
-            else:
-                types = list(ActionType.unread_types())
-
-            sql = statement(
-                """
-                    SELECT COUNT(id) AS count FROM action WHERE `room_id` = %value:roomid AND `id` > %value:actionid AND `action` IN (%inlist:types)
-                """,
-                roomid=roomid,
-                actionid=actionid,
-                types=types,
-            )
-            cursor = self.execute(sql)
-            result = cursor.mappings().fetchone()
-            return int(result["count"]) if result else 0
-
-        # There's probably a SQL way to do this, but I don't want to bang my head against
-        # it right now, so it can come in a future improvement.
-        computed_counts = [(c[0], hydrate_existing_count(c[0], c[1], c[2])) for c in counts]
-
-        # Now, make sure if we were joined to a room or a chat while we were completely gone
-        # that we still count the actions for that room or chat as well.
-        seen = [c[0] for c in computed_counts]
-        if seen:
-            stmt = statement(
-                """
-                    SELECT id, purpose FROM room WHERE id NOT IN (%inlist:seen) AND id IN (
-                        SELECT room_id FROM occupant WHERE user_id = %value:userid AND inactive != TRUE
-                    )
-                """,
-                seen=seen,
-                userid=userid,
-            )
-        else:
-            stmt = statement(
-                """
-                    SELECT id, purpose FROM room WHERE id IN (
-                        SELECT room_id FROM occupant WHERE user_id = %value:userid AND inactive != TRUE
-                    )
-                """,
-                userid=userid,
-            )
-        cursor = self.execute(stmt)
-        extra_rooms = [(RoomID(result['id']), self._get_purpose(result['purpose'])) for result in cursor.mappings()]
-
-        def hydrate_new_count(roomid: RoomID, purpose: RoomPurpose) -> int:
-            if purpose == RoomPurpose.DIRECT_MESSAGE:
-                types = list(ActionType.unread_dm_types())
-            else:
-                types = list(ActionType.unread_types())
-
-            sql = statement(
-                """
-                    SELECT COUNT(id) AS count FROM action WHERE `room_id` = %value:roomid AND `action` IN (%inlist:types)
-                """,
-                roomid=roomid,
-                types=types,
-            )
-            cursor = self.execute(sql)
-            result = cursor.mappings().fetchone()
-            return int(result["count"]) if result else 0
-
-        computed_counts += [(c[0], hydrate_new_count(c[0], c[1])) for c in extra_rooms]
-        return computed_counts
+        return [(RoomID(result['room_id']), int(result['count'])) for result in cursor.mappings()]
 
     def get_last_seen_actions(self, userid: UserID) -> list[tuple[RoomID, ActionID]]:
         """
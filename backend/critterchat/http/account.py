@@ -25,7 +25,7 @@ from .login import (
     ensure_logged_out_all,
 )
 from ..common import get_aliases_unicode_dict
-from ..data import UserPermission, FaviconID
+from ..data import PoolBusyException, UserPermission, FaviconID
 from ..service import (
     AttachmentService,
     EmoteService,
@@ -112,7 +112,22 @@ def __login(username: str, password: str) -> Response:
             )
         )
 
-    if g.data.user.validate_password(user.id, password):
+    try:
+        valid = g.data.user.validate_password(user.id, password)
+    except PoolBusyException:
+        # Too many logins are being checked at once, so don't make this one wait behind them.
+        error(UserService.BUSY_MESSAGE)
+        return Response(
+            render_template(
+                "account/login.html",
+                title="Log In",
+                username=original_username,
+                mastodon_providers=get_mastodon_providers(),
+                favicon=attachmentservice.get_attachment_url(FaviconID),
+            )
+        )
+
+    if valid:
         return login_user_id(user.id)
     else:
         error("Unrecognized username or password!")
@@ -29,10 +29,10 @@ def get_attachment(attachment: str) -> Response:
 
         # This is a debug endpoint only, not meant for production use. So, it's fine
         # to pull a little shenanigans here.
-        attachmentid, thumb = attachmentservice.id_from_path(attachment)
+        attachmentid, thumb, height = attachmentservice.id_from_path(attachment)
         if attachmentid is not None:
             if thumb:
-                response = attachmentservice.get_thumbnail_data(attachmentid)
+                response = attachmentservice.get_thumbnail_data(attachmentid, height)
             else:
                 response = attachmentservice.get_attachment_data(attachmentid)
 
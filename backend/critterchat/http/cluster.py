@@ -0,0 +1,82 @@
+import logging
+from typing import Any, Final
+
+import socketio as sio  # type: ignore
+
+from ..config import Config
+from ..data import Change, changebus
+
+
+__all__ = [
+    "RELAY_EVENT",
+    "create_client_manager",
+]
+
+
+# Pseudo-event used to relay DB changes between processes. It is never emitted to any
+# actual client, it only ever travels over the message queue.
+RELAY_EVENT: Final[str] = "critterchat:changes"
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeRelay:
+    """
+    Mixin for a Socket.IO pub/sub client manager that also relays DB changes between every
+    process attached to the same message queue. Changes committed in this process are emitted
+    on the queue as a pseudo-event, and changes emitted by other processes are fed into our
+    local change bus so that our message pump wakes up for them just like it does for local writes.
+
+    Receiving relies on overriding _handle_emit(), which isn't public API, so python-socketio is
+    pinned to the exact version in requirements.txt and tests/http/test_cluster.py round-trips
+    changes through the real listener thread to catch any change in behavior when bumping it.
+    """
+
+    host_id: str
+
+    def initialize(self) -> None:
+        super().initialize()  # type: ignore
+        changebus.forward(self.relay)
+
+    def relay(self, changes: list[Change]) -> None:
+        try:
+            self.emit(RELAY_EVENT, [c.to_dict() for c in changes])  # type: ignore
+        except Exception:
+            # Other processes will still pick this up on their fallback poll, so don't fail the write.
+            logger.exception("Failed to relay changes to the message queue!")
+
+    def _handle_emit(self, message: dict[str, Any]) -> None:
+        if message.get('event') == RELAY_EVENT:
+            # Emitting hands the message to ourselves as well, but our own change bus already has it.
+            if message.get('host_id') != self.host_id:
+                data = message.get('data') or [[]]
+                changebus.publish([Change.from_dict(c) for c in data[0]], relayed=True)
+            return
+
+        super()._handle_emit(message)  # type: ignore
+
+
+def _manager_class(url: str) -> Any:
+    # Mirrors the way Flask-SocketIO picks a client manager for a message queue URL.
+    if url.startswith(("redis://", "rediss://")):
+        return sio.RedisManager
+    if url.startswith("kafka://"):
+        return sio.KafkaManager
+    if url.startswith("zmq"):
+        return sio.ZmqManager
+    return sio.KombuManager
+
+
+def create_client_manager(config: Config) -> Any | None:
+    """
+    Given a config, create a Socket.IO client manager for the configured message queue, or
+    return None if we aren't running as part of a cluster.
+    """
+    url = config.cluster.message_queue
+    if not url:
+        return None
+
+    base = _manager_class(url)
+    manager = type("ChangeRelayManager", (ChangeRelay, base), {})
+    return manager(url, channel=config.cluster.channel)
@@ -1,11 +1,13 @@
 import logging
+import time
 from threading import Lock
 from typing import Any, Protocol, cast
 
 from ..config import Config
-from ..common import Time
 from ..data import (
     Data,
+    Change,
+    ChangeType,
     NewActionID,
     ActionID,
     UserID,
@@ -13,6 +15,7 @@ from ..data import (
     Action,
     ActionType,
     Room,
+    User,
     UserPermission,
 )
 from ..service import EmoteService, MessageService, UserService
@@ -21,21 +24,166 @@ logger = logging.getLogger(__name__)
 
 
 class SupportsSocketIO(Protocol):
-    def emit(self, event: str, details: dict[str, object], *, room: Any = None) -> None: ...
+    def emit(self, event: str, details: dict[str, object], *, room: Any = None, skip_sid: Any = None) -> None: ...
+
+
+class SupportsRooms(Protocol):
+    def enter_room(self, sid: Any, room: str) -> None: ...
+
+    def leave_room(self, sid: Any, room: str) -> None: ...
 
 
 class SocketInfo:
-    def __init__(self, sid: Any, sessionid: str | None, userid: UserID | None) -> None:
+    def __init__(self, sid: Any, sessionid: str | None, userid: UserID | None, *, index: "SocketIndex | None" = None) -> None:
         self.sid = sid
         self.sessionid = sessionid
         self.userid = userid
         self.fetchlimit: dict[RoomID, ActionID | None] = {}
         self.lastseen: dict[RoomID, int] = {}
-        self.profilets: int | None = None
-        self.prefsts: int | None = None
-        self.invitests: int | None = None
-        self.inviteslen: int | None = None
+        self.sent_profile: bool = False
+        self.sent_preferences: bool = False
+        self.sent_invites: bool = False
+        self.joined: set[RoomID] | None = None
+        self.user: User | None = None
+        self.validated: int = 0
         self.lock: Lock = Lock()
+        self.index = index
+
+    def watch(self, roomid: RoomID, fetchlimit: ActionID | None) -> None:
+        """
+        Start (or continue) monitoring a room for new actions, starting after the given fetchlimit.
+        """
+        self.fetchlimit[roomid] = fetchlimit
+        if self.index is not None:
+            self.index.watch(self, roomid)
+
+    def unwatch(self, roomid: RoomID) -> None:
+        """
+        Stop monitoring a room for new actions.
+        """
+        if roomid in self.fetchlimit:
+            del self.fetchlimit[roomid]
+        if self.index is not None:
+            self.index.unwatch(self, roomid)
+
+
+class SocketIndex:
+    """
+    Reverse lookups from rooms and users to the connected sockets that care about them, so that
+    the message pump only needs to visit sockets that are affected by a given change. Rooms are
+    tracked via SocketInfo.watch() and SocketInfo.unwatch(), which mirror the socket's fetchlimit.
+    When given a Socket.IO server, sockets are also entered into and removed from a Socket.IO
+    room for each room they watch so that new actions can be broadcast once per room.
+    """
+
+    def __init__(self, rooms: SupportsRooms | None = None) -> None:
+        self.__lock = Lock()
+        self.__sio = rooms
+        self.__rooms: dict[RoomID, set[SocketInfo]] = {}
+        self.__users: dict[UserID, set[SocketInfo]] = {}
+
+    def add(self, info: SocketInfo) -> None:
+        with self.__lock:
+            info.index = self
+            if info.userid is not None:
+                self.__users.setdefault(info.userid, set()).add(info)
+            for roomid in info.fetchlimit:
+                self.__add(roomid, info)
+
+    def remove(self, info: SocketInfo) -> None:
+        with self.__lock:
+            if info.userid is not None:
+                self.__discard(self.__users, info.userid, info)
+            for roomid in info.fetchlimit:
+                self.__discard(self.__rooms, roomid, info)
+
+    def watch(self, info: SocketInfo, roomid: RoomID) -> None:
+        with self.__lock:
+            self.__add(roomid, info)
+
+    def unwatch(self, info: SocketInfo, roomid: RoomID) -> None:
+        with self.__lock:
+            if info in self.__rooms.get(roomid, set()):
+                self.__discard(self.__rooms, roomid, info)
+                if self.__sio is not None:
+                    self.__sio.leave_room(info.sid, Room.from_id(roomid))
+
+    def lookup(self, *, roomids: set[RoomID], userids: set[UserID]) -> list[SocketInfo]:
+        """
+        Returns every socket that is watching any of the given rooms or belongs to any of the given users.
+        """
+        with self.__lock:
+            affected: set[SocketInfo] = set()
+            for roomid in roomids:
+                affected.update(self.__rooms.get(roomid, set()))
+            for userid in userids:
+                affected.update(self.__users.get(userid, set()))
+
+        return list(affected)
+
+    def __add(self, roomid: RoomID, info: SocketInfo) -> None:
+        watchers = self.__rooms.setdefault(roomid, set())
+        if info not in watchers:
+            watchers.add(info)
+            if self.__sio is not None:
+                self.__sio.enter_room(info.sid, Room.from_id(roomid))
+
+    def __discard(self, mapping: dict[Any, set[SocketInfo]], key: Any, info: SocketInfo) -> None:
+        if key in mapping:
+            mapping[key].discard(info)
+            if not mapping[key]:
+                del mapping[key]
+
+
+class ChangeCursor:
+    """
+    Follows the change log from wherever it was when we started, handing out every change
+    exactly once. Sequence IDs are handed out when a row is inserted but become visible when
+    the writing transaction commits, so a change can show up after a newer one. To avoid skipping
+    it, the cursor holds at any gap in the sequence until it is filled or until it has been
+    open long enough that the writer must have rolled back.
+    """
+
+    def __init__(self, data: Data, *, gap_timeout: float = 5.0) -> None:
+        self.data = data
+        self.gap_timeout = gap_timeout
+        self.position = data.changelog.get_last_change() or 0
+        self.__seen: set[int] = set()
+        self.__gaps: dict[int, float] = {}
+
+    def poll(self) -> list[Change]:
+        changes: list[Change] = []
+        for seq, change in self.data.changelog.get_changes(after=self.position):
+            if seq not in self.__seen:
+                self.__seen.add(seq)
+                changes.append(change)
+
+        # Move past everything contiguous that we've seen, stopping at any gap that's still young.
+        now = time.monotonic()
+        while self.__seen:
+            nextseq = self.position + 1
+            if nextseq in self.__seen:
+                # If we were waiting on this one, it showed up in time, so stop timing the gap.
+                self.__seen.remove(nextseq)
+                self.__gaps.pop(nextseq, None)
+                self.position = nextseq
+                continue
+
+            opened = self.__gaps.setdefault(nextseq, now)
+            if (now - opened) < self.gap_timeout:
+                break
+
+            del self.__gaps[nextseq]
+            self.position = nextseq
+
+        return changes
+
+    @property
+    def gaps(self) -> int:
+        """
+        Returns how many gaps in the sequence we're currently waiting on.
+        """
+        return len(self.__gaps)
 
 
 def send_emote_deltas(config: Config, data: Data, socketio: SupportsSocketIO, emotes: set[str]) -> set[str]:
@@ -69,74 +217,185 @@ def send_emote_deltas(config: Config, data: Data, socketio: SupportsSocketIO, em
     return emotes
 
 
+class RoomDeltas:
+    """
+    A cache of new actions for each room, meant to live for a single pass of the message pump.
+    Every socket watching a room needs the same new actions, just starting at a different point,
+    so we fetch the union of what everybody needs once, hydrate it once and serialize it once.
+    """
+
+    def __init__(self, config: Config, data: Data) -> None:
+        self.__messageservice = MessageService(config, data)
+        self.__after: dict[RoomID, ActionID] = {}
+        self.__actions: dict[RoomID, list[Action]] = {}
+        self.__originals: dict[ActionID, Action | None] = {}
+        self.__serialized: dict[int, dict[str, object]] = {}
+
+    def want(self, roomid: RoomID, after: ActionID) -> None:
+        """
+        Note that somebody will ask for actions in a room after a given action, so that the
+        single fetch for that room covers them as well.
+        """
+        if roomid not in self.__after or after < self.__after[roomid]:
+            self.__after[roomid] = after
+            if roomid in self.__actions:
+                # Already fetched from a later point, so we'll need to fetch again.
+                del self.__actions[roomid]
+
+    def __fetch(self, roomid: RoomID, userid: UserID) -> list[Action]:
+        if roomid not in self.__actions:
+            actions = self.__messageservice.get_room_updates(roomid, after=self.__after[roomid])
+
+            for action in actions:
+                if action.action == ActionType.CHANGE_USERS:
+                    occupants = self.__messageservice.get_room_occupants(roomid, userid)
+                    if occupants is not None:
+                        action.details = {
+                            "occupants": [o.to_dict() for o in occupants],
+                        }
+
+                elif action.action in {ActionType.INVITE_USER, ActionType.UNINVITE_USER}:
+                    occupants = self.__messageservice.get_room_occupants(roomid, userid)
+                    if occupants is not None:
+                        action.details['occupants'] = [o.to_dict() for o in occupants]
+
+            self.__actions[roomid] = actions
+
+        return self.__actions[roomid]
+
+    def __original(self, actionid: ActionID) -> Action | None:
+        if actionid not in self.__originals:
+            # Swap out the change message for the original updated message.
+            grabbed = self.__messageservice.lookup_action(actionid)
+            if grabbed:
+                grabbed = grabbed.clone()
+                grabbed.details['modified'] = True
+            self.__originals[actionid] = grabbed
+
+        return self.__originals[actionid]
+
+    def get_updates(self, roomid: RoomID, after: ActionID, userid: UserID) -> tuple[list[Action], ActionID | None]:
+        """
+        Returns the list of actions that should be sent to a client who has seen everything up
+        to and including the given action, as well as the newest action ID in that list or None
+        if there were no new actions.
+        """
+        self.want(roomid, after)
+
+        filtered: list[Action] = []
+        seen: set[ActionID] = set()
+        newest: ActionID | None = None
+
+        for action in self.__fetch(roomid, userid):
+            if action.id <= after:
+                continue
+
+            newest = action.id if newest is None else max(newest, action.id)
+
+            if action.action == ActionType.CHANGE_MESSAGE:
+                original = cast(ActionID, action.details["actionid"])
+                if original not in seen:
+                    seen.add(original)
+
+                    grabbed = self.__original(original)
+                    if grabbed:
+                        filtered.append(grabbed)
+
+            # This should go to the client.
+            filtered.append(action)
+
+        return filtered, newest
+
+    def to_dict(self, action: Action) -> dict[str, object]:
+        """
+        Serialize an action returned from get_updates(), reusing the result across clients.
+        """
+        key = id(action)
+        if key not in self.__serialized:
+            self.__serialized[key] = action.to_dict()
+        return self.__serialized[key]
+
+
 def send_action_deltas(
     config: Config,
     data: Data,
     socketio: SupportsSocketIO,
     info: SocketInfo,
+    deltas: RoomDeltas | None = None,
 ) -> bool:
     if not info.userid:
         raise Exception("Logic error, should only call this with valid users!")
 
-    messageservice = MessageService(config, data)
+    if deltas is None:
+        deltas = RoomDeltas(config, data)
 
     updated = False
     for roomid, fetchlimit in info.fetchlimit.items():
         # Only fetch deltas for clients that have gotten an initial fetch for a room.
         if fetchlimit is not None:
-            actions = messageservice.get_room_updates(roomid, after=fetchlimit)
-
-            if actions:
-                filtered: list[Action] = []
-                seen: set[ActionID] = set()
-
-                for action in actions:
-                    fetchlimit = action.id if fetchlimit is None else max(fetchlimit, action.id)
-
-                    if action.action == ActionType.CHANGE_USERS:
-                        occupants = messageservice.get_room_occupants(roomid, info.userid)
-                        if occupants is not None:
-                            action.details = {
-                                "occupants": [o.to_dict() for o in occupants],
-                            }
-
-                    elif action.action in {ActionType.INVITE_USER, ActionType.UNINVITE_USER}:
-                        occupants = messageservice.get_room_occupants(roomid, info.userid)
-                        if occupants is not None:
-                            action.details['occupants'] = [o.to_dict() for o in occupants]
-
-                    elif action.action == ActionType.CHANGE_MESSAGE:
-                        original = cast(ActionID, action.details["actionid"])
-                        if original not in seen:
-                            seen.add(original)
-
-                            # Swap out the change message for the original updated message.
-                            grabbed = messageservice.lookup_action(original)
-                            if grabbed:
-                                grabbed = grabbed.clone()
-                                grabbed.details['modified'] = True
+            filtered, newest = deltas.get_updates(roomid, fetchlimit, info.userid)
 
-                                filtered.append(grabbed)
-
-                    # This should go to the client.
-                    filtered.append(action)
-
-                info.fetchlimit[roomid] = fetchlimit or NewActionID
+            if newest is not None:
+                info.fetchlimit[roomid] = max(fetchlimit, newest)
 
                 socketio.emit('chatactions', {
                     'roomid': Room.from_id(roomid),
-                    'actions': [action.to_dict() for action in filtered],
+                    'actions': [deltas.to_dict(action) for action in filtered],
                 }, room=info.sid)
                 updated = True
 
     return updated
 
 
+def send_room_deltas(
+    config: Config,
+    data: Data,
+    socketio: SupportsSocketIO,
+    index: SocketIndex,
+    sockets: list[SocketInfo],
+    deltas: RoomDeltas,
+) -> None:
+    """
+    Broadcast new actions to each room's Socket.IO room once, instead of once per connected client.
+    Only the largest group of sockets that have all seen the same actions in a room are served this
+    way. Every other socket in the room is skipped and caught up afterwards by send_action_deltas().
+    The caller must hold the lock for every socket passed in.
+    """
+    # Group sockets by where they are in each room's history.
+    byroom: dict[RoomID, dict[ActionID, list[SocketInfo]]] = {}
+    for info in sockets:
+        if not info.userid:
+            raise Exception("Logic error, should only call this with valid users!")
+
+        for roomid, fetchlimit in info.fetchlimit.items():
+            if fetchlimit is not None:
+                byroom.setdefault(roomid, {}).setdefault(fetchlimit, []).append(info)
+
+    for roomid, groups in byroom.items():
+        fetchlimit, members = max(groups.items(), key=lambda g: len(g[1]))
+        filtered, newest = deltas.get_updates(roomid, fetchlimit, cast(UserID, members[0].userid))
+        if newest is None:
+            continue
+
+        # Anybody else watching this room, including sockets we couldn't lock, gets skipped.
+        sids = {info.sid for info in members}
+        skip = [info.sid for info in index.lookup(roomids={roomid}, userids=set()) if info.sid not in sids]
+
+        socketio.emit('chatactions', {
+            'roomid': Room.from_id(roomid),
+            'actions': [deltas.to_dict(action) for action in filtered],
+        }, room=Room.from_id(roomid), skip_sid=skip)
+
+        for info in members:
+            info.fetchlimit[roomid] = max(fetchlimit, newest)
+
+
 def send_chat_deltas(
     config: Config,
     data: Data,
     socketio: SupportsSocketIO,
     info: SocketInfo,
+    deltas: RoomDeltas | None = None,
 ) -> None:
     if not info.userid:
         raise Exception("Logic error, should only call this with valid users!")
@@ -145,16 +404,22 @@ def send_chat_deltas(
     userservice = UserService(config, data)
 
     # First, send any new actions to any rooms that the client has already joined and is monitoring.
-    updated = send_action_deltas(config, data, socketio, info)
+    updated = send_action_deltas(config, data, socketio, info, deltas)
 
     # Now, figure out if this user has been joined to a new chat by another user or the server.
     rooms = messageservice.get_joined_rooms(info.userid)
 
+    # Stop monitoring any rooms that we've been removed from by somebody else.
+    joined = {room.id for room in rooms}
+    info.joined = joined
+    for roomid in [r for r in info.fetchlimit if r not in joined]:
+        info.unwatch(roomid)
+
     includes: set[RoomID] = set()
     for room in rooms:
         if room.id not in info.fetchlimit:
             includes.add(room.id)
-            info.fetchlimit[room.id] = room.newest_action if room.newest_action is not None else NewActionID
+            info.watch(room.id, room.newest_action if room.newest_action is not None else NewActionID)
             updated = True
 
     # Calculate any badge updates that the client needs to know about, including
@@ -177,40 +442,37 @@ def send_chat_deltas(
         socketio.emit('roomlist', clientdata, room=info.sid)
 
 
+def _changed(changes: list[Change], changetype: ChangeType, userid: UserID) -> bool:
+    # Changes that don't say who they're for could be for anybody.
+    return any(c.type == changetype and (c.userid is None or c.userid == userid) for c in changes)
+
+
 def send_profile_deltas(
     config: Config,
     data: Data,
     socketio: SupportsSocketIO,
     info: SocketInfo,
+    changes: list[Change],
 ) -> None:
     if not info.userid:
         raise Exception("Logic error, should only call this with valid users!")
 
     userservice = UserService(config, data)
 
-    # Figure out if preferences or profile changed since our last poll,
+    # Figure out if preferences or profile changed according to the change log,
     # and send an updated "preferences" or "profile" response to said
     # client if it has. This should keep prefs and profiles in sync
     # across multiple sessions at once.
-    profilets = info.profilets
-    prefsts = info.prefsts
-
-    if profilets is not None:
-        ts = Time.now()
-        if userservice.has_updated_user(info.userid, profilets):
-            userprofile = userservice.lookup_user(info.userid)
-            admin = userprofile is not None and UserPermission.ADMINISTRATOR in userprofile.permissions
-            if userprofile:
-                info.profilets = ts
-                socketio.emit('profile', userprofile.to_dict(config=config, admin=admin), room=info.sid)
-
-    if prefsts is not None:
-        ts = Time.now()
-        if userservice.has_updated_preferences(info.userid, prefsts):
-            userpreferences = userservice.get_preferences(info.userid)
-            if userpreferences:
-                info.prefsts = ts
-                socketio.emit('preferences', userpreferences.to_dict(), room=info.sid)
+    if info.sent_profile and _changed(changes, ChangeType.USER, info.userid):
+        userprofile = userservice.lookup_user(info.userid)
+        admin = userprofile is not None and UserPermission.ADMINISTRATOR in userprofile.permissions
+        if userprofile:
+            socketio.emit('profile', userprofile.to_dict(config=config, admin=admin), room=info.sid)
+
+    if info.sent_preferences and _changed(changes, ChangeType.PREFERENCES, info.userid):
+        userpreferences = userservice.get_preferences(info.userid)
+        if userpreferences:
+            socketio.emit('preferences', userpreferences.to_dict(), room=info.sid)
 
 
 def send_invite_deltas(
@@ -218,6 +480,7 @@ def send_invite_deltas(
     data: Data,
     socketio: SupportsSocketIO,
     info: SocketInfo,
+    changes: list[Change],
 ) -> None:
     if not info.userid:
         raise Exception("Logic error, should only call this with valid users!")
@@ -225,16 +488,9 @@ def send_invite_deltas(
     messageservice = MessageService(config, data)
 
     # Figure out if we've gotten any invites since last time we updated the client.
-    invitests = info.invitests
-    inviteslen = info.inviteslen
-
-    if invitests is not None and inviteslen is not None:
-        ts = Time.now()
-        if messageservice.has_updated_invites(info.userid, invitests, inviteslen):
-            invites = messageservice.get_invited_rooms(info.userid)
-            info.invitests = ts
-            info.inviteslen = len(invites)
-            socketio.emit('invites', {
-                'active': [invite.to_dict() for invite in invites if invite.active],
-                'ignored': [invite.to_dict() for invite in invites if not invite.active],
-            }, room=info.sid)
+    if info.sent_invites and _changed(changes, ChangeType.INVITE, info.userid):
+        invites = messageservice.get_invited_rooms(info.userid)
+        socketio.emit('invites', {
+            'active': [invite.to_dict() for invite in invites if invite.active],
+            'ignored': [invite.to_dict() for invite in invites if not invite.active],
+        }, room=info.sid)
@@ -5,7 +5,17 @@ from threading import Lock
 from typing import Any, Final, Literal, cast
 
 from .app import app, socketio, config, request
-from .messagepump import SocketInfo, send_emote_deltas, send_chat_deltas, send_profile_deltas, send_invite_deltas
+from .messagepump import (
+    ChangeCursor,
+    RoomDeltas,
+    SocketIndex,
+    SocketInfo,
+    send_emote_deltas,
+    send_room_deltas,
+    send_chat_deltas,
+    send_profile_deltas,
+    send_invite_deltas,
+)
 from ..common import AESCipher, Time, represents_real_text, coerce_enum
 from ..service import (
     AttachmentService,
@@ -14,9 +24,15 @@ from ..service import (
     MessageService,
     UserServiceException,
     MessageServiceException,
+    mediapool,
 )
 from ..data import (
     Data,
+    ChangeType,
+    changebus,
+    invalidate_changes,
+    occupantcache,
+    usercache,
     Action,
     ActionType,
     Attachment,
@@ -37,20 +53,45 @@ from ..data import (
     AttachmentID,
     FaviconID,
     RoomID,
+    UserID,
 )
 
 
-MESSAGE_PUMP_TICK_SECONDS: Final[float] = 0.05
+MESSAGE_PUMP_WAIT_SECONDS: Final[float] = 0.5
+FALLBACK_POLL_TICK_SECONDS: Final[float] = 2.0
 EMOJI_REFRESH_TICK_SECONDS: Final[float] = 5.0
-AUXILIARY_REFRESH_TICK_SECONDS: Final[float] = 0.5
+CHANGELOG_PRUNE_TICK_SECONDS: Final[int] = 60 * 60
+CHANGELOG_RETENTION_SECONDS: Final[int] = 24 * 60 * 60
+CACHE_STATS_TICK_SECONDS: Final[int] = 10 * 60
 
 
 MAX_ICON_WIDTH: Final[int] = 256
 MAX_ICON_HEIGHT: Final[int] = 256
 
 
+class LocalSocketIO:
+    """
+    Wraps our Socket.IO server for the message pump. Each process' message pump only ever
+    computes deltas for the sockets connected to that process, so when running as part of a
+    cluster there's no reason to fan its emits out to every other process through the message
+    queue. This also looks up the server at call time, since it is replaced when we attach
+    to a message queue on startup.
+    """
+
+    def emit(self, event: str, details: dict[str, object], *, room: Any = None, skip_sid: Any = None) -> None:
+        socketio.emit(event, details, room=room, skip_sid=skip_sid, ignore_queue=True)
+
+    def enter_room(self, sid: Any, room: str) -> None:
+        socketio.server.enter_room(sid, room)
+
+    def leave_room(self, sid: Any, room: str) -> None:
+        socketio.server.leave_room(sid, room)
+
+
+localsocketio: LocalSocketIO = LocalSocketIO()
 socket_lock: Lock = Lock()
 socket_to_info: dict[Any, SocketInfo] = {}
+socket_index: SocketIndex = SocketIndex(localsocketio)
 background_thread: object | None = None
 logger = logging.getLogger(__name__)
 
@@ -67,94 +108,150 @@ def background_thread_proc() -> None:
 
 def background_thread_proc_impl() -> None:
     """
-    The background polling thread that manages asynchronous messages from the database.
+    The background thread that manages relaying asynchronous messages from the database.
     """
 
     with Data.spawn(config) as data:
-        messageservice = MessageService(config, data)
-        userservice = UserService(config, data)
         emoteservice = EmoteService(config, data)
+        userservice = UserService(config, data)
 
         # Make sure we can send emote additions and subtractions to the connected clients.
         emotes = {k for k in emoteservice.get_all_emotes()}
         last_emote_update = Time.now()
-        last_auxiliary_poll = 0
-        last_user_update: int | None = None
-        last_invite_update: tuple[int, int] | None = None
-        last_action: ActionID | None = None
-
-        while True:
-            # Just yield to the async system.
-            socketio.sleep(MESSAGE_PUMP_TICK_SECONDS)
-
-            # See if we need to update emotes on clients.
-            if (Time.now() - last_emote_update) >= EMOJI_REFRESH_TICK_SECONDS:
-                emotes = send_emote_deltas(config, data, socketio, emotes)
-                last_emote_update = Time.now()
-
-            # Look for any new actions that should be relayed.
-            current_action = messageservice.get_last_action()
-            current_update = userservice.get_last_user_update()
-
-            # Also look for any new invites, but do so less frequently.
-            if (Time.now() - last_auxiliary_poll) >= AUXILIARY_REFRESH_TICK_SECONDS:
-                last_auxiliary_poll = Time.now()
-                current_invite = messageservice.get_last_invite_update()
-
-            # Shut down early if we have nothing to poll.
-            global background_thread
-            with socket_lock:
-                if not socket_to_info:
-                    logger.info("Shutting down message pump thread due to no more client sockets.")
-                    background_thread = None
-
-                    return
+        last_prune = 0
+        last_cache_stats = Time.now()
+        last_poll = 0
 
-            if current_action == last_action and current_update == last_user_update and current_invite == last_invite_update:
-                # Nothing to do, skip the expensive part below.
-                data.commit()
-                continue
-
-            last_action = current_action
-            last_user_update = current_update
-            last_invite_update = current_invite
+        # Writers in this process will wake us up as soon as they commit something, and the
+        # change log tells us exactly what changed regardless of which process wrote it.
+        subscription = changebus.subscribe()
+        cursor = ChangeCursor(data)
 
-            # If we have actual actions, grab who we need to act on and then individually lock.
-            # This prevents a misbehaving client from locking the whole network.
-            with socket_lock:
-                if not socket_to_info:
-                    logger.info("Shutting down message pump thread due to no more client sockets.")
-                    background_thread = None
-
-                    return
-
-                sockets: list[SocketInfo] = list(socket_to_info.values())
-
-            # Get a fresh data so that the per-request cache only takes effect for the for loop below.
-            deltadata = data.clone()
+        try:
+            while True:
+                # Block until something happens, yielding to the async system while we wait.
+                changes = subscription.wait(MESSAGE_PUMP_WAIT_SECONDS)
+
+                # See if we need to update emotes on clients.
+                if (Time.now() - last_emote_update) >= EMOJI_REFRESH_TICK_SECONDS:
+                    emotes = send_emote_deltas(config, data, localsocketio, emotes)
+                    last_emote_update = Time.now()
+
+                # Shut down early if we have nothing to poll.
+                global background_thread
+                with socket_lock:
+                    if not socket_to_info:
+                        logger.info("Shutting down message pump thread due to no more client sockets.")
+                        background_thread = None
+
+                        return
+
+                # Write out any read state that clients have told us about since the last flush.
+                userservice.flush_last_seen()
+
+                # Keep the change log from growing forever. Nothing reads more than a few seconds back.
+                if (Time.now() - last_prune) >= CHANGELOG_PRUNE_TICK_SECONDS:
+                    data.changelog.prune_changes(Time.now() - CHANGELOG_RETENTION_SECONDS)
+                    last_prune = Time.now()
+
+                # Let operators see how well the process-wide caches and pools are doing so they can be sized.
+                if (Time.now() - last_cache_stats) >= CACHE_STATS_TICK_SECONDS:
+                    logger.info(f"User cache {usercache.stats()}, occupant cache {occupantcache.stats()}")
+                    logger.info(f"Media pool {mediapool.stats()}")
+                    last_cache_stats = Time.now()
+
+                # Changes made by other processes (such as the management CLI) never show up on the
+                # change bus unless we're in a cluster, so occasionally read the change log for them.
+                # Whenever we read it, the log is the authority on what changed, so that every change
+                # is handled exactly once no matter how we found out about it.
+                if changes or (Time.now() - last_poll) >= FALLBACK_POLL_TICK_SECONDS:
+                    last_poll = Time.now()
+                    changes = cursor.poll()
+
+                    # Users and occupants are cached for the whole process, so drop any that were just
+                    # changed, including by other processes that we'd otherwise never hear from.
+                    invalidate_changes(changes)
+
+                if not changes:
+                    # Nothing to do, skip the expensive part below.
+                    data.commit()
+                    continue
 
-            for info in sockets:
-                # Lock this so other communication with this client doesn't get out of order.
-                locked = info.lock.acquire(blocking=False)
-                if locked:
-                    try:
+                # If we have actual actions, grab who we need to act on and then individually lock.
+                # This prevents a misbehaving client from locking the whole network.
+                with socket_lock:
+                    if not socket_to_info:
+                        logger.info("Shutting down message pump thread due to no more client sockets.")
+                        background_thread = None
+
+                        return
+
+                    sockets: list[SocketInfo] = list(socket_to_info.values())
+
+                # Narrow down to only the sockets watching a changed room or belonging to a changed user.
+                # Changes that we can't attribute to any room or user still need to go to everyone.
+                roomids = {c.roomid for c in changes if c.roomid is not None}
+                userids = {c.userid for c in changes if c.userid is not None}
+                if all(c.roomid is not None or c.userid is not None for c in changes):
+                    sockets = socket_index.lookup(roomids=roomids, userids=userids)
+
+                # Get a fresh data so that the per-request cache only takes effect for the for loop below.
+                deltadata = data.clone()
+
+                # Figure out how far back each room needs to go for every socket we're about to visit,
+                # so that each room's new actions are only fetched and serialized once.
+                deltas = RoomDeltas(config, deltadata)
+                for info in sockets:
+                    for roomid, fetchlimit in list(info.fetchlimit.items()):
+                        if fetchlimit is not None:
+                            deltas.want(roomid, fetchlimit)
+
+                # Look up everyone we're about to visit in one go, so that we can check for deactivation
+                # without a query per socket. This also primes the request cache for the deltas below.
+                users = UserService(config, deltadata).lookup_users([info.userid for info in sockets if info.userid is not None])
+
+                # Anybody whose account or sessions changed needs their cached user dropped so that the
+                # next request from them re-checks their session against the DB.
+                changed = {c.userid for c in changes if c.type == ChangeType.USER and c.userid is not None}
+                for info in sockets:
+                    if info.userid in changed:
+                        info.user = None
+
+                # Lock each socket so other communication with this client doesn't get out of order.
+                # Sockets that are busy are skipped, which prevents a misbehaving client from locking
+                # the whole network.
+                active: list[SocketInfo] = []
+                for info in sockets:
+                    if info.lock.acquire(blocking=False):
                         # First, if they were deactivated, inform them now.
-                        user = userservice.lookup_user(info.userid) if info.userid is not None else None
+                        user = users.get(info.userid) if info.userid is not None else None
                         if user is None or UserPermission.ACTIVATED not in user.permissions:
-                            socketio.emit('reload', {}, room=info.sid)
+                            localsocketio.emit('reload', {}, room=info.sid)
+                            info.lock.release()
                             continue
 
+                        active.append(info)
+
+                try:
+                    # Broadcast new actions once per room to everyone who is caught up.
+                    send_room_deltas(config, deltadata, localsocketio, socket_index, active, deltas)
+
+                    for info in active:
                         # Now, send this connected client any updates both in terms of actions and details
                         # of their account that might have been changed.
-                        send_profile_deltas(config, deltadata, socketio, info)
-                        send_invite_deltas(config, deltadata, socketio, info)
-                        send_chat_deltas(config, deltadata, socketio, info)
+                        send_profile_deltas(config, deltadata, localsocketio, info, changes)
+                        send_invite_deltas(config, deltadata, localsocketio, info, changes)
+                        send_chat_deltas(config, deltadata, localsocketio, info, deltas)
 
-                    finally:
+                finally:
+                    for info in active:
                         info.lock.release()
 
-            # Finally, release any locks and make sure we can sleep successfully.
-            data.commit()
+                # Finally, release any locks and make sure we can sleep successfully.
+                data.commit()
+
+        finally:
+            changebus.unsubscribe(subscription)
 
 
 def register_sid(data: Data, sid: Any, sessionid: str | None) -> None:
@@ -165,12 +262,15 @@ def register_sid(data: Data, sid: Any, sessionid: str | None) -> None:
             background_thread = socketio.start_background_task(background_thread_proc)
 
         user = None if sessionid is None else data.user.from_session(sessionid)
-        socket_to_info[sid] = SocketInfo(sid, sessionid, user.id if user is not None else None)
+        info = SocketInfo(sid, sessionid, user.id if user is not None else None)
+        socket_to_info[sid] = info
+        socket_index.add(info)
 
 
 def unregister_sid(sid: Any) -> None:
     with socket_lock:
         if sid in socket_to_info:
+            socket_index.remove(socket_to_info[sid])
             del socket_to_info[sid]
 
 
@@ -199,7 +299,14 @@ def recover_user(data: Data, sid: Any) -> User | None:
         socketio.emit('reload', {}, room=sid)
         return None
 
-    user = data.user.from_session(info.sessionid)
+    # The message pump drops the cached user whenever the user or one of their sessions changes,
+    # so we only need to go back to the DB to catch sessions that quietly expired.
+    user = info.user
+    if user is None or (Time.now() - info.validated) >= config.authentication.session_revalidate:
+        user = data.user.from_session(info.sessionid)
+        info.user = user
+        info.validated = Time.now()
+
     if user is None:
         # Session was de-authed, tell the client to refresh.
         socketio.emit('reload', {}, room=sid)
@@ -218,6 +325,14 @@ def recover_user(data: Data, sid: Any) -> User | None:
     return user
 
 
+def is_joined(messageservice: MessageService, info: SocketInfo, userid: UserID, roomid: RoomID) -> bool:
+    # The message pump keeps the joined room set up to date whenever membership changes for this
+    # user, so we only need to hit the DB if we haven't learned it yet on this socket.
+    if info.joined is None:
+        info.joined = messageservice.get_joined_room_ids(userid)
+    return roomid in info.joined
+
+
 def hydrate_tag(request: dict[str, object], response: dict[str, object]) -> dict[str, object]:
     if 'tag' not in request:
         return response
@@ -265,6 +380,9 @@ def disconnect() -> None:
 
         # Explicitly kill the presence since we know they're gone.
         unregister_sid(request.sid)
+
+        # Make sure whatever they read right before leaving sticks if they reconnect somewhere else.
+        UserService(config, data).flush_last_seen(force=True)
         logger.info(f"Client {username} disconnected from {request.remote_addr} with session {request.sid}")
 
 
@@ -341,6 +459,8 @@ def welcomeaccept(json: dict[str, object]) -> None:
         messageservice.join_autojoin_rooms(user.id)
         userservice.add_permission(user.id, UserPermission.WELCOMED)
         rooms = messageservice.get_joined_rooms(user.id)
+        info = recover_info(request.sid)
+        info.joined = {room.id for room in rooms}
         if rooms:
             socketio.emit('roomlist', {
                 'rooms': [room.to_dict() for room in rooms],
@@ -364,10 +484,11 @@ def roomlist(json: dict[str, object]) -> None:
             # Grab all rooms that the user is in, based on their user ID.
             rooms = messageservice.get_joined_rooms(user.id)
             lastseen = userservice.get_last_seen_counts(user.id)
+            info.joined = {room.id for room in rooms}
 
             # Pre-charge the delta fetches for all rooms this user is in.
             for room in rooms:
-                info.fetchlimit[room.id] = room.newest_action if room.newest_action is not None else NewActionID
+                info.watch(room.id, room.newest_action if room.newest_action is not None else NewActionID)
                 info.lastseen[room.id] = lastseen.get(room.id, 0)
 
         socketio.emit('roomlist', hydrate_tag(json, {
@@ -427,10 +548,9 @@ def profile(json: dict[str, object]) -> None:
         # That way we can notify other sessions if the current one changes their profile.
         with info.lock:
             # Look up last settings for this user.
-            ts = Time.now()
             userprofile = userservice.lookup_user(user.id)
             if userprofile:
-                info.profilets = ts
+                info.sent_profile = True
                 socketio.emit('profile', hydrate_tag(json, userprofile.to_dict(config=config, admin=admin)), room=request.sid)
 
 
@@ -449,10 +569,9 @@ def preferences(json: dict[str, object]) -> None:
         # That way we can notify other sessions if the current one changes their profile.
         with info.lock:
             # Look up last settings for this user.
-            ts = Time.now()
             userpreferences = userservice.get_preferences(user.id)
             if userpreferences:
-                info.prefsts = ts
+                info.sent_preferences = True
                 socketio.emit('preferences', hydrate_tag(json, userpreferences.to_dict()), room=request.sid)
 
 
@@ -506,6 +625,8 @@ def updateprofile(json: dict[str, object]) -> None:
 
         try:
             userservice.update_user(user.id, name=newname, about=newabout, icon=icon, icon_delete=icondelete)
+            # Don't keep handing out our own stale profile until the message pump catches up.
+            recover_info(request.sid).user = None
             userprofile = userservice.lookup_user(user.id)
             admin = userprofile is not None and UserPermission.ADMINISTRATOR in userprofile.permissions
 
@@ -611,13 +732,7 @@ def chatactions(json: dict[str, object]) -> None:
         with info.lock:
             roomid = Room.to_id(str(json.get('roomid')))
             if roomid:
-                # Grab the current room in our joined rooms list. There's a way more performant
-                # way to do this but we can fix that later.
-                rooms = messageservice.get_joined_rooms(user.id)
-                rooms = [r for r in rooms if r.id == roomid]
-                room = rooms[0] if rooms else None
-
-                if not room:
+                if not is_joined(messageservice, info, user.id, roomid):
                     # Trying to grab chat for a room we're not in!
                     return
 
@@ -630,13 +745,16 @@ def chatactions(json: dict[str, object]) -> None:
                     # up re-sending the messages again in the message pump thread above.
                     fetchlimit = afterid
                     filtered: list[Action] = []
+                    occupants: list[Occupant] | None = None
 
                     for action in actions:
                         fetchlimit = max(fetchlimit, action.id)
 
                         if action.action == ActionType.CHANGE_USERS:
+                            if occupants is None:
+                                occupants = messageservice.get_room_occupants(roomid, user.id) or []
                             action.details = {
-                                "occupants": [o.to_dict() for o in room.occupants],
+                                "occupants": [o.to_dict() for o in occupants],
                             }
 
                         elif action.action == ActionType.CHANGE_MESSAGE:
@@ -652,7 +770,7 @@ def chatactions(json: dict[str, object]) -> None:
                         # This should go to the client as-is.
                         filtered.append(action)
 
-                    info.fetchlimit[roomid] = fetchlimit
+                    info.watch(roomid, fetchlimit)
 
                     socketio.emit('chatactions', hydrate_tag(json, {
                         'roomid': Room.from_id(roomid),
@@ -677,45 +795,54 @@ def chathistory(json: dict[str, object]) -> None:
         with info.lock:
             roomid = Room.to_id(str(json.get('roomid')))
             if roomid:
-                rooms = messageservice.get_joined_rooms(user.id)
-                joinedrooms = {room.id: room for room in rooms}
-                if roomid not in joinedrooms:
+                if not is_joined(messageservice, info, user.id, roomid):
                     # Trying to grab chat for a room we're not in!
                     return
 
-                before = json.get('before', None)
-                if before:
-                    beforeid = Action.to_id(str(before))
-                    actions = messageservice.get_room_history(roomid, before=beforeid)
-
-                    socketio.emit('chathistory', hydrate_tag(json, {
-                        'roomid': Room.from_id(roomid),
-                        'history': [action.to_dict() for action in actions],
-                    }), room=request.sid)
-
-                else:
+                # Anchors are all optional. Without any of them we load the most recent history,
+                # which is also when the client gets the occupant list and starts watching.
+                before = Action.to_id(str(json['before'])) if json.get('before') else None
+                after = Action.to_id(str(json['after'])) if json.get('after') else None
+                around = Action.to_id(str(json['around'])) if json.get('around') else None
+                try:
+                    limit = int(str(json['limit'])) if json.get('limit') else None
+                except ValueError:
+                    limit = None
+
+                history = messageservice.get_room_history(roomid, before=before, after=after, around=around, limit=limit)
+                response: dict[str, object] = {
+                    'roomid': Room.from_id(roomid),
+                    'history': [action.to_dict() for action in history.actions],
+                    'more_before': history.more_before,
+                    'more_after': history.more_after,
+                }
+
+                if before is None and not history.more_after:
+                    # The client has caught up to the newest action, so start sending new ones from
+                    # the point where we read here, and only updating if new events somehow came in
+                    # after we read the room. This stops us from accidentally re-sending events that
+                    # aren't looked up in get_room_history such as CHANGE_MESSAGE actions.
+                    fetchlimit = history.newest_action
+                    for action in history.actions:
+                        fetchlimit = action.id if fetchlimit is None else max(fetchlimit, action.id)
+                    info.watch(roomid, fetchlimit or NewActionID)
+                elif around is not None:
+                    # The client jumped into the middle of history and will page forwards with after
+                    # until it catches up. Sending new actions in the meantime would leave a gap
+                    # between its page and them that it would never be told about.
+                    info.unwatch(roomid)
+
+                if before is None and after is None:
                     lastseen = userservice.get_last_seen_actions(user.id)
-                    actions = messageservice.get_room_history(roomid)
                     occupants = messageservice.get_room_occupants(roomid, user.id) or []
 
-                    # Starting from the point where we read here, and only updating if new events
-                    # somehow came in after we read the list of joined rooms. This stops us from
-                    # accidentally re-sending events that aren't looked up in get_room_history such
-                    # as CHANGE_MESSAGE actions.
-                    fetchlimit = joinedrooms[roomid].newest_action
-                    for action in actions:
-                        fetchlimit = action.id if fetchlimit is None else max(fetchlimit, action.id)
-                    info.fetchlimit[roomid] = fetchlimit or NewActionID
-
                     # Also report the last seen message, so that a "new" indicator can be displayed.
                     lastaction = lastseen.get(roomid, None)
 
-                    socketio.emit('chathistory', hydrate_tag(json, {
-                        'roomid': Room.from_id(roomid),
-                        'history': [action.to_dict() for action in actions],
-                        'occupants': [occupant.to_dict() for occupant in occupants],
-                        'lastseen': Action.from_id(lastaction) if lastaction else None,
-                    }), room=request.sid)
+                    response['occupants'] = [occupant.to_dict() for occupant in occupants]
+                    response['lastseen'] = Action.from_id(lastaction) if lastaction else None
+
+                socketio.emit('chathistory', hydrate_tag(json, response), room=request.sid)
 
 
 @socketio.on('invite')  # type: ignore
@@ -745,7 +872,8 @@ def message(json: dict[str, object]) -> dict[str, object]:
 
         # Try to associate with a user if there is one.
         user = recover_user(data, request.sid)
-        if user is None:
+        info = recover_info(request.sid)
+        if user is None or info is None:
             return {'status': 'failed'}
 
         roomid = Room.to_id(str(json.get('roomid')))
@@ -753,9 +881,9 @@ def message(json: dict[str, object]) -> dict[str, object]:
         # While we allow funny formatting and spaces, we don't allow space-only messages.
         message = str(json.get('message')).strip()
         if roomid:
-            rooms = messageservice.get_joined_rooms(user.id)
-            joinedrooms = {room.id for room in rooms}
-            if roomid not in joinedrooms:
+            # Inserting the action re-checks that we're still in the room, so this only needs to
+            # weed out rooms we were never in.
+            if not is_joined(messageservice, info, user.id, roomid):
                 # Trying to insert a chat for a room we're not in!
                 return {'status': 'failed'}
 
@@ -806,8 +934,9 @@ def leaveroom(json: dict[str, object]) -> None:
         with info.lock:
             roomid = Room.to_id(str(json.get('roomid')))
             if roomid:
-                if roomid in info.fetchlimit:
-                    del info.fetchlimit[roomid]
+                info.unwatch(roomid)
+                if info.joined is not None:
+                    info.joined.discard(roomid)
 
                 messageservice.leave_room(roomid, user.id)
 
@@ -887,12 +1016,13 @@ def joinroom(json: dict[str, object]) -> None:
             if actual_id:
                 # Grab all rooms that the user is in, based on their user ID.
                 rooms = messageservice.get_joined_rooms(user.id)
+                info.joined = {room.id for room in rooms}
 
                 # Pre-charge the delta fetches for all rooms this user is in that
                 # they weren't in beforehand.
                 for room in rooms:
                     if room.id not in info.fetchlimit:
-                        info.fetchlimit[room.id] = room.newest_action if room.newest_action is not None else NewActionID
+                        info.watch(room.id, room.newest_action if room.newest_action is not None else NewActionID)
 
         if actual_id:
             socketio.emit('roomlist', {
@@ -965,12 +1095,13 @@ def newroom(json: dict[str, object]) -> None:
             if actual_id:
                 # Grab all rooms that the user is in, based on their user ID.
                 rooms = messageservice.get_joined_rooms(user.id)
+                info.joined = {room.id for room in rooms}
 
                 # Pre-charge the delta fetches for all rooms this user is in that
                 # they weren't in beforehand.
                 for room in rooms:
                     if room.id not in info.fetchlimit:
-                        info.fetchlimit[room.id] = room.newest_action if room.newest_action is not None else NewActionID
+                        info.watch(room.id, room.newest_action if room.newest_action is not None else NewActionID)
 
         if actual_id:
             socketio.emit('roomlist', {
@@ -1036,10 +1167,8 @@ def invites(json: dict[str, object]) -> None:
         # That way we can reliably notify sessions when a user sends them an invite.
         with info.lock:
             # Look up last settings for this user.
-            ts = Time.now()
             invites = messageservice.get_invited_rooms(user.id)
-            info.invitests = ts
-            info.inviteslen = len(invites)
+            info.sent_invites = True
             socketio.emit('invites', hydrate_tag(json, {
                 'active': [invite.to_dict() for invite in invites if invite.active],
                 'ignored': [invite.to_dict() for invite in invites if not invite.active],
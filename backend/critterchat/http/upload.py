@@ -1,14 +1,17 @@
 import logging
 import os
-import tempfile
 import urllib.request
 from flask import Blueprint, request
-from pydub import AudioSegment  # type: ignore
-from pydub.exceptions import CouldntDecodeError  # type: ignore
 
 from .app import UserException, app, static_location, templates_location, loginrequired, jsonify, g
 from ..data import Attachment, UserNotification, MetadataType
-from ..service import AttachmentService, AttachmentServiceUnsupportedImageException, AttachmentServiceInvalidSizeException
+from ..service import (
+    AttachmentService,
+    AttachmentServiceBusyException,
+    AttachmentServiceInvalidSizeException,
+    AttachmentServiceUnsupportedAudioException,
+    AttachmentServiceUnsupportedImageException,
+)
 
 
 upload = Blueprint(
@@ -72,6 +75,8 @@ def _icon_upload(uploadtype: str) -> dict[str, object]:
         raise UserException(f"{uploadtype.capitalize()} image is an unrecognized format.")
     except AttachmentServiceInvalidSizeException:
         raise UserException(f"Invalid image size for {uploadtype}. {uploadtype.capitalize()}s must be a maximum of {AttachmentService.MAX_ICON_WIDTH}x{AttachmentService.MAX_ICON_HEIGHT}")
+    except AttachmentServiceBusyException as e:
+        raise UserException(str(e))
 
     if width != height:
         raise UserException(f"{uploadtype.capitalize()} image is not square.")
@@ -136,33 +141,22 @@ def notifications_upload() -> dict[str, object]:
             raise Exception("Notification key unrecognized, cannot set notification.")
 
         try:
-            with tempfile.NamedTemporaryFile(delete_on_close=False) as fp1:
-                fp1.write(data)
-                fp1.close()
-
-                segment = AudioSegment.from_file(fp1.name)
-
-                with tempfile.NamedTemporaryFile(delete_on_close=False) as fp2:
-                    fp2.close()
-
-                    segment.export(fp2.name, format="mp3")
-
-                    with open(fp2.name, "rb") as bfp:
-                        actual_data = bfp.read()
-
-                        attachmentid = attachmentservice.create_attachment("audio/mpeg", None, {})
-                        if attachmentid is None:
-                            raise Exception("Could not insert new user notification sound!")
-                        attachmentservice.put_attachment_data(attachmentid, actual_data)
+            actual_data = attachmentservice.prepare_notification_audio(data)
+        except AttachmentServiceUnsupportedAudioException as e:
+            logger.warning(f"Client {username} denied upload attachment with the following reason: {str(e)}")
+            raise UserException("Unsupported audio provided for user notification.")
+        except AttachmentServiceBusyException as e:
+            raise UserException(str(e))
 
-                        name = attachmentservice.get_attachment_name(attachmentid)
-                        logger.info(f"Client {username} uploaded attachment with ID {attachmentid} and public name {name}")
+        attachmentid = attachmentservice.create_attachment("audio/mpeg", None, {})
+        if attachmentid is None:
+            raise Exception("Could not insert new user notification sound!")
+        attachmentservice.put_attachment_data(attachmentid, actual_data)
 
-                        response[alias] = Attachment.from_id(attachmentid)
+        name = attachmentservice.get_attachment_name(attachmentid)
+        logger.info(f"Client {username} uploaded attachment with ID {attachmentid} and public name {name}")
 
-        except CouldntDecodeError as e:
-            logger.warning(f"Client {username} denied upload attachment with the following reason: {str(e)}")
-            raise UserException("Unsupported audio provided for user notification.")
+        response[alias] = Attachment.from_id(attachmentid)
 
     # Finally, return all the attachment IDs.
     return {"notif_sounds": response}
@@ -232,7 +226,10 @@ def attachments_upload() -> dict[str, object]:
         # Remember the old content type, because if we detect that it's wrong, or we convert the image
         # we will want to update the filename with the new correct extension.
         presumed_content_type = attachmentservice.get_content_type(filename)
-        content_type = attachmentservice.get_content_type(attachmentdata)
+        try:
+            content_type = attachmentservice.get_content_type(attachmentdata)
+        except AttachmentServiceBusyException as e:
+            raise UserException(str(e))
         if (
             not attachmentservice.is_allowed_content_type(presumed_content_type, allow_convertible=True) and
             not attachmentservice.is_allowed_content_type(content_type, allow_convertible=True)
@@ -251,6 +248,10 @@ def attachments_upload() -> dict[str, object]:
             except AttachmentServiceUnsupportedImageException as e:
                 logger.warning(f"Client {username} denied upload attachment with the following reason: {str(e)}")
                 raise UserException(f'Chosen attachment {filename} is not a supported image.')
+            except AttachmentServiceInvalidSizeException:
+                raise UserException(f'Chosen attachment {filename} is too large. Images cannot be larger than {g.config.media.max_megapixels} megapixels.')
+            except AttachmentServiceBusyException as e:
+                raise UserException(str(e))
 
             if content_type != presumed_content_type:
                 # Gotta add a new extension to the file.
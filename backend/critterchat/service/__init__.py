@@ -1,8 +1,12 @@
 from .attachment import (
     AttachmentService,
+    AttachmentServiceBusyException,
     AttachmentServiceException,
     AttachmentServiceInvalidSizeException,
+    AttachmentServiceUnsupportedAudioException,
     AttachmentServiceUnsupportedImageException,
+    Thumbnail,
+    mediapool,
 )
 from .emote import (
     EmoteService,
@@ -16,6 +20,7 @@ from .mastodon import (
 from .message import (
     MessageService,
     MessageServiceException,
+    RoomHistory,
 )
 from .user import (
     UserService,
@@ -24,8 +29,10 @@ from .user import (
 
 __all__ = [
     "AttachmentService",
+    "AttachmentServiceBusyException",
     "AttachmentServiceException",
     "AttachmentServiceInvalidSizeException",
+    "AttachmentServiceUnsupportedAudioException",
     "AttachmentServiceUnsupportedImageException",
     "EmoteService",
     "EmoteServiceException",
@@ -34,6 +41,9 @@ __all__ = [
     "MessageService",
     "MessageServiceException",
     "MastodonInstanceDetails",
+    "RoomHistory",
+    "Thumbnail",
     "UserService",
     "UserServiceException",
+    "mediapool",
 ]
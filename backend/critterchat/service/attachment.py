@@ -5,10 +5,19 @@ import mimetypes
 import os
 import pillow_jxl  # noqa: import registers this plugin
 import re
-from PIL import Image, ImageOps
+import tempfile
+from PIL import ExifTags, Image, ImageOps, features
 from pillow_heif import register_heif_opener  # type: ignore
-from typing import Final, Tuple, cast
-
+from pydub import AudioSegment  # type: ignore
+from pydub.exceptions import CouldntDecodeError  # type: ignore
+from typing import Any, Callable, Final, Tuple, TypeVar, cast
+
+from ..common.process import (
+    ProcessPool,
+    ProcessPoolBusyException,
+    ProcessPoolCrashedException,
+    ProcessPoolTimeoutException,
+)
 from ..config import Config
 from ..data import (
     Data,
@@ -49,10 +58,32 @@ class AttachmentServiceInvalidSizeException(AttachmentServiceException):
     pass
 
 
+class AttachmentServiceUnsupportedAudioException(AttachmentServiceException):
+    pass
+
+
+class AttachmentServiceBusyException(AttachmentServiceException):
+    pass
+
+
+class Thumbnail:
+    def __init__(self, height: int, content_type: str, data: bytes) -> None:
+        self.height: Final[int] = height
+        self.content_type: Final[str] = content_type
+        self.data: Final[bytes] = data
+
+
+T = TypeVar("T")
+
+# Decoding and converting uploaded media is CPU heavy, and a hostile upload can make it take a
+# very long time or a huge amount of memory, so it all happens in worker processes instead.
+mediapool: Final[ProcessPool] = ProcessPool(preload=[__name__])
+
+
 _hash_to_id_lut: dict[str, AttachmentID] = {}
 _id_to_hash_lut: dict[AttachmentID, str] = {}
-_thumbhash_to_id_lut: dict[str, AttachmentID] = {}
-_id_to_thumbhash_lut: dict[AttachmentID, str] = {}
+_thumbhash_to_id_lut: dict[str, tuple[AttachmentID, int | None]] = {}
+_id_to_thumbhash_lut: dict[tuple[AttachmentID, int | None], str] = {}
 _emotes_initialized: bool = False
 
 
@@ -74,6 +105,8 @@ class AttachmentService:
         self.__config = config
         self.__data = data
 
+        mediapool.configure(config.media.workers, config.media.timeout, config.media.memory, config.media.queue)
+
         global _emotes_initialized
         if not _emotes_initialized:
             emotes = self.__data.attachment.get_emotes()
@@ -82,9 +115,9 @@ class AttachmentService:
                     # Emotes always have an empty filename, we don't store it.
                     emote.attachmentid, emote.content_type, None,
                 )
-                _id_to_thumbhash_lut[emote.attachmentid] = self._get_hashed_thumbnail_name(
+                _id_to_thumbhash_lut[(emote.attachmentid, None)] = self._get_hashed_thumbnail_name(
                     # Emotes always have an empty filename, we don't store it.
-                    emote.attachmentid, emote.content_type, None,
+                    emote.attachmentid, emote.content_type, None, self._pick_thumbnail(emote.metadata, None),
                 )
 
             _emotes_initialized = True
@@ -97,7 +130,9 @@ class AttachmentService:
                 return self.GENERIC_MIME_TYPE
         else:
             try:
-                return magic.from_buffer(name_or_content, mime=True)
+                return self.__run_media_job(_detect_content_type, name_or_content)
+            except AttachmentServiceBusyException:
+                raise
             except Exception:
                 return self.GENERIC_MIME_TYPE
 
@@ -185,15 +220,60 @@ class AttachmentService:
             ext = "." + ext
 
         # Now, hash the attachment for a unique name and to not expose attachment IDs.
+        return f"{self._get_attachment_hash(aid)}{ext}"
+
+    def _get_attachment_hash(self, aid: AttachmentID) -> str:
         hashkey = self.__config.attachments.attachment_key
         inval = f"{hashkey}-{Attachment.from_id(aid)}"
-        hashval = hashlib.shake_256(inval.encode('utf-8')).hexdigest(20)
-        return f"{hashval}{ext}"
+        return hashlib.shake_256(inval.encode('utf-8')).hexdigest(20)
 
-    def _get_hashed_thumbnail_name(self, aid: AttachmentID, content_type: str, original_filename: str | None) -> str:
+    def _get_hashed_thumbnail_name(
+        self,
+        aid: AttachmentID,
+        content_type: str,
+        original_filename: str | None,
+        thumbnail: tuple[int, str] | None = None,
+    ) -> str:
+        if thumbnail is not None:
+            # Each size gets its own file named after the attachment's hash, using the thumbnail's own type.
+            height, thumbnail_type = thumbnail
+            return f"{self.THUMBNAIL_PREFIX}{height}_{self._get_attachment_hash(aid)}{self.get_extension(thumbnail_type)}"
+
+        # Attachments from before we made multiple sizes have a single thumbnail named after the attachment.
         hashed_name = self._get_hashed_attachment_name(aid, content_type, original_filename)
         return f"{self.THUMBNAIL_PREFIX}{hashed_name}"
 
+    def _get_thumbnails(self, metadata: dict[MetadataType, object]) -> list[tuple[int, str]]:
+        thumbnails = metadata.get(MetadataType.THUMBNAILS)
+        if not isinstance(thumbnails, list):
+            return []
+
+        return sorted(
+            (int(t["height"]), str(t["content_type"]))
+            for t in thumbnails
+            if isinstance(t, dict) and "height" in t and "content_type" in t
+        )
+
+    def _pick_thumbnail(self, metadata: dict[MetadataType, object], height: int | None) -> tuple[int, str] | None:
+        """
+        Given an attachment's metadata, return the smallest thumbnail that is at least as tall as
+        the requested height, or the largest one if none are or no height was requested. Returns
+        None for attachments that only have the single thumbnail from before we made multiple sizes.
+        """
+        thumbnails = self._get_thumbnails(metadata)
+        if not thumbnails:
+            return None
+
+        if height is not None:
+            for thumbnail in thumbnails:
+                if thumbnail[0] >= height:
+                    return thumbnail
+        return thumbnails[-1]
+
+    def get_preview_height(self, count: int) -> int:
+        # Clients show a lone image as a large preview and anything else as a row of small ones.
+        return self.MAX_LARGE_PREVIEW_HEIGHT if count == 1 else self.MAX_SMALL_PREVIEW_HEIGHT
+
     def _get_local_attachment_path(self, aid: AttachmentID, content_type: str, original_filename: str | None) -> str:
         directory = self.__config.attachments.directory
         if not directory:
@@ -201,12 +281,18 @@ class AttachmentService:
 
         return os.path.join(directory, self._get_hashed_attachment_name(aid, content_type, original_filename))
 
-    def _get_local_thumbnail_path(self, aid: AttachmentID, content_type: str, original_filename: str | None) -> str:
+    def _get_local_thumbnail_path(
+        self,
+        aid: AttachmentID,
+        content_type: str,
+        original_filename: str | None,
+        thumbnail: tuple[int, str] | None = None,
+    ) -> str:
         directory = self.__config.attachments.directory
         if not directory:
             raise AttachmentServiceException("Cannot find directory for local attachment storage!")
 
-        return os.path.join(directory, self._get_hashed_thumbnail_name(aid, content_type, original_filename))
+        return os.path.join(directory, self._get_hashed_thumbnail_name(aid, content_type, original_filename, thumbnail))
 
     def create_default_attachments(self) -> None:
         for aid, default in [
@@ -379,8 +465,7 @@ class AttachmentService:
                         except Exception:
                             raise AttachmentServiceUnsupportedImageException(f"Unsupported image provided for {attachment.id}.")
 
-                        transposed = ImageOps.exif_transpose(img)
-                        width, height = transposed.size
+                        width, height = _get_image_size(img)
                         self.__data.attachment.update_attachment_metadata(
                             attachment.id,
                             {MetadataType.WIDTH: width, MetadataType.HEIGHT: height},
@@ -418,31 +503,32 @@ class AttachmentService:
             # Unknown backend, throw since we have no known migrations.
             raise AttachmentServiceException("Unrecognized backend system!")
 
-    def id_from_path(self, path: str) -> Tuple[AttachmentID | None, bool]:
+    def id_from_path(self, path: str) -> Tuple[AttachmentID | None, bool, int | None]:
         """
         Given an attachment path, returns the attachment's ID as well as whether the path
-        represents a thumbnail or a regular attachment.
+        represents a thumbnail or a regular attachment. For thumbnails, also returns which
+        height was asked for, or None for the single thumbnail older attachments have.
         """
 
         path = path.rsplit("/", 1)[-1]
 
         if path == Attachment.from_id(DefaultAvatarID):
-            return DefaultAvatarID, False
+            return DefaultAvatarID, False, None
         if path == Attachment.from_id(DefaultRoomID):
-            return DefaultRoomID, False
+            return DefaultRoomID, False, None
         if path == Attachment.from_id(FaviconID):
-            return FaviconID, False
+            return FaviconID, False, None
         if path == self.THUMBNAIL_PREFIX + Attachment.from_id(DefaultAvatarID):
-            return DefaultAvatarID, True
+            return DefaultAvatarID, True, None
         if path == self.THUMBNAIL_PREFIX + Attachment.from_id(DefaultRoomID):
-            return DefaultRoomID, True
+            return DefaultRoomID, True, None
         if path == self.THUMBNAIL_PREFIX + Attachment.from_id(FaviconID):
-            return FaviconID, True
+            return FaviconID, True, None
 
         if path in _hash_to_id_lut:
-            return (_hash_to_id_lut[path], False)
+            return _hash_to_id_lut[path], False, None
         if path in _thumbhash_to_id_lut:
-            return (_thumbhash_to_id_lut[path], True)
+            return _thumbhash_to_id_lut[path][0], True, _thumbhash_to_id_lut[path][1]
 
         attachments = self.__data.attachment.get_attachments()
         for attachment in attachments:
@@ -451,16 +537,18 @@ class AttachmentService:
             _id_to_hash_lut[attachment.id] = calculated
 
             calculated = self._get_hashed_thumbnail_name(attachment.id, attachment.content_type, attachment.original_filename)
-            _thumbhash_to_id_lut[calculated] = attachment.id
-            _id_to_thumbhash_lut[attachment.id] = calculated
+            _thumbhash_to_id_lut[calculated] = (attachment.id, None)
+            for thumbnail in self._get_thumbnails(attachment.metadata):
+                calculated = self._get_hashed_thumbnail_name(attachment.id, attachment.content_type, attachment.original_filename, thumbnail)
+                _thumbhash_to_id_lut[calculated] = (attachment.id, thumbnail[0])
 
         actual = _hash_to_id_lut.get(path)
         if actual:
-            return actual, False
-        actual = _thumbhash_to_id_lut.get(path)
-        if actual:
-            return actual, True
-        return None, False
+            return actual, False, None
+        thumbnail_actual = _thumbhash_to_id_lut.get(path)
+        if thumbnail_actual:
+            return thumbnail_actual[0], True, thumbnail_actual[1]
+        return None, False, None
 
     def create_attachment(
         self,
@@ -542,7 +630,7 @@ class AttachmentService:
             # Unknown backend, throw.
             raise AttachmentServiceException("Unrecognized backend system!")
 
-    def get_thumbnail_data(self, attachmentid: AttachmentID) -> tuple[str, bytes] | None:
+    def get_thumbnail_data(self, attachmentid: AttachmentID, height: int | None = None) -> tuple[str, bytes] | None:
         # Check for default images which aren't stored in the DB.
         if attachmentid == DefaultAvatarID or attachmentid == DefaultRoomID or attachmentid == FaviconID:
             if self.__config.attachments.system == "local":
@@ -563,28 +651,41 @@ class AttachmentService:
         if not attachment:
             return None
 
+        # Thumbnails come in a handful of sizes, each with its own type, except for attachments from
+        # before we made multiple sizes, which have a single thumbnail the same type as the attachment.
+        content_type = attachment.content_type
+        thumbnail = None
+        if height is not None:
+            thumbnail = next((t for t in self._get_thumbnails(attachment.metadata) if t[0] == height), None)
+            if thumbnail is None:
+                return None
+            content_type = thumbnail[1]
+
         if attachment.system == "local":
             # Local storage, look up the storage directory and return that data.
-            path = self._get_local_thumbnail_path(attachment.id, attachment.content_type, attachment.original_filename)
+            path = self._get_local_thumbnail_path(attachment.id, attachment.content_type, attachment.original_filename, thumbnail)
             try:
                 with open(path, "rb") as bfp:
-                    print(path)
                     data = bfp.read()
-                return attachment.content_type, data
+                return content_type, data
             except FileNotFoundError:
                 return None
         else:
             # Unknown backend, throw.
             raise AttachmentServiceException("Unrecognized backend system!")
 
-    def put_thumbnail_data(self, attachmentid: AttachmentID, data: bytes) -> None:
+    def put_thumbnail_data(self, attachmentid: AttachmentID, thumbnails: list[Thumbnail]) -> None:
+        if not thumbnails:
+            return
+
         # Check for default images which aren't stored in the DB.
         if attachmentid == DefaultAvatarID or attachmentid == DefaultRoomID or attachmentid == FaviconID:
             if self.__config.attachments.system == "local":
-                # Local storage, look up the storage directory and return that data.
+                # Local storage, look up the storage directory and return that data. These have no
+                # metadata to track sizes with and are only ever shown small, so keep the largest.
                 path = self._get_local_thumbnail_path(attachmentid, self.GENERIC_MIME_TYPE, None)
                 with open(path, "wb") as bfp:
-                    bfp.write(data)
+                    bfp.write(max(thumbnails, key=lambda t: t.height).data)
             else:
                 # Unknown backend, throw.
                 raise AttachmentServiceException("Unrecognized backend system!")
@@ -597,13 +698,32 @@ class AttachmentService:
 
         if attachment.system == "local":
             # Local storage, look up the storage directory and write the data.
-            path = self._get_local_thumbnail_path(attachment.id, attachment.content_type, attachment.original_filename)
-            with open(path, "wb") as bfp:
-                bfp.write(data)
+            for thumbnail in thumbnails:
+                path = self._get_local_thumbnail_path(
+                    attachment.id,
+                    attachment.content_type,
+                    attachment.original_filename,
+                    (thumbnail.height, thumbnail.content_type),
+                )
+                with open(path, "wb") as bfp:
+                    bfp.write(thumbnail.data)
         else:
             # Unknown backend, throw.
             raise AttachmentServiceException("Unrecognized backend system!")
 
+        # Only record the sizes once they're all written, so nobody is ever pointed at a missing file.
+        self.__data.attachment.update_attachment_metadata(
+            attachment.id,
+            {MetadataType.THUMBNAILS: [{"height": t.height, "content_type": t.content_type} for t in thumbnails]},
+        )
+        self._forget_thumbnail_names(attachment.id)
+
+    def _forget_thumbnail_names(self, aid: AttachmentID) -> None:
+        for key in [k for k in _id_to_thumbhash_lut if k[0] == aid]:
+            del _id_to_thumbhash_lut[key]
+        for name in [n for n, k in _thumbhash_to_id_lut.items() if k[0] == aid]:
+            del _thumbhash_to_id_lut[name]
+
     def delete_attachment_data(self, attachmentid: AttachmentID) -> None:
         attachment = self.__data.attachment.lookup_attachment(attachmentid)
         if not attachment:
@@ -616,71 +736,47 @@ class AttachmentService:
                 os.remove(path)
             except FileNotFoundError:
                 pass
-            path = self._get_local_thumbnail_path(attachment.id, attachment.content_type, attachment.original_filename)
-            try:
-                os.remove(path)
-            except FileNotFoundError:
-                pass
+            for thumbnail in [None, *self._get_thumbnails(attachment.metadata)]:
+                path = self._get_local_thumbnail_path(attachment.id, attachment.content_type, attachment.original_filename, thumbnail)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
         else:
             # Unknown backend, throw.
             raise AttachmentServiceException("Unrecognized backend system!")
 
-    def prepare_attachment_image(self, data: bytes, max_width: int | None = None, max_height: int | None = None) -> tuple[bytes, bytes, int, int, bool, str]:
+    def __run_media_job(self, func: Callable[..., T], *args: Any, failure: type[AttachmentServiceException] = AttachmentServiceException) -> T:
         try:
-            img = Image.open(io.BytesIO(data))
-        except Exception:
-            raise AttachmentServiceUnsupportedImageException("Unsupported image provided for attachment.")
-
-        content_type = img.get_format_mimetype()
-        if not content_type:
-            raise AttachmentServiceUnsupportedImageException("Attachment image is an unrecognized format.")
-        content_type = content_type.lower()
-
-        # Now, determine if it is animated, because we want to have thumbnail support for non-animated
-        # images, as well as have the option for low-motion for accessibility.
-        is_animated = getattr(img, "is_animated", False)
-
-        transposed = ImageOps.exif_transpose(img)
-        img.close()
-
-        width, height = transposed.size
-        if max_width is not None and width > max_width:
-            raise AttachmentServiceInvalidSizeException(f"Invalid image size {width}x{height} for attachment.")
-        if max_height is not None and height > max_height:
-            raise AttachmentServiceInvalidSizeException(f"Invalid image size {width}x{height} for attachment.")
-
-        if content_type in self.CONVERTIBLE_IMAGE_TYPES:
-            # We want to convert this to a PNG file so that we can support uploading it.
-            converted = transposed.convert("RGBA")
-            transposed.close()
-
-            converted_array = io.BytesIO()
-            converted.save(converted_array, format='PNG')
-            data = converted_array.getvalue()
-            is_animated = False
-
-            # Re-open so we can use the image we just created in the below stanza for animation detection.
-            converted.close()
-            transposed = Image.open(io.BytesIO(data))
-
-            # We've updated the content type to a PNG now, so reflect that.
-            content_type = "image/png"
-
-        if content_type not in self.SUPPORTED_IMAGE_TYPES:
-            raise AttachmentServiceUnsupportedImageException(f"Attachment image is an unrecognized format {content_type}.")
-
-        # And finally, create a thumbnail to go along with the image.
-        transposed.thumbnail((self.MAX_THUMBNAIL_WIDTH, self.MAX_LARGE_PREVIEW_HEIGHT))
-        thumbnail_bytes = io.BytesIO()
-        thumb = transposed.convert("RGBA")
-        transposed.close()
-
-        thumb.save(thumbnail_bytes, format='PNG')
-        thumb.close()
+            return mediapool.run(func, *args)
+        except ProcessPoolBusyException:
+            raise AttachmentServiceBusyException("Too many uploads are being processed right now, try again later.")
+        except ProcessPoolTimeoutException:
+            raise failure("Took too long to process uploaded media.")
+        except (ProcessPoolCrashedException, MemoryError):
+            raise failure("Ran out of resources processing uploaded media.")
+
+    def prepare_attachment_image(
+        self,
+        data: bytes,
+        max_width: int | None = None,
+        max_height: int | None = None,
+    ) -> tuple[bytes, list[Thumbnail], int, int, bool, str]:
+        return self.__run_media_job(
+            _prepare_attachment_image,
+            data,
+            max_width,
+            max_height,
+            self.__config.media.max_megapixels * 1000 * 1000,
+            self.__config.attachments.thumbnail_heights,
+            self.__config.attachments.thumbnail_format,
+            failure=AttachmentServiceUnsupportedImageException,
+        )
 
-        return data, thumbnail_bytes.getvalue(), width, height, is_animated, content_type
+    def prepare_notification_audio(self, data: bytes) -> bytes:
+        return self.__run_media_job(_prepare_notification_audio, data, failure=AttachmentServiceUnsupportedAudioException)
 
-    def resolve_attachment_preview(self, attachment: Attachment) -> Attachment:
+    def resolve_attachment_preview(self, attachment: Attachment, height: int | None = None) -> Attachment:
         category = self.get_content_category(attachment.mimetype)
         if category == "text":
             # Look up the attachment data itself for the attachment preview.
@@ -693,8 +789,8 @@ class AttachmentService:
                 except Exception:
                     pass
         elif category == "image":
-            # Look up the attachment thumbnail URI.
-            attachment.preview = self.get_thumbnail_url(attachment.id)
+            # Look up the attachment thumbnail URI, sized for how large the client will show it.
+            attachment.preview = self.get_thumbnail_url(attachment.id, height)
 
         return attachment
 
@@ -785,23 +881,29 @@ class AttachmentService:
             room.lmdeficon = self.get_thumbnail_url(room.deficonid)
         return room
 
-    def get_thumbnail_name(self, attachmentid: AttachmentID) -> str:
-        if attachmentid in _id_to_thumbhash_lut:
-            return _id_to_thumbhash_lut[attachmentid]
+    def get_thumbnail_name(self, attachmentid: AttachmentID, height: int | None = None) -> str:
+        key = (attachmentid, height)
+        if key in _id_to_thumbhash_lut:
+            return _id_to_thumbhash_lut[key]
 
         if attachmentid in {DefaultAvatarID, DefaultRoomID, FaviconID}:
-            _id_to_thumbhash_lut[attachmentid] = self._get_hashed_thumbnail_name(attachmentid, self.GENERIC_MIME_TYPE, None)
-            return _id_to_thumbhash_lut[attachmentid]
+            _id_to_thumbhash_lut[key] = self._get_hashed_thumbnail_name(attachmentid, self.GENERIC_MIME_TYPE, None)
+            return _id_to_thumbhash_lut[key]
 
         attachment = self.__data.attachment.lookup_attachment(attachmentid)
         if not attachment:
             # We can't find the attachment, so it's a dangling or invalid ID. Just return the generic
             # filename for the attachment in this case.
-            _id_to_thumbhash_lut[attachmentid] = self._get_hashed_thumbnail_name(attachmentid, self.GENERIC_MIME_TYPE, None)
-            return _id_to_thumbhash_lut[attachmentid]
-
-        _id_to_thumbhash_lut[attachmentid] = self._get_hashed_thumbnail_name(attachment.id, attachment.content_type, attachment.original_filename)
-        return _id_to_thumbhash_lut[attachmentid]
+            _id_to_thumbhash_lut[key] = self._get_hashed_thumbnail_name(attachmentid, self.GENERIC_MIME_TYPE, None)
+            return _id_to_thumbhash_lut[key]
+
+        _id_to_thumbhash_lut[key] = self._get_hashed_thumbnail_name(
+            attachment.id,
+            attachment.content_type,
+            attachment.original_filename,
+            self._pick_thumbnail(attachment.metadata, height),
+        )
+        return _id_to_thumbhash_lut[key]
 
     def get_attachment_name(self, attachmentid: AttachmentID) -> str:
         if attachmentid in _id_to_hash_lut:
@@ -821,12 +923,16 @@ class AttachmentService:
         _id_to_hash_lut[attachmentid] = self._get_hashed_attachment_name(attachment.id, attachment.content_type, attachment.original_filename)
         return _id_to_hash_lut[attachmentid]
 
-    def get_thumbnail_url(self, attachmentid: AttachmentID) -> str:
+    def get_thumbnail_url(self, attachmentid: AttachmentID, height: int | None = None) -> str:
+        """
+        Returns the URL of the smallest thumbnail that is at least the given height, or the
+        largest one when no height is given.
+        """
         prefix = self.__config.attachments.prefix
         while prefix and (prefix[-1] == "/"):
             prefix = prefix[:-1]
 
-        possibly_relative = f"{prefix}/{self.get_thumbnail_name(attachmentid)}"
+        possibly_relative = f"{prefix}/{self.get_thumbnail_name(attachmentid, height)}"
         if possibly_relative.startswith("http://") or possibly_relative.startswith("https://"):
             return possibly_relative
 
@@ -856,3 +962,142 @@ class AttachmentService:
             base = base[:-1]
 
         return f"{base}/{possibly_relative}"
+
+
+# The functions below run on the media pool, so they must stay at module level where workers can find them.
+def _detect_content_type(data: bytes) -> str:
+    return magic.from_buffer(data, mime=True)
+
+
+def _get_image_size(img: Image.Image) -> tuple[int, int]:
+    # Reads the size of the image as displayed from its headers, without decoding any pixels.
+    width, height = img.size
+    if img.getexif().get(ExifTags.Base.Orientation) in {5, 6, 7, 8}:
+        return height, width
+    return width, height
+
+
+def _prepare_attachment_image(
+    data: bytes,
+    max_width: int | None,
+    max_height: int | None,
+    max_pixels: int | None = None,
+    thumbnail_heights: list[int] | None = None,
+    thumbnail_format: str = "webp",
+) -> tuple[bytes, list[Thumbnail], int, int, bool, str]:
+    heights = sorted(set(thumbnail_heights or [
+        AttachmentService.MAX_SMALL_PREVIEW_HEIGHT,
+        AttachmentService.MAX_LARGE_PREVIEW_HEIGHT,
+    ]))
+    if thumbnail_format == "webp" and not features.check("webp"):
+        # Pillow can be built without WebP, in which case PNG is the one format we know we have.
+        thumbnail_format = "png"
+
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise AttachmentServiceInvalidSizeException("Attachment image has too many pixels.")
+    except Exception:
+        raise AttachmentServiceUnsupportedImageException("Unsupported image provided for attachment.")
+
+    content_type = img.get_format_mimetype()
+    if not content_type:
+        raise AttachmentServiceUnsupportedImageException("Attachment image is an unrecognized format.")
+    content_type = content_type.lower()
+    if content_type not in AttachmentService.SUPPORTED_IMAGE_TYPES and content_type not in AttachmentService.CONVERTIBLE_IMAGE_TYPES:
+        raise AttachmentServiceUnsupportedImageException(f"Attachment image is an unrecognized format {content_type}.")
+
+    # Now, determine if it is animated, because we want to have thumbnail support for non-animated
+    # images, as well as have the option for low-motion for accessibility.
+    is_animated = getattr(img, "is_animated", False)
+
+    # Everything up to here only read the image headers, so turn away anything too large before
+    # we commit to decoding it.
+    width, height = _get_image_size(img)
+    if max_width is not None and width > max_width:
+        raise AttachmentServiceInvalidSizeException(f"Invalid image size {width}x{height} for attachment.")
+    if max_height is not None and height > max_height:
+        raise AttachmentServiceInvalidSizeException(f"Invalid image size {width}x{height} for attachment.")
+    if max_pixels is not None and width * height > max_pixels:
+        raise AttachmentServiceInvalidSizeException(f"Invalid image size {width}x{height} for attachment.")
+
+    try:
+        source: Image.Image = img
+        if content_type in AttachmentService.CONVERTIBLE_IMAGE_TYPES:
+            # We want to convert this to a PNG file so that we can support uploading it, which is
+            # the one case where we need every pixel.
+            transposed = ImageOps.exif_transpose(img)
+            img.close()
+            source = transposed.convert("RGBA")
+            transposed.close()
+
+            converted_array = io.BytesIO()
+            source.save(converted_array, format='PNG')
+            data = converted_array.getvalue()
+            is_animated = False
+
+            # We've updated the content type to a PNG now, so reflect that. The thumbnail below
+            # can be made from what we already decoded instead of reading the PNG back in.
+            content_type = "image/png"
+
+        # And finally, create thumbnails to go along with the image, starting with the largest. The
+        # thumbnail is made before rotating, so the bounds are swapped for sideways images. That way,
+        # we never hold a full size rotated copy of a photo just to shrink it.
+        bounds = (AttachmentService.MAX_THUMBNAIL_WIDTH, heights[-1])
+        if (width, height) != source.size:
+            bounds = (bounds[1], bounds[0])
+
+        # JPEG can decode straight to a fraction of its full size, so ask for the smallest one that
+        # is still twice the thumbnail, which is what thumbnail() itself would resample from. It
+        # can't work this out on its own, since it only sees our bounds and not the final size.
+        scale = min(bounds[0] / source.width, bounds[1] / source.height)
+        if scale < 1.0:
+            source.draft(None, (int(source.width * scale * 2), int(source.height * scale * 2)))
+
+        source.thumbnail(bounds)
+        transposed = ImageOps.exif_transpose(source)
+        source.close()
+    except (Image.DecompressionBombError, MemoryError):
+        raise AttachmentServiceInvalidSizeException(f"Invalid image size {width}x{height} for attachment.")
+    except (OSError, ValueError):
+        raise AttachmentServiceUnsupportedImageException("Attachment image is truncated or corrupt.")
+
+    thumb = transposed.convert("RGBA")
+    transposed.close()
+
+    # Every smaller size is shrunk from the one before it, which is far cheaper than going back to
+    # the original. WebP previews are a fraction of the size of PNG ones, so rooms full of images
+    # load with a lot less data.
+    thumbnails: list[Thumbnail] = []
+    for thumbnail_height in reversed(heights):
+        thumb.thumbnail((AttachmentService.MAX_THUMBNAIL_WIDTH, thumbnail_height))
+
+        thumbnail_bytes = io.BytesIO()
+        if thumbnail_format == "webp":
+            thumb.save(thumbnail_bytes, format='WEBP', quality=80, method=4)
+            thumbnails.append(Thumbnail(thumbnail_height, "image/webp", thumbnail_bytes.getvalue()))
+        else:
+            thumb.save(thumbnail_bytes, format='PNG')
+            thumbnails.append(Thumbnail(thumbnail_height, "image/png", thumbnail_bytes.getvalue()))
+    thumb.close()
+
+    return data, thumbnails[::-1], width, height, is_animated, content_type
+
+
+def _prepare_notification_audio(data: bytes) -> bytes:
+    try:
+        with tempfile.NamedTemporaryFile(delete_on_close=False) as fp1:
+            fp1.write(data)
+            fp1.close()
+
+            segment = AudioSegment.from_file(fp1.name)
+
+            with tempfile.NamedTemporaryFile(delete_on_close=False) as fp2:
+                fp2.close()
+
+                segment.export(fp2.name, format="mp3")
+
+                with open(fp2.name, "rb") as bfp:
+                    return bfp.read()
+    except CouldntDecodeError as e:
+        raise AttachmentServiceUnsupportedAudioException(f"Unsupported audio provided for notification: {e}")
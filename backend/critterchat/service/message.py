@@ -1,4 +1,4 @@
-from typing import Final, Literal, cast
+from typing import Final, Literal
 
 from ..config import Config
 from ..common import Time, emojize, represents_real_text
@@ -9,6 +9,7 @@ from ..data import (
     Attachment,
     Invite,
     InvitePrivacy,
+    Migration,
     Occupant,
     Room,
     RoomPurpose,
@@ -18,7 +19,6 @@ from ..data import (
     DefaultAvatarID,
     DefaultRoomID,
     FaviconID,
-    NewOccupantID,
     NewActionID,
     NewRoomID,
     NewUserID,
@@ -38,10 +38,18 @@ class MessageServiceException(Exception):
     pass
 
 
-class MessageService:
-    # Maximum number of displayable events we pull on first load of a chat.
-    MAX_HISTORY: Final[int] = 100
+class RoomHistory:
+    def __init__(self, actions: list[Action], more_before: bool, more_after: bool, newest_action: ActionID | None) -> None:
+        self.actions = actions
+        self.more_before = more_before
+        self.more_after = more_after
+
+        # The room's newest action of any type as of before the history was read, which can be
+        # newer than anything in actions since not every action type is sent as history.
+        self.newest_action = newest_action
+
 
+class MessageService:
     # Number of seconds in which only the inviter can cancel an invite.
     INVITE_SELF_CANCEL_GRACE_PERIOD_SECONDS: Final[int] = Time.SECONDS_IN_DAY * 3
 
@@ -61,6 +69,34 @@ class MessageService:
         # Don't check for whether this migration ran, we want it to run every restart.
         pass
 
+    def migrate_room_action_ids(self) -> None:
+        """
+        Rooms used to compute their oldest and newest action on every lookup and now carry
+        them as columns maintained on insert, so fill them in for existing rooms once.
+        """
+
+        if Migration.ROOM_ACTION_IDS in self.__data.migration.get_migrations():
+            return
+
+        self.__data.room.backfill_action_ids()
+
+        # Mark that we did this migration so we never run it again.
+        self.__data.migration.flag_migrated(Migration.ROOM_ACTION_IDS)
+
+    def migrate_reactions(self) -> None:
+        """
+        Reactions used to be stored inside each message's details and now live in their own
+        table, so move any existing reactions over once.
+        """
+
+        if Migration.REACTION_TABLE in self.__data.migration.get_migrations():
+            return
+
+        self.__data.room.backfill_reactions()
+
+        # Mark that we did this migration so we never run it again.
+        self.__data.migration.flag_migrated(Migration.REACTION_TABLE)
+
     def _resolve_attachments(self, actions: list[Action]) -> list[Action]:
         ids = {a.id for a in actions}
         if not ids:
@@ -69,6 +105,7 @@ class MessageService:
         actionmap = self.__data.attachment.get_action_attachments(ids)
         for action in actions:
             actionattachments = actionmap[action.id]
+            height = self.__attachments.get_preview_height(len(actionattachments))
 
             attachments: list[Attachment] = []
             for actionattachment in actionattachments:
@@ -80,34 +117,76 @@ class MessageService:
                             actionattachment.content_type,
                             actionattachment.metadata,
                             filename=actionattachment.original_filename,
-                        )
+                        ),
+                        height,
                     )
                 )
             action.attachments = attachments
         return actions
 
-    def get_last_action(self) -> ActionID | None:
-        return self.__data.room.get_last_action()
-
-    def get_room_history(self, roomid: RoomID, before: ActionID | None = None) -> list[Action]:
+    def get_room_history(
+        self,
+        roomid: RoomID,
+        before: ActionID | None = None,
+        after: ActionID | None = None,
+        around: ActionID | None = None,
+        limit: int | None = None,
+    ) -> RoomHistory:
         room = self.__data.room.get_room(roomid)
         if not room:
-            return []
+            return RoomHistory([], False, False, None)
+
+        # Clients may ask for smaller pages, but never for more than we're willing to send.
+        maximum = self.__config.limits.history_length
+        limit = maximum if limit is None else max(1, min(limit, maximum))
 
         # We intentionally over-fetch joins/leaves for DMs here, because the "load more history"
         # component needs to know if there's any more history, and it does that by comparing
         # its own list of events to the oldest event to see if there's anything more to load. If
         # we filter out the first events (a join in every case) for DMs, it never knows to stop
         # showing the load more indicator.
-        history = self.__data.room.get_room_history(
-            room.id,
-            before=before,
-            types=ActionType.unread_types(),
-            limit=self.MAX_HISTORY,
-        )
+        types = ActionType.unread_types()
+
+        older: list[Action] = []
+        newer: list[Action] = []
+        older_limit = 0
+        newer_limit = 0
+        if around is not None:
+            # Split the page around the anchor, keeping the anchor itself on the older side.
+            newer_limit = limit // 2
+            older_limit = limit - newer_limit
+            older = self.__data.room.get_room_history(room.id, before=ActionID(around + 1), types=types, limit=older_limit + 1)
+            if newer_limit:
+                newer = self.__data.room.get_room_history(room.id, after=around, types=types, limit=newer_limit + 1)
+        elif after is not None:
+            newer_limit = limit
+            newer = self.__data.room.get_room_history(room.id, after=after, types=types, limit=newer_limit + 1)
+        else:
+            older_limit = limit
+            older = self.__data.room.get_room_history(room.id, before=before, types=types, limit=older_limit + 1)
+
+        # Each side is fetched with one extra action, so that we know whether there's anything past
+        # either end of the page without clients needing to make an extra request to find out they're
+        # done. Both sides are newest first, so the extra action is the one furthest from the anchor.
+        if older_limit:
+            more_before = len(older) > older_limit
+            older = older[:older_limit]
+        else:
+            # Only paging forwards skips the older side, and the anchor itself counts as older.
+            more_before = after is not None and self.__data.room.has_room_history(room.id, before=ActionID(after + 1), types=types)
+
+        if newer_limit:
+            more_after = len(newer) > newer_limit
+            newer = newer[-newer_limit:]
+        elif around is not None:
+            more_after = self.__data.room.has_room_history(room.id, after=around, types=types)
+        else:
+            more_after = before is not None and self.__data.room.has_room_history(room.id, after=ActionID(before - 1), types=types)
+
+        history = newer + older
         history = self._resolve_attachments(history)
         history = [self.__attachments.resolve_action_icon(e) for e in history]
-        return history
+        return RoomHistory(history, more_before, more_after, room.newest_action)
 
     def get_room_updates(self, roomid: RoomID, after: ActionID) -> list[Action]:
         history = self.__data.room.get_room_history(roomid, after=after, types=ActionType.update_types())
@@ -135,25 +214,31 @@ class MessageService:
         if not room:
             raise MessageServiceException("You cannot message a room that does not exist!")
 
-        # Now, make sure the user adding to the room is here and not muted.
-        occupants = self.__data.room.get_room_occupants(room.id, include_left=room.purpose == RoomPurpose.DIRECT_MESSAGE)
-        for occupant in occupants:
-            if occupant.userid == userid:
-                if occupant.muted:
-                    raise MessageServiceException("You are muted!")
-                break
+        # Now, make sure the user adding to the room is here and not muted. Only DMs need everyone
+        # in the room, since both sides get rejoined below.
+        occupants: list[Occupant] = []
+        occupant: Occupant | None = None
+        if room.purpose == RoomPurpose.DIRECT_MESSAGE:
+            occupants = self.__data.room.get_room_occupants(room.id, include_left=True)
+            for other in occupants:
+                if other.userid == userid:
+                    occupant = other
+                    break
         else:
+            occupant = self.__data.room.get_room_occupant_for_user(room.id, userid)
+            if occupant and not occupant.present:
+                occupant = None
+
+        if occupant is None:
             raise MessageServiceException("You cannot message a room that you are not a member of!")
+        if occupant.muted:
+            raise MessageServiceException("You are muted!")
 
         # Now that we've passed checks, ensure that DMs re-open when messaging the other user again.
-        self.rejoin_direct_message(roomid)
-
-        occupant = Occupant(
-            occupantid=NewOccupantID,
-            userid=userid,
-        )
+        if occupants:
+            self.__rejoin_occupants(room, occupants)
 
-        messagedata: dict[str, object] = {"message": message, "reactions": {}}
+        messagedata: dict[str, object] = {"message": message}
         if sensitive:
             messagedata["sensitive"] = True
 
@@ -179,33 +264,35 @@ class MessageService:
 
             attachmentids.append(adata.id)
             response_attachments.append(
-                self.__attachments.resolve_attachment_preview(
-                    Attachment(
-                        adata.id,
-                        self.__attachments.get_attachment_url(adata.id),
-                        adata.content_type,
-                        adata.metadata,
-                        filename=adata.original_filename,
-                    )
+                Attachment(
+                    adata.id,
+                    self.__attachments.get_attachment_url(adata.id),
+                    adata.content_type,
+                    adata.metadata,
+                    filename=adata.original_filename,
                 )
             )
 
         if len(attachmentids) != len(response_attachments):
             raise Exception("Logic error, mismatched message attachment structures!")
 
+        # Previews can only be sized once we know how many attachments made it through.
+        height = self.__attachments.get_preview_height(len(response_attachments))
+        for response_attachment in response_attachments:
+            self.__attachments.resolve_attachment_preview(response_attachment, height)
+
         if not (represents_real_text(message) or attachmentids):
             raise MessageServiceException("You're trying to send an empty message!")
 
-        # Locking a bunch of tables is expensive, so only do it when we really need to be atomic.
+        # Only lock the room when we really need the action and its attachments to show up together.
         if attachmentids:
-            with self.__data.room.lock_actions():
-                self.__data.room.insert_action(roomid, action)
+            with self.__data.room.lock_room(roomid):
+                self.__data.room.insert_action(roomid, action, room=room)
 
-                with self.__data.attachment.lock_action_attachments():
-                    for attachmentid in attachmentids:
-                        self.__data.attachment.link_action_attachment(action.id, attachmentid)
+                for attachmentid in attachmentids:
+                    self.__data.attachment.link_action_attachment(action.id, attachmentid)
         else:
-            self.__data.room.insert_action(roomid, action)
+            self.__data.room.insert_action(roomid, action, room=room)
 
         action.attachments = response_attachments
         if action.id is not NewActionID:
@@ -246,91 +333,41 @@ class MessageService:
         if not self.validate_reaction(reaction):
             return
 
-        with self.__data.room.lock_actions():
-            # Grab the action that we're about to modify.
-            action = self.__data.room.get_action(actionid)
-            if not action:
-                raise MessageServiceException("You cannot react to a nonexistent message!")
-
-            # Make sure we're allowed to add a reaction to the message.
-            if action.action not in {ActionType.MESSAGE} or not action.occupant:
-                raise MessageServiceException("You cannot react to something that isn't a message!")
-
-            # Now, make sure the room is valid.
-            room = self.__data.room.get_occupant_room(action.occupant.id)
-            if not room:
-                raise MessageServiceException("You cannot react to a message in a nonexistent room!")
-
-            # And, make sure the user adding to the room is here and not muted.
-            occupants = self.__data.room.get_room_occupants(room.id)
-            myself: Occupant
-            for occupant in occupants:
-                if occupant.userid == userid:
-                    myself = occupant
-                    if occupant.muted:
-                        raise MessageServiceException("You are muted!")
-                    break
-            else:
-                raise MessageServiceException("You cannot react to a message in a room that you are not a member of!")
-
-            # Alright. Now, let's actually modify the reaction table. We store reactions keyed by
-            # the reaction itself, and instead of just a count the value is the list of occupants that
-            # reacted to that message with that reaction. That way, clients can show who reacted
-            # with what and you can remove reactions that you'd added previously.
-            reactions = cast(dict[str, list[OccupantID]], action.details.get("reactions", {}))
-            ordering = cast(list[str], action.details.get("reactions_order", []))
-            for er in reactions:
-                if er not in ordering:
-                    ordering.append(er)
-
-            modified = False
-            if reaction not in reactions:
-                if delta == "add":
-                    # We're adding, so that's easy.
-                    reactions[reaction] = [myself.id]
-                    ordering.append(reaction)
-                    modified = True
-
-            else:
-                existing = reactions[reaction]
-                if delta == "add":
-                    # Only modify if we don't already have this reaction.
-                    if occupant.id not in existing:
-                        existing.append(occupant.id)
-                        modified = True
-
-                else:
-                    # Only modify if we already have this reaction.
-                    if occupant.id in existing:
-                        existing = [e for e in existing if e != occupant.id]
-                        modified = True
-
-                if existing:
-                    reactions[reaction] = existing
-                else:
-                    del reactions[reaction]
-
-            # Always make sure the ordering doesn't include reactions that don't exist.
-            ordering = [o for o in ordering if o in reactions]
-
-            if modified:
-                # Finally, if we actually modified a reaction, then save it and generate an
-                # action for updating clients.
-                action.details["reactions"] = reactions
-                action.details["reactions_order"] = ordering
-                self.__data.room.update_action(action)
-
-                # Generate the action that says we modified a message.
-                action = Action(
-                    actionid=NewActionID,
-                    timestamp=Time.now(),
-                    occupant=myself,
-                    action=ActionType.CHANGE_MESSAGE,
-                    # For this action, the details will be filled in at look-up time.
-                    details={"actionid": action.id, "edited": ["reactions"], delta: reaction},
-                )
+        # Make sure we're allowed to add a reaction to the message.
+        found = self.__data.room.get_action_room(actionid)
+        if not found:
+            raise MessageServiceException("You cannot react to a nonexistent message!")
+        actiontype, roomid = found
+        if actiontype != ActionType.MESSAGE:
+            raise MessageServiceException("You cannot react to something that isn't a message!")
+
+        # And, make sure the user adding to the room is here and not muted.
+        myself = self.__data.room.get_room_occupant_for_user(roomid, userid)
+        if not myself or not myself.present:
+            raise MessageServiceException("You cannot react to a message in a room that you are not a member of!")
+        if myself.muted:
+            raise MessageServiceException("You are muted!")
+
+        # Alright. Now, let's actually modify the reaction table. Each occupant's reaction is its own
+        # row, so this never has to touch the message itself and concurrent reactions can't clobber
+        # each other. If nothing actually changed, there's nothing to tell clients about either.
+        if delta == "add":
+            modified = self.__data.room.add_reaction(actionid, reaction, myself.id)
+        else:
+            modified = self.__data.room.remove_reaction(actionid, reaction, myself.id)
+
+        if modified:
+            # Generate the action that tells clients about just this one change, so that they can
+            # apply it to the message they already have instead of being sent the whole message again.
+            action = Action(
+                actionid=NewActionID,
+                timestamp=Time.now(),
+                occupant=myself,
+                action=ActionType.CHANGE_REACTION,
+                details={"actionid": actionid, delta: reaction},
+            )
 
-                self.__data.room.insert_action(room.id, action)
+            self.__data.room.insert_action(roomid, action)
 
     def lookup_occupant(self, occupantid: OccupantID, userid: UserID) -> User | None:
         occupant = self.__data.room.get_room_occupant(occupantid)
@@ -492,15 +529,22 @@ class MessageService:
         self.__data.room.unmute_room_occupant(room.id, user.id)
 
     def __infer_room_info(self, userid: UserID, room: Room) -> None:
+        self.__infer_rooms_info(userid, [room])
+
+    def __infer_rooms_info(self, userid: UserID, rooms: list[Room]) -> None:
+        # Every room purpose wants left occupants (which includes invited ones), so grab occupants
+        # for the whole list at once instead of once per room.
+        occupants_by_room = self.__data.room.get_room_occupants_for_rooms([r.id for r in rooms], include_left=True)
+        for room in rooms:
+            self.__infer_room_info_from(userid, room, occupants_by_room.get(room.id, []))
+
+    def __infer_room_info_from(self, userid: UserID, room: Room, occupants: list[Occupant]) -> None:
         if room.purpose == RoomPurpose.ROOM:
             room_name = "Unnamed Public Room"
-            occupants = self.__data.room.get_room_occupants(room.id, include_left=True, include_invited=True)
         elif room.purpose == RoomPurpose.CHAT:
             room_name = "Unnamed Private Conversation"
-            occupants = self.__data.room.get_room_occupants(room.id, include_left=True, include_invited=True)
         else:
             # Figure out how many people are in the direct message, name it after them.
-            occupants = self.__data.room.get_room_occupants(room.id, include_left=True)
             if not occupants:
                 # This shouldn't happen, since we would have to be the sole occupant,
                 # but I guess there could be a race between grabbing the rooms and occupants,
@@ -575,16 +619,14 @@ class MessageService:
 
     def create_direct_message(self, userid: UserID, otherid: UserID) -> Room:
         # First, find all rooms that the first user is in or was ever in.
-        rooms = self.__data.room.get_joined_rooms(userid, include_left=True)
+        # Private chats never can go to a public room or a group chat even if that only has
+        # the two of you chatting.
+        rooms = [r for r in self.__data.room.get_joined_rooms(userid, include_left=True) if r.purpose == RoomPurpose.DIRECT_MESSAGE]
+        occupants_by_room = self.__data.room.get_room_occupants_for_rooms([r.id for r in rooms], include_left=True)
 
         # Now, for each of these, see if the only ones in the room are the two IDs.
         for room in rooms:
-            if room.purpose != RoomPurpose.DIRECT_MESSAGE:
-                # Private chats never can go to a public room or a group chat even
-                # if that only has the two of you chatting.
-                continue
-
-            occupants = self.__data.room.get_room_occupants(room.id, include_left=True)
+            occupants = occupants_by_room.get(room.id, [])
             desired = {userid, otherid}
             if len(desired) == len(occupants):
                 for occupant in occupants:
@@ -611,11 +653,15 @@ class MessageService:
         if room is None or room.purpose != RoomPurpose.DIRECT_MESSAGE:
             return
 
-        # Join all occupants including left occupants to the room so they can receive
-        # an incoming message.
-        occupants = self.__data.room.get_room_occupants(room.id, include_left=True)
+        self.__rejoin_occupants(room, self.__data.room.get_room_occupants(room.id, include_left=True))
+
+    def __rejoin_occupants(self, room: Room, occupants: list[Occupant]) -> None:
+        # Join all left occupants back to the room so they can receive an incoming message. Anyone
+        # still in the room doesn't need touching.
         for occupant in occupants:
-            self.__data.room.join_room(room.id, occupant.userid)
+            if not occupant.present:
+                self.__data.room.join_room(room.id, occupant.userid)
+                occupant.present = True
 
     def lookup_room(self, roomid: RoomID, userid: UserID) -> Room | None:
         room = self.__data.room.get_room(roomid)
@@ -823,12 +869,6 @@ class MessageService:
         if changed:
             self.__data.room.update_room(room, userid)
 
-    def get_last_invite_update(self) -> tuple[int, int] | None:
-        return self.__data.room.get_last_invite_update()
-
-    def has_updated_invites(self, userid: UserID, last_checked: int, last_length: int) -> bool:
-        return self.__data.room.has_updated_invites(userid, last_checked, last_length)
-
     def invite_to_room(self, roomid: RoomID, inviter: UserID, invited: UserID) -> None:
         room = self.__data.room.get_room(roomid)
         if room is None:
@@ -914,19 +954,25 @@ class MessageService:
 
     def get_invited_rooms(self, userid: UserID) -> list[Invite]:
         invites = self.__data.room.get_room_invites(userid)
+        rooms: list[Room] = []
         for invite in invites:
             invite.user = self.__user.lookup_user(invite.userid)
             if invite.room is None:
                 raise Exception("Logic error, rooms should exist when looking up invites directly!")
-            self.__infer_room_info(userid, invite.room)
+            rooms.append(invite.room)
+        self.__infer_rooms_info(userid, rooms)
         return invites
 
+    def get_joined_room_ids(self, userid: UserID) -> set[RoomID]:
+        # Cheap membership check for when we don't need any of the room details.
+        occupancy = self.__data.room.get_joined_room_occupants(userid)
+        return {roomid for roomid, occupant in occupancy.items() if occupant.present}
+
     def get_joined_rooms(self, userid: UserID) -> list[Room]:
         rooms = self.__data.room.get_joined_rooms(userid)
 
         # Figure out any rooms that don't have a set name, and infer the name of the room.
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
 
         return sorted(rooms, key=lambda r: r.last_action_timestamp, reverse=True)
 
@@ -934,8 +980,7 @@ class MessageService:
         rooms = self.__data.room.get_autojoin_rooms()
 
         # Figure out any rooms that don't have a set name, and infer the name of the room.
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
 
         return sorted(rooms, key=lambda r: r.name)
 
@@ -946,8 +991,7 @@ class MessageService:
 
     def get_public_rooms(self, userid: UserID) -> list[Room]:
         rooms = self.__data.room.get_public_rooms()
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
         return rooms
 
     def get_matching_rooms(self, userid: UserID, *, name: str | None = None) -> list[SearchResult]:
@@ -965,8 +1009,7 @@ class MessageService:
         rooms = [val for _, val in rooms_by_id.items()]
 
         # Figure out any rooms that don't have a set name, and infer the name of the room.
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
 
         # Now, filter out any rooms that still don't meet our criteria.
         if name:
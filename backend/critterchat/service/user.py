@@ -1,3 +1,6 @@
+import logging
+from typing import Final
+
 from ..common import Time, represents_real_text
 from ..config import Config
 from ..data import (
@@ -15,6 +18,7 @@ from ..data import (
     FaviconID,
     NewActionID,
     NewOccupantID,
+    NewRoomID,
     NewUserID,
     ActionID,
     AttachmentID,
@@ -26,15 +30,24 @@ from ..data import (
     AdminControls,
     SearchPrivacy,
     InvitePrivacy,
+    Migration,
+    PoolBusyException,
+    lastseenbuffer,
 )
 from .attachment import AttachmentService
 
 
+logger = logging.getLogger(__name__)
+
+
 class UserServiceException(Exception):
     pass
 
 
 class UserService:
+    # Shown whenever there are too many passwords waiting to be hashed to take on another one.
+    BUSY_MESSAGE: Final[str] = "The server is busy right now, please try again in a moment!"
+
     def __init__(self, config: Config, data: Data) -> None:
         self.__config = config
         self.__data = data
@@ -55,8 +68,21 @@ class UserService:
                 self.__data.user.update_user(user)
                 self.__notify_user_changed(user.id)
 
-    def get_last_user_update(self) -> int | None:
-        return self.__data.user.get_last_user_update()
+    def migrate_unread_counts(self) -> None:
+        """
+        Unread counts used to be computed on the fly and are now maintained as actions are
+        written, so fill in the starting counts for everyone the first time we run.
+        """
+
+        if Migration.UNREAD_COUNTS in self.__data.migration.get_migrations():
+            return
+
+        users = self.__data.user.get_users()
+        for user in users:
+            self.__data.user.rebuild_unread_counts(user.id)
+
+        # Mark that we did this migration so we never run it again.
+        self.__data.migration.flag_migrated(Migration.UNREAD_COUNTS)
 
     def get_settings(self, session: str, userid: UserID) -> UserSettings:
         settings = self.__data.user.get_settings(session)
@@ -189,12 +215,12 @@ class UserService:
         # And persist!
         self.__data.user.put_preferences(prefs)
 
-    def has_updated_preferences(self, userid: UserID, last_checked: int) -> bool:
-        return self.__data.user.has_updated_preferences(userid, last_checked)
-
     def create_user(self, username: str, password: str) -> User:
         # First, try to create the actual account.
-        user = self.__data.user.create_account(username, password)
+        try:
+            user = self.__data.user.create_account(username, password)
+        except PoolBusyException:
+            raise UserServiceException(self.BUSY_MESSAGE)
         if not user:
             raise UserServiceException("Username already exists, please choose another!")
 
@@ -216,6 +242,19 @@ class UserService:
 
         return self.__data.requestcache.users[userid]
 
+    def lookup_users(self, userids: list[UserID]) -> dict[UserID, User | None]:
+        missing = [u for u in set(userids) if u not in self.__data.requestcache.users]
+        if missing:
+            users = self.__data.user.get_users_by_id(missing)
+            for userid in missing:
+                user = users.get(userid)
+                if user:
+                    self.__attachments.resolve_user_icon(user)
+
+                self.__data.requestcache.users[userid] = user
+
+        return {userid: self.__data.requestcache.users[userid] for userid in userids}
+
     def find_user(self, username: str) -> User | None:
         # Just try to find the user by username, returning that.
         user = self.__data.user.from_username(username)
@@ -286,7 +325,10 @@ class UserService:
             raise UserServiceException("User does not exist in the database!")
 
         # Now, update the password for the user.
-        self.__data.user.update_password(user.id, password)
+        try:
+            self.__data.user.update_password(user.id, password)
+        except PoolBusyException:
+            raise UserServiceException(self.BUSY_MESSAGE)
 
     def create_user_recovery(self, userid: UserID) -> str:
         # First, ensure the user existis so we can get the ID of the user.
@@ -330,7 +372,10 @@ class UserService:
             raise UserServiceException("Recovery URL is not for your account!")
 
         # Now, update the password since the checks passed.
-        self.__data.user.update_password(user.id, password)
+        try:
+            self.__data.user.update_password(user.id, password)
+        except PoolBusyException:
+            raise UserServiceException(self.BUSY_MESSAGE)
 
         # Finally, return that user.
         return user
@@ -362,9 +407,6 @@ class UserService:
             )
             self.__data.room.insert_action(roomid, action)
 
-    def has_updated_user(self, userid: UserID, last_checked: int) -> bool:
-        return self.__data.user.has_updated_user(userid, last_checked)
-
     def add_permission(self, userid: UserID, permission: UserPermission) -> None:
         user = self.__data.user.get_user(userid)
         if not user:
@@ -414,12 +456,55 @@ class UserService:
             self.__data.room.insert_action(room.id, action)
 
     def mark_last_seen(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
-        self.__data.user.mark_last_seen(userid, roomid, actionid)
+        # This is only remembered in memory until the next call to flush_last_seen(). Reads
+        # below take anything pending into account, so badges stay correct in the meantime.
+        if userid == NewUserID or roomid == NewRoomID or actionid == NewActionID:
+            return
+
+        lastseenbuffer.mark(userid, roomid, actionid)
+
+    def flush_last_seen(self, *, force: bool = False) -> None:
+        """
+        Write out any read state remembered by mark_last_seen() in one go. Unless forced, this
+        only writes once per configured flush interval, so it is safe to call as often as we like.
+        """
+
+        pending = lastseenbuffer.take(force=force)
+        if not pending:
+            return
+
+        try:
+            self.__data.user.mark_last_seen_many({
+                (userid, roomid): actionid
+                for userid, rooms in pending.items()
+                for roomid, actionid in rooms.items()
+            })
+        except Exception as e:
+            # Put everything back so that a DB hiccup doesn't lose anything, keeping anything newer
+            # that came in while we were trying to write. This runs on the message pump, so don't let
+            # the failure escape and take the pump down with it, just try again on the next flush.
+            logger.error(f"Failed to write out read state for {len(pending)} users, will retry: {e}")
+            lastseenbuffer.restore(pending)
 
     def get_last_seen_counts(self, userid: UserID) -> dict[RoomID, int]:
         lastseen = self.__data.user.get_last_seen_counts(userid)
-        return {ls[0]: ls[1] for ls in lastseen}
+        counts = {ls[0]: ls[1] for ls in lastseen}
+
+        # Anything not yet flushed needs to be counted against what the client told us it saw.
+        pending = lastseenbuffer.get(userid)
+        if pending:
+            actions = self.get_last_seen_actions(userid)
+            counts.update(self.__data.user.count_unread_actions_many({
+                roomid: actions.get(roomid, actionid) for roomid, actionid in pending.items()
+            }))
+
+        return counts
 
     def get_last_seen_actions(self, userid: UserID) -> dict[RoomID, ActionID]:
         lastseen = self.__data.user.get_last_seen_actions(userid)
-        return {ls[0]: ls[1] for ls in lastseen}
+        actions = {ls[0]: ls[1] for ls in lastseen}
+
+        for roomid, actionid in lastseenbuffer.get(userid).items():
+            actions[roomid] = max(actionid, actions.get(roomid, actionid))
+
+        return actions
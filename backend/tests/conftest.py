@@ -6,7 +6,7 @@ from sqlalchemy.sql import text
 from typing import Any, Generator
 
 from critterchat.config import Config
-from critterchat.data import Data, ConnectionLike
+from critterchat.data import Data, ConnectionLike, occupantcache, usercache
 
 from .mocks import MockConfig
 
@@ -160,6 +160,12 @@ def tx(config: Config, db: Engine) -> Generator[ConnectionLike, None, None]:
         if config.database.backend == "mysql":
             conn.execute(text("SET SESSION innodb_lock_wait_timeout = 1;"))
 
+        # Every test starts from an empty DB, so nothing cached by an earlier test can be trusted.
+        occupantcache.configure(config.cache.occupants, config.cache.ttl)
+        occupantcache.clear()
+        usercache.configure(config.cache.users, config.cache.ttl)
+        usercache.clear()
+
         try:
             # Yield it for use.
             yield conn
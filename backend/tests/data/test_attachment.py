@@ -299,8 +299,7 @@ class TestAttachmentData:
         assert attachments == {action1: [], action2: []}
 
         # Now, link an attachment to the first action.
-        with attachmentdata.lock_action_attachments():
-            attachmentdata.link_action_attachment(action1, aid)
+        attachmentdata.link_action_attachment(action1, aid)
 
         # Now, verify that we can reach this attachment.
         attachments = attachmentdata.get_action_attachments(action1)
@@ -325,8 +324,7 @@ class TestAttachmentData:
         assert len(attachments[action2]) == 0
 
         # Now, unlink that attachment and verify again.
-        with attachmentdata.lock_action_attachments():
-            attachmentdata.unlink_action_attachment(action1, aid)
+        attachmentdata.unlink_action_attachment(action1, aid)
 
         attachments = attachmentdata.get_action_attachments(action1)
         assert attachments == {action1: []}
@@ -5,6 +5,8 @@ from sqlalchemy.engine import Engine
 
 from critterchat.config import Config
 from critterchat.data.base import BaseData, ConnectionLike
+from critterchat.data.notify import Change, ChangeType, changebus
+from critterchat.data.types import RoomID, UserID
 
 
 @pytest.mark.integration
@@ -258,3 +260,60 @@ class TestBase:
         final = BaseData(config, cast(ConnectionLike, finalconn))
         final.execute("DROP TABLE IF EXISTS test_nested_outer_rollback")
         finalconn.close()
+
+    def test_notify(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that change notifications are only delivered once the surrounding transaction commits.
+        """
+
+        basedata = BaseData(config, tx)
+        subscription = changebus.subscribe()
+
+        try:
+            # Outside of a transaction, changes are delivered immediately.
+            basedata.notify(Change(ChangeType.ACTION, roomid=RoomID(1)))
+            changes = subscription.wait(0.0)
+            assert [(c.type, c.roomid) for c in changes] == [(ChangeType.ACTION, RoomID(1))]
+
+            # Nothing new was published, so we should get nothing back.
+            assert subscription.wait(0.0) == []
+
+            # Inside a transaction, changes are held until the outermost commit.
+            with basedata.transaction():
+                basedata.notify(Change(ChangeType.USER, userid=UserID(2)))
+                with basedata.transaction():
+                    basedata.notify(Change(ChangeType.PREFERENCES, userid=UserID(2)))
+                assert subscription.wait(0.0) == []
+
+            changes = subscription.wait(0.0)
+            assert [(c.type, c.userid) for c in changes] == [(ChangeType.USER, UserID(2)), (ChangeType.PREFERENCES, UserID(2))]
+
+            # Rolled back transactions should never be announced.
+            try:
+                with basedata.transaction():
+                    basedata.notify(Change(ChangeType.INVITE))
+                    raise Exception("Should cause rollback!")
+            except Exception:
+                pass
+            assert subscription.wait(0.0) == []
+
+            # Rolling back an inner transaction should only forget what was recorded inside it.
+            with basedata.transaction():
+                basedata.notify(Change(ChangeType.USER, userid=UserID(3)))
+                try:
+                    with basedata.transaction():
+                        basedata.notify(Change(ChangeType.USER, userid=UserID(4)))
+                        raise Exception("Should cause rollback!")
+                except Exception:
+                    pass
+                basedata.notify(Change(ChangeType.USER, userid=UserID(5)))
+
+            changes = subscription.wait(0.0)
+            assert [(c.type, c.userid) for c in changes] == [(ChangeType.USER, UserID(3)), (ChangeType.USER, UserID(5))]
+
+        finally:
+            changebus.unsubscribe(subscription)
+
+        # Once unsubscribed, nothing should be queued up for us.
+        basedata.notify(Change(ChangeType.ACTION, roomid=RoomID(1)))
+        assert subscription.wait(0.0) == []
@@ -0,0 +1,93 @@
+import pytest
+from unittest.mock import patch
+
+from critterchat.data import Change, ChangeType, Invite, Occupant, InviteID, OccupantID, RoomID, UserID
+from critterchat.data.cache import LRUCache, OccupantCache
+
+
+@pytest.mark.unit
+class TestCache:
+    def test_lru_cache(self) -> None:
+        """
+        Tests eviction order, expiry, stale writes and hit counting for the basic cache.
+        """
+
+        cache: LRUCache[int, str] = LRUCache()
+
+        # Nothing is cached until the cache is given a size.
+        cache.put(1, "one", cache.generation)
+        assert cache.get(1) is None
+
+        cache.configure(2, 60)
+        cache.put(1, "one", cache.generation)
+        cache.put(2, "two", cache.generation)
+        assert cache.get(1) == "one"
+
+        # Two was used least recently, so it should be the one to go.
+        cache.put(3, "three", cache.generation)
+        assert cache.get(2) is None
+        assert cache.get(1) == "one"
+        assert cache.get(3) == "three"
+
+        # A lookup that started before an invalidation must not store what it read.
+        generation = cache.generation
+        cache.discard([1])
+        cache.put(1, "stale", generation)
+        assert cache.get(1) is None
+
+        cache.discard_if(lambda k, _: k == 3)
+        assert cache.get(3) is None
+
+        # Entries should expire after their time to live.
+        cache.put(4, "four", cache.generation)
+        with patch("critterchat.data.cache.time.monotonic", return_value=10 ** 12):
+            assert cache.get(4) is None
+
+        stats = cache.stats()
+        assert stats.size == 0
+        assert stats.hits == 3
+        assert stats.misses == 5
+
+    def test_occupant_cache(self) -> None:
+        """
+        Tests that occupants come back as copies, and that room lists are dropped along with
+        any occupant in them.
+        """
+
+        cache = OccupantCache()
+        cache.configure(100, 60)
+
+        first = Occupant(OccupantID(1), UserID(10), username="first")
+        second = Occupant(OccupantID(2), UserID(20), username="second", present=False)
+        second.invite = Invite(InviteID(5), active=True, seen=False, timestamp=1, userid=UserID(10))
+        third = Occupant(OccupantID(3), UserID(10), username="first")
+
+        cache.put_room(RoomID(100), [(first, False), (second, True)], cache.generation)
+        cache.put_occupants([(RoomID(200), third, False)], cache.generation)
+
+        room = cache.get_room(RoomID(100))
+        assert room is not None
+        assert [(o.id, o.present, invited) for o, invited in room] == [(OccupantID(1), True, False), (OccupantID(2), False, True)]
+
+        # Modifying what we got back shouldn't modify the cache.
+        room[0][0].nickname = "changed"
+        assert cache.get_occupants([OccupantID(1)])[OccupantID(1)][0].nickname == ""
+
+        # Dismissing an invite should only drop the occupant holding it, which takes the room with it.
+        cache.invalidate_invite(InviteID(5))
+        assert cache.get_room(RoomID(100)) is None
+        assert set(cache.get_occupants([OccupantID(1), OccupantID(2), OccupantID(3)])) == {OccupantID(1), OccupantID(3)}
+
+        # Changing a user should drop them from every room they are in.
+        cache.invalidate_changes([Change(ChangeType.USER, userid=UserID(10))])
+        assert cache.get_occupants([OccupantID(1), OccupantID(3)]) == {}
+
+        # Occupant changes from another process should drop that whole room.
+        cache.put_room(RoomID(100), [(first, False)], cache.generation)
+        cache.put_occupants([(RoomID(200), third, False)], cache.generation)
+        cache.invalidate_changes([Change(ChangeType.ACTION, roomid=RoomID(100)), Change(ChangeType.OCCUPANT, roomid=RoomID(200))])
+        assert cache.get_room(RoomID(100)) is not None
+        assert cache.get_occupants([OccupantID(3)]) == {}
+
+        cache.invalidate_changes([Change(ChangeType.INVITE, roomid=RoomID(100))])
+        assert cache.get_room(RoomID(100)) is None
@@ -0,0 +1,84 @@
+import pytest
+from freezegun import freeze_time
+
+from critterchat.common import Time
+from critterchat.config import Config
+from critterchat.data import Data
+from critterchat.data.base import ConnectionLike
+from critterchat.data.changelog import ChangeLogData
+from critterchat.data.notify import Change, ChangeType
+from critterchat.data.types import RoomID, UserID
+from critterchat.http.messagepump import ChangeCursor
+
+
+@pytest.mark.integration
+class TestChangeLogData:
+    def test_changelog(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that notified changes are recorded in order and can be followed with a cursor.
+        """
+
+        changelog = ChangeLogData(config, tx)
+        assert changelog.get_last_change() is None
+        assert changelog.get_changes(None) == []
+
+        with freeze_time("2026-01-01 6:00:00"):
+            changelog.notify(Change(ChangeType.ACTION, roomid=RoomID(1), userid=UserID(2)))
+        with freeze_time("2026-01-01 6:10:00"):
+            changelog.notify(Change(ChangeType.INVITE))
+            changelog.notify(Change(ChangeType.USER, userid=UserID(3)))
+
+        changes = changelog.get_changes(None)
+        assert [(c.type, c.roomid, c.userid) for _, c in changes] == [
+            (ChangeType.ACTION, RoomID(1), UserID(2)),
+            (ChangeType.INVITE, None, None),
+            (ChangeType.USER, None, UserID(3)),
+        ]
+        assert changelog.get_last_change() == changes[-1][0]
+
+        # Following from a cursor should only give us what's newer.
+        after = changelog.get_changes(changes[0][0])
+        assert [seq for seq, _ in after] == [seq for seq, _ in changes[1:]]
+        assert changelog.get_changes(changes[-1][0]) == []
+
+        # Rolled back changes should never make it into the log.
+        try:
+            with changelog.transaction():
+                changelog.notify(Change(ChangeType.PREFERENCES, userid=UserID(3)))
+                raise Exception("Should cause rollback!")
+        except Exception:
+            pass
+        assert changelog.get_changes(changes[-1][0]) == []
+
+        # Pruning should only get rid of older changes.
+        with freeze_time("2026-01-01 6:10:00"):
+            changelog.prune_changes(Time.now() - 60)
+        assert [seq for seq, _ in changelog.get_changes(None)] == [seq for seq, _ in changes[1:]]
+
+    def test_prune_everything(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that pruning the whole log never lets the sequence go backwards, so that a cursor
+        that was following along still sees everything that happens afterwards.
+        """
+
+        data = Data(config, tx)
+        data.changelog.notify(Change(ChangeType.ACTION, roomid=RoomID(1)))
+        data.changelog.notify(Change(ChangeType.ACTION, roomid=RoomID(2)))
+
+        cursor = ChangeCursor(data)
+        last = cursor.position
+        assert last > 0
+
+        # Everything is old enough to prune, but the newest change always sticks around.
+        data.changelog.prune_changes(Time.now() + 60)
+        assert [seq for seq, _ in data.changelog.get_changes(None)] == [last]
+
+        data.changelog.notify(Change(ChangeType.ACTION, roomid=RoomID(3)))
+        assert data.changelog.get_last_change() == last + 1
+        assert [(c.type, c.roomid) for c in cursor.poll()] == [(ChangeType.ACTION, RoomID(3))]
+
+        # Even if the newest change is gone, the sequence should keep going where it left off.
+        data.changelog.execute("DELETE FROM changelog")
+        data.changelog.notify(Change(ChangeType.ACTION, roomid=RoomID(4)))
+        assert data.changelog.get_last_change() == last + 2
+        assert [(c.type, c.roomid) for c in cursor.poll()] == [(ChangeType.ACTION, RoomID(4))]
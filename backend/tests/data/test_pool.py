@@ -0,0 +1,58 @@
+import gevent
+import pytest
+import threading
+
+from critterchat.data.pool import PoolBusyException, WorkerPool
+
+
+@pytest.mark.unit
+class TestPool:
+    def test_pool(self) -> None:
+        """
+        Tests that work runs on a native thread only when the pool has threads, and that
+        results and exceptions make it back to the caller either way.
+        """
+
+        pool = WorkerPool()
+        caller = threading.get_ident()
+
+        # Without any threads, everything runs right where it was called.
+        assert pool.run(threading.get_ident) == caller
+
+        pool.configure(2)
+        assert pool.size == 2
+        assert pool.run(threading.get_ident) != caller
+        assert pool.run(lambda: 5) == 5
+
+        def fail() -> None:
+            raise ValueError("DB went away")
+
+        with pytest.raises(ValueError):
+            pool.run(fail)
+
+        pool.configure(0)
+        assert pool.size == 0
+        assert pool.run(threading.get_ident) == caller
+
+    def test_pool_queue(self) -> None:
+        """
+        Tests that callers are turned away once too many are already waiting on the pool.
+        """
+
+        pool = WorkerPool()
+        pool.configure(1, queue=1)
+        release = threading.Event()
+
+        # One caller holds the only thread and another waits behind it.
+        waiting = [gevent.spawn(pool.run, lambda: release.wait(5)) for _ in range(2)]
+        gevent.sleep(0)
+
+        with pytest.raises(PoolBusyException):
+            pool.run(lambda: 5)
+
+        release.set()
+        gevent.joinall(waiting, raise_error=True)
+        assert [g.value for g in waiting] == [True, True]
+
+        # With everybody done, there's room again.
+        assert pool.run(lambda: 5) == 5
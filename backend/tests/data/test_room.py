@@ -10,17 +10,25 @@ from critterchat.data import (
     Room,
     RoomPurpose,
     RoomID,
+    UserID,
     NewActionID,
     NewOccupantID,
     NewRoomID,
     NewUserID,
     UserPermission,
+    occupantcache,
 )
 from critterchat.data.attachment import AttachmentData
+from critterchat.data.changelog import ChangeLogData
+from critterchat.data.notify import ChangeType
 from critterchat.data.room import RoomData
 from critterchat.data.user import UserData
 
 
+def invite_changes(changelog: ChangeLogData, after: int | None) -> list[tuple[RoomID | None, UserID | None]]:
+    return [(c.roomid, c.userid) for _, c in changelog.get_changes(after) if c.type == ChangeType.INVITE]
+
+
 @pytest.mark.integration
 class TestRoomData:
     # TODO: There's a decent amount of edge cases that aren't covered in this function. At
@@ -81,8 +89,10 @@ class TestRoomData:
         assert history[0].occupant is None
         old_action_id = history[0].id
 
-        # And verify that the action ID we detect on the network is correct.
-        assert old_action_id == roomdata.get_last_action()
+        # And verify that the room knows this is its newest action.
+        by_id = roomdata.get_room(room.id)
+        assert by_id is not None
+        assert by_id.newest_action == old_action_id
 
         # Now, join the room as a user and then make a change again.
         user = userdata.create_account("room_crud_user", "amazing_password")
@@ -96,8 +106,10 @@ class TestRoomData:
         assert history[0].occupant is not None
         assert history[0].occupant.userid == user.id
 
-        # And verify that the action ID we detect on the network is correct.
-        assert history[0].id == roomdata.get_last_action()
+        # And verify that the room knows this is its newest action.
+        by_id = roomdata.get_room(room.id)
+        assert by_id is not None
+        assert by_id.newest_action == history[0].id
 
         # Now, edit the room as the user.
         aid = attachmentdata.insert_attachment('local', 'image/png', 'testing.png', {})
@@ -121,9 +133,6 @@ class TestRoomData:
         assert history[0].occupant.userid == user.id
         new_action_id = history[0].id
 
-        # And verify that the action ID we detect on the network is correct.
-        assert new_action_id == roomdata.get_last_action()
-
         # Also make sure we can find the info by limiting the response to the last few actions.
         history = roomdata.get_room_history(room.id, limit=1)
         assert len(history) == 1
@@ -140,8 +149,19 @@ class TestRoomData:
         assert history[1].action == ActionType.CHANGE_INFO
         assert history[1].occupant is None
 
-        # And verify that the action ID we detect on the network is correct.
-        assert new_action_id == roomdata.get_last_action()
+        # Make sure the room tracks its oldest and newest action as they're inserted.
+        by_id = roomdata.get_room(room.id)
+        assert by_id is not None
+        assert by_id.oldest_action == old_action_id
+        assert by_id.newest_action == new_action_id
+        assert [(r.oldest_action, r.newest_action) for r in roomdata.get_joined_rooms(user.id)] == [(old_action_id, new_action_id)]
+
+        # And make sure that recomputing them from scratch lands on the same thing.
+        roomdata.backfill_action_ids()
+        by_id = roomdata.get_room(room.id)
+        assert by_id is not None
+        assert by_id.oldest_action == old_action_id
+        assert by_id.newest_action == new_action_id
 
         # No delete because we do not delete rooms currently.
 
@@ -352,6 +372,25 @@ class TestRoomData:
         users2 = {occupant.userid: occupant for occupant in roomdata.get_room_occupants(room2.id)}
         assert users2.keys() == {user1.id}
 
+        # Verify that looking up both rooms at once gives the same answer.
+        bulk = roomdata.get_room_occupants_for_rooms([room1.id, room2.id])
+        assert {room: {o.userid for o in occupants} for room, occupants in bulk.items()} == {
+            room1.id: {user1.id, user2.id},
+            room2.id: {user1.id},
+        }
+        bulk = roomdata.get_room_occupants_for_rooms([room1.id, room2.id], include_invited=True)
+        assert {room: {o.userid for o in occupants} for room, occupants in bulk.items()} == {
+            room1.id: {user1.id, user2.id, user3.id},
+            room2.id: {user1.id},
+        }
+        bulk = roomdata.get_room_occupants_for_rooms([room1.id, room2.id], include_left=True)
+        assert {room: {o.userid for o in occupants} for room, occupants in bulk.items()} == {
+            room1.id: {user1.id, user2.id, user3.id},
+            room2.id: {user1.id, user2.id},
+        }
+        assert roomdata.get_room_occupants_for_rooms([]) == {}
+        assert roomdata.get_room_occupants_for_rooms([NewRoomID]) == {}
+
         # Verify some properties and ensure the occupants are different.
         assert users1[user1.id].id != users2[user1.id].id
 
@@ -540,6 +579,45 @@ class TestRoomData:
         assert fetched is not None
         assert fetched.id == room1.id
 
+    def test_occupant_cache_commit(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Verifies that cached occupants are only dropped once a change commits, while the transaction
+        that made the change still sees it right away.
+        """
+
+        roomdata = RoomData(config, tx)
+        userdata = UserData(config, tx)
+
+        user1 = userdata.create_account('test_cache_commit_1', 'some_arbitrary_password')
+        assert user1 is not None
+        user2 = userdata.create_account('test_cache_commit_2', 'some_arbitrary_password')
+        assert user2 is not None
+
+        room = Room(NewRoomID, "test cache commit", "", RoomPurpose.CHAT, False, False, None, None)
+        roomdata.create_room(room)
+        roomdata.join_room(room.id, user1.id)
+
+        # Warm the cache up so there's something to drop.
+        assert {user1.id} == {o.userid for o in roomdata.get_room_occupants(room.id)}
+        assert occupantcache.get_room(room.id) is not None
+
+        # A transaction that never commits leaves the cache alone, and doesn't fill it from its own reads.
+        with pytest.raises(RuntimeError):
+            with roomdata.transaction():
+                roomdata.join_room(room.id, user2.id)
+                assert {user1.id, user2.id} == {o.userid for o in roomdata.get_room_occupants(room.id)}
+                raise RuntimeError("Roll it back!")
+        assert {user1.id} == {o.userid for o, _ in occupantcache.get_room(room.id) or []}
+        assert {user1.id} == {o.userid for o in roomdata.get_room_occupants(room.id)}
+
+        # A transaction that commits drops the cached copy only once it's done.
+        with roomdata.transaction():
+            roomdata.join_room(room.id, user2.id)
+            assert {user1.id, user2.id} == {o.userid for o in roomdata.get_room_occupants(room.id)}
+            assert occupantcache.get_room(room.id) is not None
+        assert occupantcache.get_room(room.id) is None
+        assert {user1.id, user2.id} == {o.userid for o in roomdata.get_room_occupants(room.id)}
+
     def test_edit_action(self, config: Config, tx: ConnectionLike) -> None:
         """
         Tests that we can fetch and edit actions, for the purpose of edits and reactions.
@@ -592,9 +670,9 @@ class TestRoomData:
         assert action.occupant.userid == user.id
         assert action.occupant.username == "room_edit_action_user"
 
-        # Now, attempt to modify the action. Lock the table to test the locking flow, even
+        # Now, attempt to modify the action. Lock the room to test the locking flow, even
         # though we don't really need to lock here.
-        with roomdata.lock_actions():
+        with roomdata.lock_room(room.id):
             action.details = {"message": "this is an edit"}
             roomdata.update_action(action)
 
@@ -608,6 +686,114 @@ class TestRoomData:
         assert action.occupant.userid == user.id
         assert action.occupant.username == "room_edit_action_user"
 
+    def test_reactions(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that reactions can be added and removed, show up on fetched messages, and that legacy
+        reactions stored in message details get moved over to the reaction table.
+        """
+
+        roomdata = RoomData(config, tx)
+        userdata = UserData(config, tx)
+
+        # First, create a room
+        room = Room(
+            NewRoomID,
+            "test reactions",
+            "",
+            RoomPurpose.ROOM,
+            False,
+            False,
+            None,
+            None,
+        )
+        roomdata.create_room(room)
+        assert room.id != NewRoomID
+
+        # Now, join the room as two users and then add a message.
+        user1 = userdata.create_account("room_reactions_user1", "amazing_password")
+        assert user1 is not None
+        user2 = userdata.create_account("room_reactions_user2", "amazing_password")
+        assert user2 is not None
+        roomdata.join_room(room.id, user1.id)
+        roomdata.join_room(room.id, user2.id)
+
+        occupant1 = roomdata.get_room_occupant_for_user(room.id, user1.id)
+        assert occupant1 is not None
+        occupant2 = roomdata.get_room_occupant_for_user(room.id, user2.id)
+        assert occupant2 is not None
+
+        newaction = Action(
+            actionid=NewActionID,
+            timestamp=Time.now(),
+            occupant=occupant1,
+            action=ActionType.MESSAGE,
+            details={"message": "react to me"},
+        )
+        roomdata.insert_action(room.id, newaction)
+        assert newaction.id != NewActionID
+        assert roomdata.get_action_room(newaction.id) == (ActionType.MESSAGE, room.id)
+
+        # Add some reactions, making sure doubling up doesn't count.
+        assert roomdata.add_reaction(newaction.id, ":b:", occupant2.id)
+        assert roomdata.add_reaction(newaction.id, ":a:", occupant1.id)
+        assert roomdata.add_reaction(newaction.id, ":b:", occupant1.id)
+        assert not roomdata.add_reaction(newaction.id, ":b:", occupant2.id)
+
+        assert roomdata.get_reactions([newaction.id]) == {
+            newaction.id: {":b:": [occupant2.id, occupant1.id], ":a:": [occupant1.id]},
+        }
+
+        # Fetching the message should include reactions in the order they were first used.
+        action = roomdata.get_action(newaction.id)
+        assert action is not None
+        assert action.details == {
+            "message": "react to me",
+            "reactions": {":b:": [occupant2.id, occupant1.id], ":a:": [occupant1.id]},
+            "reactions_order": [":b:", ":a:"],
+        }
+
+        # Now, remove some reactions, making sure removing one we don't have doesn't count.
+        assert roomdata.remove_reaction(newaction.id, ":b:", occupant2.id)
+        assert not roomdata.remove_reaction(newaction.id, ":b:", occupant2.id)
+        assert roomdata.remove_reaction(newaction.id, ":a:", occupant1.id)
+
+        history = roomdata.get_room_history(room.id)
+        messages = [a for a in history if a.action == ActionType.MESSAGE]
+        assert len(messages) == 1
+        assert messages[0].details == {
+            "message": "react to me",
+            "reactions": {":b:": [occupant1.id]},
+            "reactions_order": [":b:"],
+        }
+
+        # Finally, insert a message with reactions stored the legacy way and make sure it moves over.
+        legacy = Action(
+            actionid=NewActionID,
+            timestamp=Time.now(),
+            occupant=occupant2,
+            action=ActionType.MESSAGE,
+            details={
+                "message": "legacy reactions",
+                "reactions": {":a:": [occupant1.id], ":c:": [occupant1.id, occupant2.id]},
+                "reactions_order": [":c:", ":a:"],
+            },
+        )
+        roomdata.insert_action(room.id, legacy)
+        assert legacy.id != NewActionID
+
+        roomdata.backfill_reactions()
+        assert roomdata.get_reactions([legacy.id]) == {
+            legacy.id: {":c:": [occupant1.id, occupant2.id], ":a:": [occupant1.id]},
+        }
+
+        action = roomdata.get_action(legacy.id)
+        assert action is not None
+        assert action.details == {
+            "message": "legacy reactions",
+            "reactions": {":c:": [occupant1.id, occupant2.id], ":a:": [occupant1.id]},
+            "reactions_order": [":c:", ":a:"],
+        }
+
     def test_occupant_room_properties(self, config: Config, tx: ConnectionLike) -> None:
         """
         Tests that we can fetch and update occupant properties in rooms.
@@ -731,11 +917,9 @@ class TestRoomData:
         assert not roomdata.is_invited_to_room(room.id, inviter.id)
         assert not roomdata.is_invited_to_room(room.id, invitee.id)
 
-        # Verify that we haven't gotten any invite updates.
-        ts_and_cnt = roomdata.get_last_invite_update()
-        assert ts_and_cnt is None
-
         # Now, send an invite from the inviter to the invitee.
+        changelog = ChangeLogData(config, tx)
+        last = changelog.get_last_change()
         roomdata.grant_room_invite(room.id, invitee.id, inviter.id)
 
         # Verify that they got the invite.
@@ -751,16 +935,11 @@ class TestRoomData:
         assert not roomdata.is_invited_to_room(room.id, inviter.id)
         assert roomdata.is_invited_to_room(room.id, invitee.id)
 
-        # We should get an invite update now.
-        ts_and_cnt = roomdata.get_last_invite_update()
-        assert ts_and_cnt is not None
-        ts, cnt = ts_and_cnt
-
-        assert cnt == 1
-        assert not roomdata.has_updated_invites(inviter.id, ts, 0)
-        assert roomdata.has_updated_invites(invitee.id, ts, 0)
+        # Only the invitee should be told about an invite update.
+        assert invite_changes(changelog, last) == [(room.id, invitee.id)]
 
         # Now, revoke the invite (uninvite the user).
+        last = changelog.get_last_change()
         roomdata.revoke_room_invite(room.id, invitee.id, inviter.id)
 
         # Make sure we're back to not having any invites.
@@ -770,15 +949,10 @@ class TestRoomData:
         assert not roomdata.is_invited_to_room(room.id, invitee.id)
 
         # And make sure we get updates for this.
-        assert not roomdata.has_updated_invites(inviter.id, ts, 0)
-        assert roomdata.has_updated_invites(invitee.id, ts, 1)
-
-        ts_and_cnt = roomdata.get_last_invite_update()
-        assert ts_and_cnt is not None
-        ts, cnt = ts_and_cnt
-        assert cnt == 1
+        assert invite_changes(changelog, last) == [(room.id, invitee.id)]
 
         # Make sure we can't invite if we're not in the room.
+        last = changelog.get_last_change()
         roomdata.grant_room_invite(room.id, inviter.id, invitee.id)
         assert [] == roomdata.get_room_invites(inviter.id)
         assert [] == roomdata.get_room_invites(invitee.id)
@@ -786,10 +960,7 @@ class TestRoomData:
         assert not roomdata.is_invited_to_room(room.id, invitee.id)
 
         # Make sure invites didn't actually change.
-        nts_and_ncnt = roomdata.get_last_invite_update()
-        assert nts_and_ncnt is not None
-        assert nts_and_ncnt[0] == ts
-        assert nts_and_ncnt[1] == cnt
+        assert invite_changes(changelog, last) == []
 
         # Make sure we can't invite somebody who's already in the room.
         roomdata.join_room(room.id, invitee.id)
@@ -811,7 +982,9 @@ class TestRoomData:
         assert invites[0].seen is False
 
         # Acknowledge the invite so we can mark it as seen.
+        last = changelog.get_last_change()
         roomdata.acknowledge_room_invite(invites[0].id)
+        assert invite_changes(changelog, last) == [(room.id, invitee.id)]
         assert not roomdata.is_invited_to_room(room.id, inviter.id)
         assert roomdata.is_invited_to_room(room.id, invitee.id)
 
@@ -821,7 +994,9 @@ class TestRoomData:
         assert invites[0].seen is True
 
         # Now, dismiss the invite so we can test it as inactive.
+        last = changelog.get_last_change()
         roomdata.dismiss_room_invite(invites[0].id)
+        assert invite_changes(changelog, last) == [(room.id, invitee.id)]
         assert not roomdata.is_invited_to_room(room.id, inviter.id)
         assert roomdata.is_invited_to_room(room.id, invitee.id)
 
@@ -831,7 +1006,9 @@ class TestRoomData:
         assert invites[0].seen is True
 
         # Now, join the room, verifying that the invite goes away.
+        last = changelog.get_last_change()
         roomdata.join_room(room.id, invitee.id, inviter=inviter.id)
+        assert invite_changes(changelog, last) == [(room.id, invitee.id)]
         assert [] == roomdata.get_room_invites(inviter.id)
         assert [] == roomdata.get_room_invites(invitee.id)
         assert not roomdata.is_invited_to_room(room.id, inviter.id)
@@ -1,5 +1,6 @@
 import pytest
 from freezegun import freeze_time
+from sqlalchemy.sql import text
 
 from critterchat.common import Time
 from critterchat.config import Config
@@ -28,8 +29,12 @@ from critterchat.data import (
     UserNotification,
     User,
 )
+from critterchat.data.cache import usercache
+from critterchat.data.changelog import ChangeLogData
+from critterchat.data.notify import ChangeType
 from critterchat.data.user import UserData
 from critterchat.data.room import RoomData
+from ..mocks import InterleavedConnection
 
 
 @pytest.mark.integration
@@ -40,6 +45,7 @@ class TestUserData:
         """
 
         userdata = UserData(config, tx)
+        changelog = ChangeLogData(config, tx)
 
         with freeze_time("2026-01-01 6:00:00"):
             # First, create the user
@@ -64,13 +70,9 @@ class TestUserData:
             assert userdata.from_username("nonexistent_username") is None
             assert userdata.get_user(NewUserID) is None
 
-            # Verify that we can detect changes to this user.
-            assert userdata.has_updated_user(user.id, Time.now() - 5) is True
-            assert userdata.has_updated_user(user.id, Time.now() + 5) is False
-            assert userdata.get_last_user_update() == Time.now()
-
         with freeze_time("2026-01-01 6:10:00"):
             # Now, verify user modifications.
+            last = changelog.get_last_change()
             assert user.nickname == "test_user_crud"
             user.nickname = "updated_nickname"
             user.iconid = AttachmentID(999999)
@@ -88,10 +90,9 @@ class TestUserData:
                 )
                 userdata.update_user(invalid)
 
-            # Verify that we can detect changes to this user.
-            assert userdata.has_updated_user(user.id, Time.now() - 5) is True
-            assert userdata.has_updated_user(user.id, Time.now() + 5) is False
-            assert userdata.get_last_user_update() == Time.now()
+            # Verify that connected clients will be told about changes to this user.
+            changes = changelog.get_changes(last)
+            assert [(c.type, c.userid) for _, c in changes] == [(ChangeType.USER, user.id)]
 
             # Make sure that it reflects in the data.
             by_id = userdata.get_user(user.id)
@@ -113,15 +114,78 @@ class TestUserData:
 
         # No delete because we don't support user deletion since that would screw history.
 
-        # Finally, verify that our get last user update still works even when we have only preferences updates.
+        # Finally, verify that preferences updates aren't mistaken for changes to the user.
         with freeze_time("2026-01-01 6:20:00"):
+            last = changelog.get_last_change()
             prefs = UserPreferences.default(user.id)
             userdata.put_preferences(prefs)
 
-            # Verify that we can detect changes to this user.
-            assert userdata.has_updated_user(user.id, Time.now() - 5) is False
-            assert userdata.has_updated_user(user.id, Time.now() + 5) is False
-            assert userdata.get_last_user_update() == Time.now()
+            changes = changelog.get_changes(last)
+            assert [(c.type, c.userid) for _, c in changes] == [(ChangeType.PREFERENCES, user.id)]
+
+    def test_get_users_by_id(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that we can look up several users at once.
+        """
+
+        userdata = UserData(config, tx)
+
+        first = userdata.create_account('test_users_by_id_1', 'some_arbitrary_password')
+        second = userdata.create_account('test_users_by_id_2', 'some_arbitrary_password')
+        assert first is not None
+        assert second is not None
+
+        second.nickname = "second_nickname"
+        userdata.update_user(second)
+
+        assert userdata.get_users_by_id([]) == {}
+        assert userdata.get_users_by_id([NewUserID]) == {}
+
+        users = userdata.get_users_by_id([first.id, second.id, second.id, UserID(999999)])
+        assert set(users.keys()) == {first.id, second.id}
+        assert users[first.id].username == 'test_users_by_id_1'
+        assert users[first.id].nickname == 'test_users_by_id_1'
+        assert users[second.id].username == 'test_users_by_id_2'
+        assert users[second.id].nickname == 'second_nickname'
+
+    def test_user_cache(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that users are served from the process-wide cache, handed out as copies and
+        dropped from the cache whenever they're updated.
+        """
+
+        userdata = UserData(config, tx)
+
+        user = userdata.create_account('test_user_cache', 'some_arbitrary_password')
+        assert user is not None
+
+        # Creating the account looks it up, so start from scratch. The first lookup should miss
+        # and the next one should hit.
+        usercache.discard([user.id])
+        before = usercache.stats()
+        first = userdata.get_user(user.id)
+        second = userdata.get_user(user.id)
+        after = usercache.stats()
+        assert first is not None
+        assert second is not None
+        assert after.misses == before.misses + 1
+        assert after.hits == before.hits + 1
+
+        # Modifying what we got back shouldn't leak into the next lookup.
+        first.permissions.add(UserPermission.ADMINISTRATOR)
+        first.nickname = "not_saved"
+        cached = userdata.get_user(user.id)
+        assert cached is not None
+        assert UserPermission.ADMINISTRATOR not in cached.permissions
+        assert cached.nickname == 'test_user_cache'
+
+        # Updating the user should be visible on the very next lookup.
+        cached.nickname = "saved"
+        cached.permissions.add(UserPermission.ACTIVATED)
+        userdata.update_user(cached)
+        updated = userdata.get_users_by_id([user.id])[user.id]
+        assert updated.nickname == "saved"
+        assert UserPermission.ACTIVATED in updated.permissions
 
     def test_user_password(self, config: Config, tx: ConnectionLike) -> None:
         """
@@ -151,6 +215,35 @@ class TestUserData:
         with pytest.raises(ValueError):
             userdata.update_password(NewUserID, 'brand_new_password')
 
+    def test_user_password_rehash(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that changing the password cost rehashes passwords the next time they are used.
+        """
+
+        cheap = config.clone()
+        cheap["authentication"] = {**cheap.get("authentication", {}), "password_rounds": 1000}
+        pricey = config.clone()
+        pricey["authentication"] = {**pricey.get("authentication", {}), "password_rounds": 2000}
+
+        def stored(userid: UserID) -> str:
+            cursor = tx.execute(text("SELECT password FROM user WHERE id = :userid"), {"userid": userid})
+            return str(cursor.mappings().fetchone()['password'])
+
+        user = UserData(cheap, tx).create_account('test_user_password_rehash', 'some_arbitrary_password')
+        assert user is not None
+        assert stored(user.id).startswith("$pbkdf2-sha512$1000$")
+
+        # A wrong password must never be rehashed, since we can't know what the right one is.
+        userdata = UserData(pricey, tx)
+        assert userdata.validate_password(user.id, 'another_wrong_password') is False
+        assert stored(user.id).startswith("$pbkdf2-sha512$1000$")
+
+        # A successful login should bring the hash up to the new cost, and keep working after.
+        assert userdata.validate_password(user.id, 'some_arbitrary_password') is True
+        assert stored(user.id).startswith("$pbkdf2-sha512$2000$")
+        assert userdata.validate_password(user.id, 'some_arbitrary_password') is True
+        assert userdata.validate_password(user.id, 'another_wrong_password') is False
+
     def test_settings_crud(self, config: Config, tx: ConnectionLike) -> None:
         """
         Tests basic create, retrieve, update, delete for user settings in the system.
@@ -246,8 +339,13 @@ class TestUserData:
         assert user3 is None
 
         # Now, delete one of the sessions, make sure the other still works.
+        last = ChangeLogData(config, tx).get_last_change()
         userdata.destroy_session(session1)
 
+        # Connected clients caching this user need to be told that the session went away.
+        changes = ChangeLogData(config, tx).get_changes(last)
+        assert [(c.type, c.userid) for _, c in changes] == [(ChangeType.USER, user.id)]
+
         user1 = userdata.from_session(session1)
         assert user1 is None
         user2 = userdata.from_session(session2)
@@ -361,8 +459,6 @@ class TestUserData:
         # Now, attempt to grab the preferences that don't exist yet.
         prefs = userdata.get_preferences(user.id)
         assert prefs is None
-        assert userdata.has_updated_preferences(user.id, Time.now() - 5) is False
-        assert userdata.has_updated_preferences(user.id, Time.now() + 5) is False
 
         # Verify that getting preferences for an invalid user always returns nothing.
         assert userdata.get_preferences(NewUserID) is None
@@ -374,6 +470,8 @@ class TestUserData:
             userdata.put_preferences(invalid)
 
         # Now, create a fresh preferences and save them.
+        changelog = ChangeLogData(config, tx)
+        last = changelog.get_last_change()
         prefs = UserPreferences.default(user.id)
         userdata.put_preferences(prefs)
 
@@ -393,9 +491,10 @@ class TestUserData:
         assert new_prefs.mobile_audio_notifs == prefs.mobile_audio_notifs
         assert new_prefs.audio_notifs == prefs.audio_notifs
 
-        # And make sure the availability boolean works.
-        assert userdata.has_updated_preferences(user.id, Time.now() - 5) is True
-        assert userdata.has_updated_preferences(user.id, Time.now() + 5) is False
+        # And make sure connected clients will be told about the change.
+        changes = changelog.get_changes(last)
+        assert [(c.type, c.userid) for _, c in changes] == [(ChangeType.PREFERENCES, user.id)]
+        last = changelog.get_last_change()
 
         # Now make some updates.
         prefs.desktop_size = UISize.SMALLEST
@@ -419,9 +518,50 @@ class TestUserData:
         assert new_prefs.mobile_audio_notifs == prefs.mobile_audio_notifs
         assert new_prefs.audio_notifs == prefs.audio_notifs
 
-        # And make sure the availability boolean still works.
-        assert userdata.has_updated_preferences(user.id, Time.now() - 5) is True
-        assert userdata.has_updated_preferences(user.id, Time.now() + 5) is False
+        # And make sure connected clients are told about this change as well.
+        changes = changelog.get_changes(last)
+        assert [(c.type, c.userid) for _, c in changes] == [(ChangeType.PREFERENCES, user.id)]
+
+    def test_unread_counts_interleaved(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Verifies that an action inserted by somebody else while rooms are being marked as seen still
+        counts towards the badge, instead of being overwritten by a recount that didn't see it.
+        """
+
+        if config.database.backend == "sqlite":
+            pytest.skip("SQLite only allows one writer at a time, so writes can never interleave.")
+
+        roomdata = RoomData(config, tx)
+        userdata = UserData(config, tx)
+
+        user = userdata.create_account('test_unread_interleaved', 'some_arbitrary_password')
+        assert user is not None
+        other = userdata.create_account('test_unread_interleaved_other', 'some_arbitrary_password')
+        assert other is not None
+
+        room = Room(NewRoomID, "test unread interleaved", "", RoomPurpose.ROOM, False, False, None, None)
+        roomdata.create_room(room)
+        roomdata.join_room(room.id, user.id)
+        roomdata.join_room(room.id, other.id)
+        seen = roomdata.get_room_history(room.id, limit=1)[0].id
+
+        def insert_action() -> None:
+            # Somebody else sends a message and commits while we're part of the way through marking.
+            with config.database.engine.connect() as conn:
+                action = Action(
+                    actionid=NewActionID,
+                    timestamp=Time.now(),
+                    occupant=Occupant(occupantid=NewOccupantID, userid=other.id),
+                    action=ActionType.MESSAGE,
+                    details={"message": "sent in the middle"},
+                )
+                RoomData(config, conn).insert_action(room.id, action)
+
+        interleaved = InterleavedConnection(tx, "INSERT INTO unread", insert_action)
+        UserData(config, interleaved).mark_last_seen_many({(user.id, room.id): seen})
+        assert interleaved.callback is None
+
+        assert {room.id: 1} == {roomid: count for (roomid, count) in userdata.get_last_seen_counts(user.id)}
 
     def test_get_visible_users(self, config: Config, tx: ConnectionLike) -> None:
         """
@@ -638,6 +778,42 @@ class TestUserData:
         assert {room1.id: 3, room2.id: 0, room3.id: 1} == {roomid: count for (roomid, count) in userdata.get_last_seen_counts(user.id)}
         assert expected == {roomid: actionid for (roomid, actionid) in userdata.get_last_seen_actions(user.id)}
 
+        # Counting several rooms at once should agree with the stored counts, and count everything
+        # in a room that has never been seen.
+        assert {room1.id: 3, room2.id: 0, room3.id: 1} == userdata.count_unread_actions_many({
+            room1.id: expected[room1.id],
+            room2.id: expected[room2.id],
+            room3.id: None,
+        })
+        assert {room1.id: 0, RoomID(999999): 0} == userdata.count_unread_actions_many({
+            room1.id: roomdata.get_room_history(room1.id, limit=1)[0].id,
+            RoomID(999999): None,
+        })
+        assert {} == userdata.count_unread_actions_many({})
+
+        # Rebuilding the counts from scratch should land on the same numbers.
+        userdata.rebuild_unread_counts(user.id)
+        assert {room1.id: 3, room2.id: 0, room3.id: 1} == {roomid: count for (roomid, count) in userdata.get_last_seen_counts(user.id)}
+
+        # Leaving a room we've never seen should stop counting it, but a room we've seen should stick around.
+        roomdata.leave_room(room1.id, user.id)
+        roomdata.leave_room(room3.id, user.id)
+        assert {room1.id: 4, room2.id: 0} == {roomid: count for (roomid, count) in userdata.get_last_seen_counts(user.id)}
+
+        # Rejoining should pick up everything we missed since we last looked.
+        roomdata.join_room(room3.id, user.id)
+        assert {room1.id: 4, room2.id: 0, room3.id: 3} == {roomid: count for (roomid, count) in userdata.get_last_seen_counts(user.id)}
+
+        # Marking several rooms at once should update every count, and should ignore stale actions.
+        newest = {roomid: roomdata.get_room_history(roomid, limit=1)[0].id for roomid in [room1.id, room3.id]}
+        userdata.mark_last_seen_many({
+            (user.id, room1.id): newest[room1.id],
+            (user.id, room2.id): ActionID(1),
+            (user.id, room3.id): newest[room3.id],
+        })
+        assert {room1.id: 0, room2.id: 0, room3.id: 0} == {roomid: count for (roomid, count) in userdata.get_last_seen_counts(user.id)}
+        assert {**expected, **newest} == {roomid: actionid for (roomid, actionid) in userdata.get_last_seen_actions(user.id)}
+
         # Also make sure that we don't crash when given an invalid user ID.
         assert [] == userdata.get_last_seen_counts(NewUserID)
         assert [] == userdata.get_last_seen_counts(UserID(-1))
@@ -0,0 +1,99 @@
+import pytest
+import queue
+from typing import Any, Iterator
+
+import socketio  # type: ignore
+
+from critterchat.data.notify import Change, ChangeType, changebus
+from critterchat.data.types import RoomID, UserID
+from critterchat.http.cluster import RELAY_EVENT, ChangeRelay
+
+
+class QueueManager(socketio.PubSubManager):  # type: ignore
+    """
+    An in-memory stand-in for a message queue. This only implements the two methods that
+    python-socketio expects every pub/sub backend to provide, so that everything else, including
+    the listener thread that decodes and dispatches messages, is python-socketio's own.
+    """
+
+    queues: list[tuple[str, "queue.Queue[str | None]"]] = []
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.queue: "queue.Queue[str | None]" = queue.Queue()
+        QueueManager.queues.append((self.channel, self.queue))
+
+    def _publish(self, data: dict[str, Any]) -> None:
+        for channel, q in QueueManager.queues:
+            if channel == self.channel:
+                q.put(self.json.dumps(data))
+
+    def _listen(self) -> Iterator[str]:
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            yield message
+
+
+class QueueRelayManager(ChangeRelay, QueueManager):
+    pass
+
+
+@pytest.mark.unit
+class TestCluster:
+    def test_relay_changes(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """
+        Ensure that changes relayed by one process show up on the change bus of another, without
+        being forwarded back out again or reaching any clients, while regular emits still go through.
+        """
+
+        QueueManager.queues = []
+        first = QueueRelayManager(channel="test")
+        second = QueueRelayManager(channel="test")
+        firstserver = socketio.Server(client_manager=first, async_mode="threading")
+        secondserver = socketio.Server(client_manager=second, async_mode="threading")
+
+        # Give the second process a client so that we can see what gets sent to clients.
+        sent: list[str] = []
+        monkeypatch.setattr(secondserver, "_send_eio_packet", lambda eio_sid, pkt: sent.append(str(pkt.data)))
+        second.connect("eio", "/")
+
+        forwarded: list[Change] = []
+        subscription = changebus.subscribe()
+
+        try:
+            first.initialize()
+            second.initialize()
+            changebus.forward(forwarded.extend)
+
+            # A regular emit goes out first, so by the time the changes show up it has been handled.
+            firstserver.emit("chatactions", {})
+            first.relay([Change(ChangeType.ACTION, roomid=RoomID(5), userid=UserID(6)), Change(ChangeType.INVITE)])
+
+            changes = subscription.wait(5.0)
+            assert [(c.type, c.roomid, c.userid) for c in changes] == [
+                (ChangeType.ACTION, RoomID(5), UserID(6)),
+                (ChangeType.INVITE, None, None),
+            ]
+
+            # Relayed changes should not go back out to the queue, and should never reach clients.
+            assert forwarded == []
+            assert len(sent) == 1
+            assert "chatactions" in sent[0]
+            assert RELAY_EVENT not in sent[0]
+
+            # Only the second process should have heard about the changes, not the one that sent them.
+            assert subscription.wait(0.1) == []
+
+        finally:
+            changebus.unsubscribe(subscription)
+            changebus.unforward(forwarded.extend)
+            changebus.unforward(first.relay)
+            changebus.unforward(second.relay)
+
+            # Let the listener threads wind down.
+            for _, q in QueueManager.queues:
+                q.put(None)
+            first.thread.join(5.0)
+            second.thread.join(5.0)
@@ -1,6 +1,5 @@
 import pytest
 
-from critterchat.common import Time
 from critterchat.data.types import (
     ActionID,
     AttachmentID,
@@ -18,9 +17,21 @@ from critterchat.data.types import (
     User,
 )
 from critterchat.data.attachment import Attachment, Emote
-from critterchat.http.messagepump import SocketInfo, send_emote_deltas, send_profile_deltas, send_chat_deltas
+from critterchat.data.notify import Change, ChangeType
+from critterchat.http.messagepump import (
+    ChangeCursor,
+    RoomDeltas,
+    SocketIndex,
+    SocketInfo,
+    send_emote_deltas,
+    send_invite_deltas,
+    send_profile_deltas,
+    send_chat_deltas,
+    send_action_deltas,
+    send_room_deltas,
+)
 
-from ..mocks import MockConfig, MockData, MockSocketIO, Message, set_return, set_lambda
+from ..mocks import MockConfig, MockData, MockRooms, MockSocketIO, Message, set_return, set_lambda
 
 
 @pytest.mark.unit
@@ -164,8 +175,8 @@ class TestMessagePumpEmotes:
 class TestMessagePumpUser:
     def test_send_profile_deltas_no_change(self) -> None:
         """
-        Ensure that if neither the profile nor preferences have updates, nothing gets sent to the
-        client.
+        Ensure that if neither the profile nor preferences have updates for this user, nothing gets
+        sent to the client.
         """
 
         config = MockConfig()
@@ -173,14 +184,10 @@ class TestMessagePumpUser:
         socketio = MockSocketIO()
         info = SocketInfo("testsid", "testsession", UserID(100))
 
-        now = Time.now()
-        info.profilets = now
-        info.prefsts = now
-
-        set_return(data.user.has_updated_user, False)
-        set_return(data.user.has_updated_preferences, False)
+        info.sent_profile = True
+        info.sent_preferences = True
 
-        send_profile_deltas(config, data, socketio, info)
+        send_profile_deltas(config, data, socketio, info, [Change(ChangeType.USER, userid=UserID(200)), Change(ChangeType.PREFERENCES, userid=UserID(200))])
 
         assert socketio.sent == []
 
@@ -195,15 +202,12 @@ class TestMessagePumpUser:
         socketio = MockSocketIO()
         info = SocketInfo("testsid", "testsession", UserID(100))
 
-        now = Time.now()
-        info.profilets = now
-        info.prefsts = now
+        info.sent_profile = True
+        info.sent_preferences = True
 
-        set_return(data.user.has_updated_user, True)
-        set_return(data.user.has_updated_preferences, False)
         set_return(data.user.get_user, User(UserID(100), "testusername", set(), "testuser", "about me", None))
 
-        send_profile_deltas(config, data, socketio, info)
+        send_profile_deltas(config, data, socketio, info, [Change(ChangeType.USER, userid=UserID(100))])
 
         assert socketio.sent == [
             Message(
@@ -232,16 +236,13 @@ class TestMessagePumpUser:
         socketio = MockSocketIO()
         info = SocketInfo("testsid", "testsession", UserID(101))
 
-        now = Time.now()
-        info.profilets = now
-        info.prefsts = now
+        info.sent_profile = True
+        info.sent_preferences = True
 
         # In this case, the user being an admin means they should be able to see extra properties on the profile.
-        set_return(data.user.has_updated_user, True)
-        set_return(data.user.has_updated_preferences, False)
         set_return(data.user.get_user, User(UserID(101), "testusername", {UserPermission.ADMINISTRATOR}, "testuser", "about me", None))
 
-        send_profile_deltas(config, data, socketio, info)
+        send_profile_deltas(config, data, socketio, info, [Change(ChangeType.USER, userid=UserID(101))])
 
         assert socketio.sent == [
             Message(
@@ -271,17 +272,14 @@ class TestMessagePumpUser:
         socketio = MockSocketIO()
         info = SocketInfo("testsid", "testsession", UserID(102))
 
-        now = Time.now()
-        info.profilets = now
-        info.prefsts = now
+        info.sent_profile = True
+        info.sent_preferences = True
 
         attachments = {a.id: a for a in [
             Attachment(AttachmentID(301), "local", "audio/mpeg", None, {}),
             Attachment(AttachmentID(302), "local", "audio/mpeg", None, {}),
         ]}
 
-        set_return(data.user.has_updated_user, False)
-        set_return(data.user.has_updated_preferences, True)
         set_return(data.user.get_preferences, UserPreferences.default(UserID(102)))
         set_return(data.attachment.get_notifications, {
             "notif1": attachments[AttachmentID(301)],
@@ -289,7 +287,7 @@ class TestMessagePumpUser:
         })
         set_lambda(data.attachment.lookup_attachment, lambda aid: attachments.get(aid))
 
-        send_profile_deltas(config, data, socketio, info)
+        send_profile_deltas(config, data, socketio, info, [Change(ChangeType.PREFERENCES, userid=UserID(102))])
 
         assert socketio.sent == [
             Message(
@@ -316,6 +314,30 @@ class TestMessagePumpUser:
             ),
         ]
 
+    def test_send_invite_deltas(self) -> None:
+        """
+        Ensure that invites are only sent again to clients that asked for them, and only when
+        the change log says their own invites changed.
+        """
+
+        config = MockConfig()
+        data = MockData()
+        socketio = MockSocketIO()
+        info = SocketInfo("testsid", "testsession", UserID(103))
+        set_return(data.room.get_room_invites, [])
+
+        # Clients that never asked for invites don't get them pushed.
+        send_invite_deltas(config, data, socketio, info, [Change(ChangeType.INVITE, roomid=RoomID(1), userid=UserID(103))])
+        assert socketio.sent == []
+
+        # Somebody else's invites changing shouldn't matter either.
+        info.sent_invites = True
+        send_invite_deltas(config, data, socketio, info, [Change(ChangeType.INVITE, roomid=RoomID(1), userid=UserID(104))])
+        assert socketio.sent == []
+
+        send_invite_deltas(config, data, socketio, info, [Change(ChangeType.INVITE, roomid=RoomID(1), userid=UserID(103))])
+        assert socketio.sent == [Message('invites', {'active': [], 'ignored': []}, 'testsid')]
+
 
 @pytest.mark.unit
 class TestMessagePumpActions:
@@ -367,6 +389,7 @@ class TestMessagePumpActions:
 
         # Ensure that we're now tracking this new room.
         assert info.fetchlimit == {RoomID(401): ActionID(100001)}
+        assert info.joined == {RoomID(401)}
         assert info.lastseen == {RoomID(401): 2}
 
         # Chat actions are not included here because the client will pull the last 100 when it is told
@@ -431,6 +454,7 @@ class TestMessagePumpActions:
 
         # Ensure that we're now tracking this new room.
         assert info.fetchlimit == {RoomID(501): ActionID(100101), RoomID(502): ActionID(100104)}
+        assert info.joined == {RoomID(501), RoomID(502)}
         assert info.lastseen == {RoomID(501): 2, RoomID(502): 3}
 
         # Chat actions are not included here because the client will pull the last 100 when it is told
@@ -694,3 +718,183 @@ class TestMessagePumpActions:
                 'testsid',
             ),
         ]
+
+    def test_send_action_deltas_shared(self) -> None:
+        """
+        Verify that multiple clients watching the same room share a single fetch of that room's new actions.
+        """
+
+        config = MockConfig()
+        data = MockData()
+        socketio = MockSocketIO()
+        first = SocketInfo("firstsid", "firstsession", UserID(100))
+        second = SocketInfo("secondsid", "secondsession", UserID(101))
+
+        first.fetchlimit = {RoomID(901): ActionID(100500)}
+        second.fetchlimit = {RoomID(901): ActionID(100501)}
+
+        occupant = Occupant(OccupantID(200000), UserID(900), "testusername", "test nickname")
+        actions = [
+            Action(ActionID(100502), 123456, occupant, ActionType.MESSAGE, {"message": "second message"}),
+            Action(ActionID(100501), 123456, occupant, ActionType.MESSAGE, {"message": "first message"}),
+        ]
+        set_lambda(data.room.get_room_history, lambda roomid, before=None, after=None, types=None: [a for a in actions if a.id > after])
+
+        deltas = RoomDeltas(config, data)
+        deltas.want(RoomID(901), ActionID(100501))
+        deltas.want(RoomID(901), ActionID(100500))
+
+        assert send_action_deltas(config, data, socketio, first, deltas)
+        assert send_action_deltas(config, data, socketio, second, deltas)
+
+        # Both clients should be caught up, but the room should only have been fetched once.
+        assert first.fetchlimit == {RoomID(901): ActionID(100502)}
+        assert second.fetchlimit == {RoomID(901): ActionID(100502)}
+        assert data.room.get_room_history.call_count == 1  # type: ignore
+
+        # Each client only gets the actions it hasn't seen yet.
+        assert [(m.event, m.room, [a['id'] for a in m.details['actions']]) for m in socketio.sent] == [  # type: ignore
+            ('chatactions', 'firstsid', ['a100502', 'a100501']),
+            ('chatactions', 'secondsid', ['a100502']),
+        ]
+
+        # A client that's already caught up should get nothing.
+        socketio.sent = []
+        assert not send_action_deltas(config, data, socketio, second, deltas)
+        assert socketio.sent == []
+
+    def test_send_room_deltas_broadcast(self) -> None:
+        """
+        Verify that clients who are caught up in a room get new actions from a single room broadcast,
+        and that clients who are behind are skipped and caught up individually.
+        """
+
+        config = MockConfig()
+        data = MockData()
+        socketio = MockSocketIO()
+        rooms = MockRooms()
+        index = SocketIndex(rooms)
+        first = SocketInfo("firstsid", "firstsession", UserID(100))
+        second = SocketInfo("secondsid", "secondsession", UserID(101))
+        third = SocketInfo("thirdsid", "thirdsession", UserID(102))
+        for info in [first, second, third]:
+            index.add(info)
+
+        first.watch(RoomID(1001), ActionID(100601))
+        second.watch(RoomID(1001), ActionID(100601))
+        third.watch(RoomID(1001), ActionID(100600))
+        assert rooms.rooms == {'firstsid': {'r1001'}, 'secondsid': {'r1001'}, 'thirdsid': {'r1001'}}
+
+        occupant = Occupant(OccupantID(200000), UserID(900), "testusername", "test nickname")
+        actions = [
+            Action(ActionID(100602), 123456, occupant, ActionType.MESSAGE, {"message": "second message"}),
+            Action(ActionID(100601), 123456, occupant, ActionType.MESSAGE, {"message": "first message"}),
+        ]
+        set_lambda(data.room.get_room_history, lambda roomid, before=None, after=None, types=None: [a for a in actions if a.id > after])
+
+        deltas = RoomDeltas(config, data)
+        send_room_deltas(config, data, socketio, index, [first, second, third], deltas)
+
+        assert first.fetchlimit == {RoomID(1001): ActionID(100602)}
+        assert second.fetchlimit == {RoomID(1001): ActionID(100602)}
+        assert third.fetchlimit == {RoomID(1001): ActionID(100600)}
+        assert [(m.event, m.room, m.skip, [a['id'] for a in m.details['actions']]) for m in socketio.sent] == [  # type: ignore
+            ('chatactions', 'r1001', ['thirdsid'], ['a100602']),
+        ]
+
+        # The client that was behind gets caught up on its own.
+        socketio.sent = []
+        assert send_action_deltas(config, data, socketio, third, deltas)
+        assert third.fetchlimit == {RoomID(1001): ActionID(100602)}
+        assert [(m.event, m.room, [a['id'] for a in m.details['actions']]) for m in socketio.sent] == [  # type: ignore
+            ('chatactions', 'thirdsid', ['a100602', 'a100601']),
+        ]
+
+        # Leaving the room should also leave the broadcast room.
+        first.unwatch(RoomID(1001))
+        assert rooms.rooms == {'firstsid': set(), 'secondsid': {'r1001'}, 'thirdsid': {'r1001'}}
+
+
+@pytest.mark.unit
+class TestMessagePumpIndex:
+    def test_socket_index_lookup(self) -> None:
+        """
+        Ensure that we only look up sockets that are watching a changed room or that belong to a changed user.
+        """
+
+        index = SocketIndex()
+        first = SocketInfo('firstsid', 'firstsession', UserID(1))
+        second = SocketInfo('secondsid', 'secondsession', UserID(2))
+        third = SocketInfo('thirdsid', 'thirdsession', UserID(2))
+
+        # Rooms watched before being indexed should still be tracked.
+        first.watch(RoomID(10), ActionID(100))
+        index.add(first)
+        index.add(second)
+        index.add(third)
+        second.watch(RoomID(10), ActionID(100))
+        third.watch(RoomID(20), ActionID(200))
+
+        assert {i.sid for i in index.lookup(roomids={RoomID(10)}, userids=set())} == {'firstsid', 'secondsid'}
+        assert {i.sid for i in index.lookup(roomids={RoomID(20)}, userids=set())} == {'thirdsid'}
+        assert {i.sid for i in index.lookup(roomids=set(), userids={UserID(2)})} == {'secondsid', 'thirdsid'}
+        assert {i.sid for i in index.lookup(roomids={RoomID(20)}, userids={UserID(1)})} == {'firstsid', 'thirdsid'}
+        assert index.lookup(roomids={RoomID(30)}, userids={UserID(3)}) == []
+
+        # Leaving a room should stop us from visiting that socket for changes to that room.
+        second.unwatch(RoomID(10))
+        assert second.fetchlimit == {}
+        assert {i.sid for i in index.lookup(roomids={RoomID(10)}, userids=set())} == {'firstsid'}
+
+        # Disconnecting should remove the socket entirely.
+        index.remove(first)
+        index.remove(third)
+        assert index.lookup(roomids={RoomID(10), RoomID(20)}, userids={UserID(1), UserID(2)}) == [second]
+
+
+@pytest.mark.unit
+class TestMessagePumpChangeCursor:
+    def test_change_cursor(self) -> None:
+        """
+        Ensure that the change cursor hands out every change exactly once, and waits at gaps in the
+        sequence for slower writers to commit before moving past them.
+        """
+
+        data = MockData()
+        log: list[tuple[int, Change]] = [(5, Change(ChangeType.INVITE))]
+        set_return(data.changelog.get_last_change, 5)
+        set_lambda(data.changelog.get_changes, lambda after: [entry for entry in log if entry[0] > after])
+
+        cursor = ChangeCursor(data, gap_timeout=60.0)
+        assert cursor.poll() == []
+        assert cursor.position == 5
+
+        # Straightforward case, contiguous changes get handed out and the cursor moves along.
+        first = Change(ChangeType.ACTION, roomid=RoomID(1))
+        log.append((6, first))
+        assert cursor.poll() == [first]
+        assert cursor.position == 6
+
+        # Change 7 hasn't committed yet, so we get 8 but hold our position at the gap.
+        second = Change(ChangeType.USER, userid=UserID(2))
+        log.append((8, second))
+        assert cursor.poll() == [second]
+        assert cursor.position == 6
+        assert cursor.poll() == []
+        assert cursor.gaps == 1
+
+        # Once 7 commits, we get it without repeating 8.
+        third = Change(ChangeType.ACTION, roomid=RoomID(3))
+        log.append((7, third))
+        log.sort(key=lambda entry: entry[0])
+        assert cursor.poll() == [third]
+        assert cursor.position == 8
+        assert cursor.gaps == 0
+
+        # A gap that never fills should eventually be skipped.
+        fourth = Change(ChangeType.PREFERENCES, userid=UserID(2))
+        log.append((10, fourth))
+        cursor.gap_timeout = 0.0
+        assert cursor.poll() == [fourth]
+        assert cursor.position == 10
+        assert cursor.gaps == 0
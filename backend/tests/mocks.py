@@ -1,8 +1,12 @@
-from typing import Any
+from typing import Any, Callable
 from unittest.mock import MagicMock
 
+from sqlalchemy.engine.base import Transaction
+from sqlalchemy.engine.cursor import CursorResult
+from sqlalchemy.sql.expression import TextClause
+
 from critterchat.config import Config
-from critterchat.data import Data, RequestCache
+from critterchat.data import ConnectionLike, Data, RequestCache
 
 
 def MockData() -> Data:
@@ -12,6 +16,7 @@ def MockData() -> Data:
     data.attachment = MagicMock()
     data.migration = MagicMock()
     data.mastodon = MagicMock()
+    data.changelog = MagicMock()
     data.requestcache = RequestCache()
 
     return data
@@ -32,14 +37,66 @@ def MockConfig() -> Config:
     return config
 
 
+class CountingConnection:
+    """
+    Wraps a real DB connection and records every statement executed and every commit made on it,
+    so that tests can keep an eye on how many round trips a code path makes.
+    """
+
+    def __init__(self, connection: ConnectionLike) -> None:
+        self.connection = connection
+        self.queries: list[str] = []
+        # How many statements had been executed at the time of each commit.
+        self.commits: list[int] = []
+
+    def commit(self) -> None:
+        self.commits.append(len(self.queries))
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        self.connection.rollback()
+
+    def begin(self) -> Transaction:
+        return self.connection.begin()
+
+    def begin_nested(self) -> Transaction:
+        return self.connection.begin_nested()
+
+    def execute(self, text: TextClause, params: dict[str, object] = {}) -> CursorResult[Any]:
+        self.queries.append(" ".join(str(text).split()))
+        return self.connection.execute(text, params)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class InterleavedConnection(CountingConnection):
+    """
+    Wraps a real DB connection and runs a callback just before the first statement that starts
+    with the given prefix, so that tests can have somebody else write in the middle of a transaction.
+    """
+
+    def __init__(self, connection: ConnectionLike, prefix: str, callback: Callable[[], None]) -> None:
+        super().__init__(connection)
+        self.prefix = prefix
+        self.callback: Callable[[], None] | None = callback
+
+    def execute(self, text: TextClause, params: dict[str, object] = {}) -> CursorResult[Any]:
+        if self.callback is not None and " ".join(str(text).split()).startswith(self.prefix):
+            callback, self.callback = self.callback, None
+            callback()
+        return super().execute(text, params)
+
+
 DontCareSentinel = object()
 
 
 class Message:
-    def __init__(self, event: str, details: dict[str, object], room: Any = DontCareSentinel) -> None:
+    def __init__(self, event: str, details: dict[str, object], room: Any = DontCareSentinel, skip: Any = None) -> None:
         self.event = event
         self.details = details
         self.room = room
+        self.skip = skip
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Message):
@@ -60,12 +117,23 @@ class MockSocketIO():
     def __init__(self) -> None:
         self.sent: list[Message] = []
 
-    def emit(self, event: str, details: dict[str, object], *, room: Any = None) -> None:
+    def emit(self, event: str, details: dict[str, object], *, room: Any = None, skip_sid: Any = None) -> None:
         self.sent.append(
-            Message(event, details, room),
+            Message(event, details, room, skip_sid),
         )
 
 
+class MockRooms():
+    def __init__(self) -> None:
+        self.rooms: dict[Any, set[str]] = {}
+
+    def enter_room(self, sid: Any, room: str) -> None:
+        self.rooms.setdefault(sid, set()).add(room)
+
+    def leave_room(self, sid: Any, room: str) -> None:
+        self.rooms.setdefault(sid, set()).discard(room)
+
+
 def set_return(func: Any, return_value: Any) -> None:
     func.return_value = return_value
 
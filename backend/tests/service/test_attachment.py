@@ -1,11 +1,33 @@
+import io
+import os
+import pathlib
 import pytest
+import threading
+import time
+from PIL import ExifTags, Image
 
+from critterchat.common.process import (
+    ProcessPool,
+    ProcessPoolBusyException,
+    ProcessPoolCrashedException,
+    ProcessPoolTimeoutException,
+)
 from critterchat.config import Config
 from critterchat.data import (
+    Attachment,
+    AttachmentID,
     ConnectionLike,
     Data,
+    MetadataType,
+)
+from critterchat.data.attachment import Attachment as StoredAttachment
+from critterchat.service.attachment import (
+    AttachmentService,
+    AttachmentServiceInvalidSizeException,
+    AttachmentServiceUnsupportedImageException,
+    Thumbnail,
 )
-from critterchat.service.attachment import AttachmentService
+from ..mocks import MockConfig, MockData, set_lambda, set_return
 
 
 @pytest.mark.integration
@@ -39,3 +61,201 @@ class TestAttachmentService:
         assert ats._sanitize_filename("test|file.mp3") == "testfile.mp3"
         assert ats._sanitize_filename("test file.mp3") == "test_file.mp3"
         assert ats._sanitize_filename("TestFile.MP3") == "TestFile.mp3"
+
+    def test_prepare_attachment_image(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests that images are checked and thumbnailed on the media pool, and that errors raised
+        by the media workers still make it back as attachment service errors.
+        """
+
+        config = config.clone()
+        config["media"] = {"workers": 1, "timeout": 10, "queue": 0}
+
+        image = Image.new("RGB", (1200, 600))
+        png = io.BytesIO()
+        image.save(png, format="PNG")
+
+        ats = AttachmentService(config, Data(config, tx))
+        data, thumbs, width, height, is_animated, content_type = ats.prepare_attachment_image(png.getvalue())
+        assert data == png.getvalue()
+        assert (width, height, is_animated, content_type) == (1200, 600, False, "image/png")
+        assert [(t.height, t.content_type) for t in thumbs] == [(100, "image/webp"), (300, "image/webp")]
+        assert [Image.open(io.BytesIO(t.data)).size for t in thumbs] == [(200, 100), (600, 300)]
+        assert ats.get_content_type(png.getvalue()) == "image/png"
+
+        with pytest.raises(AttachmentServiceUnsupportedImageException):
+            ats.prepare_attachment_image(b"Not an image")
+        with pytest.raises(AttachmentServiceInvalidSizeException):
+            ats.prepare_attachment_image(png.getvalue(), 512, 512)
+
+        # Photos that are only tagged as sideways are measured and thumbnailed the way they're shown.
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        jpeg = io.BytesIO()
+        image.save(jpeg, format="JPEG", exif=exif)
+
+        data, thumbs, width, height, is_animated, content_type = ats.prepare_attachment_image(jpeg.getvalue())
+        assert data == jpeg.getvalue()
+        assert (width, height, is_animated, content_type) == (600, 1200, False, "image/jpeg")
+        assert [Image.open(io.BytesIO(t.data)).size for t in thumbs] == [(50, 100), (150, 300)]
+
+        # Thumbnail sizes and format can both be changed.
+        config["attachments"]["thumbnail_format"] = "png"
+        config["attachments"]["thumbnail_heights"] = [200]
+        ats = AttachmentService(config, Data(config, tx))
+        thumbs = ats.prepare_attachment_image(png.getvalue())[1]
+        assert [(t.height, t.content_type) for t in thumbs] == [(200, "image/png")]
+        assert Image.open(io.BytesIO(thumbs[0].data)).format == "PNG"
+
+        # Anything with too many pixels is turned away before it is ever decoded.
+        config["media"]["max_megapixels"] = 1
+        ats = AttachmentService(config, Data(config, tx))
+        large = io.BytesIO()
+        Image.new("RGB", (1200, 1000)).save(large, format="PNG")
+        with pytest.raises(AttachmentServiceInvalidSizeException):
+            ats.prepare_attachment_image(large.getvalue())
+        assert ats.prepare_attachment_image(png.getvalue())[2:4] == (1200, 600)
+
+
+@pytest.mark.unit
+class TestThumbnails:
+    def test_thumbnail_sizes(self, tmp_path: pathlib.Path) -> None:
+        """
+        Tests that every thumbnail size is stored and served, that previews point at the smallest
+        one that is tall enough, and that attachments from before we had sizes keep working.
+        """
+
+        config = MockConfig()
+        config["attachments"]["directory"] = str(tmp_path)
+        data = MockData()
+        ats = AttachmentService(config, data)
+
+        stored = StoredAttachment(AttachmentID(1001), "local", "image/jpeg", "photo.jpg", {})
+        set_return(data.attachment.lookup_attachment, stored)
+        set_return(data.attachment.get_attachments, [stored])
+
+        # Before it has sizes, an attachment has the one thumbnail named after it.
+        legacy = ats.get_thumbnail_name(stored.id, 100)
+        assert legacy == ats.get_thumbnail_name(stored.id)
+        assert legacy.endswith(".jpg")
+
+        def update(aid: AttachmentID, metadata: dict[MetadataType, object]) -> None:
+            stored.metadata = {**stored.metadata, **metadata}
+
+        set_lambda(data.attachment.update_attachment_metadata, update)
+        ats.put_thumbnail_data(stored.id, [
+            Thumbnail(100, "image/webp", b"small"),
+            Thumbnail(300, "image/webp", b"large"),
+        ])
+
+        small = ats.get_thumbnail_name(stored.id, 100)
+        large = ats.get_thumbnail_name(stored.id, 300)
+        assert small.endswith(".webp") and large.endswith(".webp")
+        assert small != large and legacy not in {small, large}
+        assert ats.get_thumbnail_name(stored.id, 50) == small
+        assert ats.get_thumbnail_name(stored.id, 200) == large
+        assert ats.get_thumbnail_name(stored.id, 1000) == large
+        assert ats.get_thumbnail_name(stored.id) == large
+        assert ats.get_thumbnail_url(stored.id, 100) == f"http://localhost/attachments/{small}"
+
+        assert ats.id_from_path(f"/attachments/{small}") == (stored.id, True, 100)
+        assert ats.id_from_path(f"/attachments/{large}") == (stored.id, True, 300)
+        assert ats.get_thumbnail_data(stored.id, 100) == ("image/webp", b"small")
+        assert ats.get_thumbnail_data(stored.id, 300) == ("image/webp", b"large")
+        assert ats.get_thumbnail_data(stored.id, 200) is None
+
+        # A room with a single image shows it large, and anything more gets small previews.
+        preview = ats.resolve_attachment_preview(
+            Attachment(stored.id, "", stored.content_type, stored.metadata),
+            ats.get_preview_height(2),
+        )
+        assert preview.preview == f"http://localhost/attachments/{small}"
+        assert MetadataType.THUMBNAILS not in preview.to_dict()["metadata"]  # type: ignore
+
+        ats.delete_attachment_data(stored.id)
+        assert os.listdir(tmp_path) == []
+
+
+def _add(first: int, second: int) -> int:
+    return first + second
+
+
+def _fail(message: str) -> None:
+    raise ValueError(message)
+
+
+def _crash() -> None:
+    os._exit(1)
+
+
+def _allocate(megabytes: int) -> int:
+    return len(bytearray(megabytes * 1024 * 1024))
+
+
+@pytest.mark.unit
+class TestMediaPool:
+    def test_pool(self) -> None:
+        """
+        Tests that jobs run in another process when the pool has workers, that results and
+        exceptions make it back to the caller, and that runaway jobs are killed.
+        """
+
+        pool = ProcessPool(preload=[__name__])
+
+        # Without any workers, everything runs right where it was called.
+        assert pool.run(os.getpid) == os.getpid()
+
+        pool.configure(1, 10, 1024, 0)
+        worker = pool.run(os.getpid)
+        assert worker != os.getpid()
+        assert pool.run(_add, 2, 3) == 5
+        with pytest.raises(ValueError):
+            pool.run(_fail, "Bad image")
+
+        # The same worker is reused as long as nothing went wrong.
+        assert pool.run(os.getpid) == worker
+
+        with pytest.raises(MemoryError):
+            pool.run(_allocate, 2048)
+        with pytest.raises(ProcessPoolCrashedException):
+            pool.run(_crash)
+        assert pool.run(os.getpid) != worker
+
+        pool.configure(1, 1, 1024, 0)
+        with pytest.raises(ProcessPoolTimeoutException):
+            pool.run(time.sleep, 5)
+        assert pool.run(_add, 1, 1) == 2
+
+        stats = pool.stats()
+        assert stats.workers == 1
+        assert stats.queued == 0
+        assert stats.running == 0
+        assert stats.completed == 5
+        assert stats.failed == 2
+        assert stats.crashes == 1
+        assert stats.timeouts == 1
+
+    def test_pool_queue(self) -> None:
+        """
+        Tests that callers are turned away once too many are already waiting on the pool.
+        """
+
+        pool = ProcessPool()
+        pool.configure(1, 10, 0, 1)
+
+        # One caller holds the only worker and another waits behind it.
+        waiting = [threading.Thread(target=pool.run, args=(time.sleep, 1)) for _ in range(2)]
+        for thread in waiting:
+            thread.start()
+        while pool.stats().queued + pool.stats().running < 2:
+            time.sleep(0.01)
+
+        with pytest.raises(ProcessPoolBusyException):
+            pool.run(_add, 2, 3)
+        assert pool.stats().rejected == 1
+
+        for thread in waiting:
+            thread.join()
+
+        # With everybody done, there's room again.
+        assert pool.run(_add, 2, 3) == 5
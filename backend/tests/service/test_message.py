@@ -1,12 +1,19 @@
 import pytest
 
+from critterchat.common import Time
 from critterchat.config import Config
 from critterchat.data import (
     ConnectionLike,
     Data,
+    Action,
     ActionType,
+    AttachmentID,
+    NewActionID,
+    NewOccupantID,
+    Occupant,
 )
 from critterchat.service.message import MessageService
+from ..mocks import CountingConnection
 
 
 @pytest.mark.integration
@@ -16,7 +23,8 @@ class TestMessageService:
         Tests a regression found when adding SQLite backend, to ensure attachments get linked to messages.
         """
 
-        data = Data(config, tx)
+        counter = CountingConnection(tx)
+        data = Data(config, counter)
         ms = MessageService(config, data)
 
         # First, create a user
@@ -29,18 +37,133 @@ class TestMessageService:
         # Now, join the room as a user and attempt to send a message.
         ms.join_room(room.id, user.id)
 
-        # Create an attachment to attach to the message we're going to send.
-        aid = data.attachment.insert_attachment('local', 'image/png', 'testing.png', {})
-        assert aid is not None
+        # Create a few attachments to attach to the message we're going to send.
+        aids: list[AttachmentID] = []
+        for i in range(3):
+            aid = data.attachment.insert_attachment('local', 'image/png', f'testing{i}.png', {})
+            assert aid is not None
+            aids.append(aid)
 
-        action = ms.add_message(room.id, user.id, "this is a test", False, [aid])
+        counter.queries = []
+        counter.commits = []
+        action = ms.add_message(room.id, user.id, "this is a test", False, aids)
         assert action is not None
 
+        # The action and every one of its attachments should show up together, so nothing should be
+        # committed between inserting the action and linking the last attachment.
+        inserted = next(i for i, q in enumerate(counter.queries) if q.startswith("INSERT INTO action "))
+        linked = max(i for i, q in enumerate(counter.queries) if q.startswith("INSERT INTO action_attachment"))
+        assert [c for c in counter.commits if inserted < c <= linked] == []
+        assert any(c > linked for c in counter.commits)
+        assert {a.attachmentid for a in data.attachment.get_action_attachments(action.id)[action.id]} == set(aids)
+
         # Verify the action is what we expected.
         assert action.action == ActionType.MESSAGE
         assert action.occupant is not None
         assert action.occupant.userid == user.id
-        assert action.details == {"message": "this is a test", "reactions": {}}
-        assert len(action.attachments) == 1
-        assert action.attachments[0].id == aid
-        assert action.attachments[0].mimetype == "image/png"
+        assert action.details == {"message": "this is a test"}
+        assert [a.id for a in action.attachments] == aids
+        assert {a.mimetype for a in action.attachments} == {"image/png"}
+
+    def test_message_query_count(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Locks in the number of queries it takes to send a message, since this is by far the most
+        common write that the server performs.
+        """
+
+        counter = CountingConnection(tx)
+        data = Data(config, counter)
+        ms = MessageService(config, data)
+
+        # First, create a user and a room to send messages in.
+        user = data.user.create_account("test_message_query_count_user", "amazing_password")
+        assert user is not None
+        room = ms.create_public_room("test message query count", "", None)
+        ms.join_room(room.id, user.id)
+
+        # Send a message, and make sure that we only look up what we need before writing.
+        counter.queries = []
+        action = ms.add_message(room.id, user.id, "this is a test", False, [])
+        assert action is not None
+        assert action.occupant is not None
+        assert action.occupant.username == "test_message_query_count_user"
+
+        # One lookup each for the room and our occupant, then the insert, the room's bookkeeping,
+        # the change log entry and the unread counts.
+        assert [q.split(" ")[0] for q in counter.queries] == ["SELECT", "SELECT", "INSERT", "UPDATE", "INSERT", "UPDATE"]
+
+    def test_room_history_paging(self, config: Config, tx: ConnectionLike) -> None:
+        """
+        Tests paging through history from either direction and jumping into the middle of it,
+        including whether each page reports more history past either end.
+        """
+
+        data = Data(config, tx)
+        ms = MessageService(config, data)
+
+        user = data.user.create_account("test_room_history_paging_user", "amazing_password")
+        assert user is not None
+        room = ms.create_public_room("test room history paging", "", None)
+        ms.join_room(room.id, user.id)
+        for i in range(10):
+            ms.add_message(room.id, user.id, f"message {i}", False, [])
+
+        # Everything the room has, oldest first, to compare pages against.
+        everything = [a.id for a in reversed(ms.get_room_history(room.id).actions)]
+        assert len(everything) >= 11
+
+        # The most recent page never has anything newer.
+        page = ms.get_room_history(room.id, limit=4)
+        assert [a.id for a in page.actions] == everything[-1:-5:-1]
+        assert (page.more_before, page.more_after) == (True, False)
+
+        # Walking backwards should stop exactly at the start of the room.
+        page = ms.get_room_history(room.id, before=everything[4], limit=4)
+        assert [a.id for a in page.actions] == everything[3::-1]
+        assert (page.more_before, page.more_after) == (False, True)
+
+        # Jumping into the middle should keep the anchor and split the page around it.
+        page = ms.get_room_history(room.id, around=everything[5], limit=5)
+        assert [a.id for a in page.actions] == everything[7:2:-1]
+        assert (page.more_before, page.more_after) == (True, True)
+
+        page = ms.get_room_history(room.id, around=everything[5], limit=1)
+        assert [a.id for a in page.actions] == [everything[5]]
+        assert (page.more_before, page.more_after) == (True, True)
+
+        # Walking forwards should stop exactly at the end of the room.
+        page = ms.get_room_history(room.id, after=everything[2], limit=3)
+        assert [a.id for a in page.actions] == everything[5:2:-1]
+        assert (page.more_before, page.more_after) == (True, True)
+
+        page = ms.get_room_history(room.id, after=everything[-4], limit=3)
+        assert [a.id for a in page.actions] == everything[-1:-4:-1]
+        assert (page.more_before, page.more_after) == (True, False)
+
+        page = ms.get_room_history(room.id, after=everything[-1], limit=3)
+        assert page.actions == []
+        assert (page.more_before, page.more_after) == (True, False)
+
+        # Actions that never show up in history shouldn't make it look like there's more to load.
+        data.room.insert_action(room.id, Action(
+            actionid=NewActionID,
+            timestamp=Time.now(),
+            occupant=Occupant(occupantid=NewOccupantID, userid=user.id),
+            action=ActionType.CHANGE_USERS,
+            details={},
+        ))
+
+        page = ms.get_room_history(room.id, after=everything[-4], limit=3)
+        assert [a.id for a in page.actions] == everything[-1:-4:-1]
+        assert (page.more_before, page.more_after) == (True, False)
+
+        # They still count as the newest action, so that watching from here doesn't resend them.
+        assert page.newest_action is not None and page.newest_action > everything[-1]
+
+        page = ms.get_room_history(room.id, around=everything[-1], limit=1)
+        assert [a.id for a in page.actions] == [everything[-1]]
+        assert (page.more_before, page.more_after) == (True, False)
+
+        page = ms.get_room_history(room.id, before=everything[-1], limit=3)
+        assert [a.id for a in page.actions] == everything[-2:-5:-1]
+        assert (page.more_before, page.more_after) == (True, True)
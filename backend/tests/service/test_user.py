@@ -0,0 +1,80 @@
+import pytest
+
+from critterchat.data import ActionID, RoomID, UserID, lastseenbuffer
+from critterchat.service.user import UserService
+from ..mocks import MockConfig, MockData, set_lambda, set_return
+
+
+@pytest.mark.unit
+class TestUserService:
+    def test_last_seen_coalescing(self) -> None:
+        """
+        Verifies that read state is buffered, coalesced and written out in one go, and that reads
+        see anything still waiting to be written.
+        """
+
+        config = MockConfig()
+        data = MockData()
+        us = UserService(config, data)
+
+        # Make sure nothing is left over from anywhere else.
+        us.flush_last_seen(force=True)
+        lastseenbuffer.configure(config.database.lastseen_flush_ms)
+
+        written: list[dict[tuple[UserID, RoomID], ActionID]] = []
+        set_lambda(data.user.mark_last_seen_many, written.append)
+
+        # Only the newest action per room should survive.
+        us.mark_last_seen(UserID(1), RoomID(10), ActionID(100))
+        us.mark_last_seen(UserID(1), RoomID(10), ActionID(105))
+        us.mark_last_seen(UserID(1), RoomID(10), ActionID(103))
+        us.mark_last_seen(UserID(1), RoomID(11), ActionID(200))
+        us.mark_last_seen(UserID(2), RoomID(10), ActionID(101))
+        assert written == []
+
+        # Reads should overlay what hasn't been written yet on top of what the DB has.
+        set_return(data.user.get_last_seen_actions, [(RoomID(10), ActionID(90)), (RoomID(12), ActionID(300))])
+        set_return(data.user.get_last_seen_counts, [(RoomID(10), 5), (RoomID(12), 2)])
+        counted: list[dict[RoomID, ActionID | None]] = []
+
+        def count(seen: dict[RoomID, ActionID | None]) -> dict[RoomID, int]:
+            counted.append(seen)
+            return {roomid: 0 for roomid in seen}
+
+        set_lambda(data.user.count_unread_actions_many, count)
+        assert us.get_last_seen_actions(UserID(1)) == {RoomID(10): ActionID(105), RoomID(11): ActionID(200), RoomID(12): ActionID(300)}
+        assert us.get_last_seen_counts(UserID(1)) == {RoomID(10): 0, RoomID(11): 0, RoomID(12): 2}
+
+        # Every pending room should be counted in one go against the newest action seen.
+        assert counted == [{RoomID(10): ActionID(105), RoomID(11): ActionID(200)}]
+
+        us.flush_last_seen(force=True)
+        assert written == [{
+            (UserID(1), RoomID(10)): ActionID(105),
+            (UserID(1), RoomID(11)): ActionID(200),
+            (UserID(2), RoomID(10)): ActionID(101),
+        }]
+
+        # Having just flushed, a regular flush shouldn't write again until the interval passes.
+        written.clear()
+        us.mark_last_seen(UserID(1), RoomID(10), ActionID(106))
+        us.flush_last_seen()
+        assert written == []
+
+        # A failed write shouldn't take the caller down, and should keep everything around for the next attempt.
+        def fail(seen: dict[tuple[UserID, RoomID], ActionID]) -> None:
+            raise Exception("DB went away")
+
+        set_lambda(data.user.mark_last_seen_many, fail)
+        us.flush_last_seen(force=True)
+
+        set_lambda(data.user.mark_last_seen_many, written.append)
+        us.flush_last_seen(force=True)
+        assert written == [{(UserID(1), RoomID(10)): ActionID(106)}]
+
+        # Until the process configures it, everything should be written out on every flush.
+        lastseenbuffer.configure(0)
+        written.clear()
+        us.mark_last_seen(UserID(1), RoomID(10), ActionID(107))
+        us.flush_last_seen()
+        assert written == [{(UserID(1), RoomID(10)): ActionID(107)}]
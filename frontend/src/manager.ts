@@ -115,7 +115,7 @@ interface Details {
     // Sometimes present on JOIN and LEAVE actions to specify if they were added or removed by somebody.
     actor?: ID;
 
-    // Present on CHANGE_MESSAGE actions to specify who changed the message (could be somebody reacting).
+    // Present on CHANGE_MESSAGE and CHANGE_REACTION actions to specify which message was changed.
     actionid?: ID;
 
     // Present on INVITE_USER actions to specify who invited the occupant.
@@ -131,7 +131,8 @@ interface Details {
     // Present on MESSAGE actions when the message was resent due to being modified.
     modified?: boolean;
 
-    // These are present on CHANGE_MESSAGE actions to specify what was changed.
+    // These are present on CHANGE_MESSAGE actions to specify what was changed. CHANGE_REACTION
+    // actions only ever carry the single reaction that was added or removed.
     edited?: string[];
     add?: string;
     remove?: string;
@@ -604,10 +605,11 @@ export function manager(socket: Socket) {
                             }
                         }
                     }
-                } else if (message.action == "change_message") {
+                } else if (message.action == "change_message" || message.action == "change_reaction") {
                     if (message.occupant?.username != window.username) {
                         const edited = message.details.edited || [];
-                        if (edited.includes("reactions") && message.details.add) {
+                        const reacted = message.action == "change_reaction" || edited.includes("reactions");
+                        if (reacted && message.details.add) {
                             // This is a reaction add, we need to look up the original message.
                             const reactedOwner = actions.get(message.details.actionid);
                             let reactingToMe = false;
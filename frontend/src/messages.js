@@ -950,6 +950,13 @@ class Messages {
             this._recalculateSendEnabled();
         }
 
+        // Reaction changes only carry the change itself, so apply them to messages we already have.
+        actions.forEach((message) => {
+            if (message.action == "change_reaction") {
+                this._applyReaction(message);
+            }
+        });
+
         this._drawActions( actions );
 
         if (this.visibility == "hidden" && lastSeenMessage && !this._isNewIndicatorPresent()) {
@@ -1402,6 +1409,53 @@ class Messages {
         return html;
     }
 
+    /**
+     * Given a change_reaction action, applies the single reaction that was added or removed to
+     * the message it refers to and redraws that message's reactions. The server only sends us
+     * the change instead of re-sending the whole message every time somebody reacts.
+     */
+    _applyReaction( change ) {
+        const occupant = change.occupant.id;
+        const reaction = change.details.add || change.details.remove;
+        var updated = undefined;
+
+        this.messages.forEach((message) => {
+            if (message.id != change.details.actionid || message.action != "message") {
+                return;
+            }
+
+            const reactions = message.details.reactions || {};
+            const ordering = message.details.reactions_order || [];
+            const existing = (reactions[reaction] || []).filter((o) => o != occupant);
+            if (change.details.add) {
+                existing.push(occupant);
+            }
+
+            if (existing.length) {
+                reactions[reaction] = existing;
+                if (!ordering.includes(reaction)) {
+                    ordering.push(reaction);
+                }
+            } else {
+                delete reactions[reaction];
+            }
+
+            message.details.reactions = reactions;
+            message.details.reactions_order = ordering.filter((r) => r in reactions);
+            updated = message;
+        });
+
+        if (updated) {
+            const messages = $('div.chat > div.conversation-wrapper > div.conversation');
+            const drawnReactions = messages.find('div.reactions#' + updated.id);
+            drawnReactions.html(this._drawReactions(updated.details.reactions, updated.details.reactions_order));
+
+            // Make sure reactions on the last message are visible, but don't badge new
+            // messages if we're scrolled up.
+            this._ensureScrolled(false);
+        }
+    }
+
     /**
      * Draws the reactions for a given message.
      */